@@ -0,0 +1,130 @@
+"""
+Защита от флуда и повторных нажатий.
+
+У каждого пользователя свой token bucket: RATE апдейтов в секунду с запасом
+BURST. Апдейты сверх лимита отбрасываются до хендлеров, FSM и запросов к geo.
+
+Повторное нажатие той же кнопки на том же сообщении отбрасывается, пока
+первое нажатие еще обрабатывается и DUPLICATE_WINDOW секунд после этого:
+двойной тап иначе повторяет действие кнопки. Кнопка "Next" несет номер
+своего шага (next_step:<n>), поэтому нажатие на следующем шаге того же
+сообщения - уже другая кнопка и проходит сразу; а дубль, который пришел
+позже окна, отбросит сам хендлер по номеру шага. На отброшенные нажатия
+отвечаем пустым answer(), чтобы с кнопки пропали "часики".
+
+Состояние хранится в OrderedDict в порядке последнего обращения: записи,
+которые уже ничем не отличаются от новых (бакет успел наполниться, окно
+повтора прошло), удаляются с начала словаря при каждом обращении, так что
+память ограничена активными пользователями и max_tracked.
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, TelegramObject
+
+import metrics
+
+# Сколько апдейтов в секунду пропускать от одного пользователя и какой запас на всплеск
+RATE = 1.0
+BURST = 10
+# Сколько секунд после обработки нажатия считать повторное нажатие той же кнопки дублем
+DUPLICATE_WINDOW = 1.0
+# Максимум пользователей и нажатий в памяти
+MAX_TRACKED = 100_000
+
+UPDATES = metrics.Counter("bot_antiflood_updates_total", "Updates seen by the anti-flood middleware", ["event", "result"])
+
+
+class AntiFloodMiddleware(BaseMiddleware):
+    """Outer middleware для message и callback_query: лимит частоты и отбрасывание повторных нажатий."""
+
+    def __init__(
+        self,
+        rate: float = RATE,
+        burst: int = BURST,
+        duplicate_window: float = DUPLICATE_WINDOW,
+        max_tracked: int = MAX_TRACKED,
+        exempt: Iterable[int] = (),
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.duplicate_window = duplicate_window
+        self.max_tracked = max_tracked
+        self.exempt = frozenset(exempt)
+        # user_id -> [токены, время обновления]
+        self._buckets: OrderedDict[int, list] = OrderedDict()
+        # (user_id, сообщение, callback_data) -> время окончания обработки (None - еще обрабатывается)
+        self._callbacks: OrderedDict[tuple, float | None] = OrderedDict()
+        # Через сколько секунд простоя бакет снова полный и его можно забыть
+        self._bucket_idle = burst / rate
+
+    def tracked(self) -> dict:
+        """Сколько пользователей и нажатий сейчас в памяти."""
+        return {"users": len(self._buckets), "callbacks": len(self._callbacks)}
+
+    def _allow(self, user_id: int, now: float) -> bool:
+        buckets = self._buckets
+        bucket = buckets.get(user_id)
+        if bucket is None:
+            bucket = buckets[user_id] = [float(self.burst), now]
+        else:
+            buckets.move_to_end(user_id)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        allowed = bucket[0] >= 1
+        if allowed:
+            bucket[0] -= 1
+        # Начало словаря - давно не писавшие пользователи
+        idle_before = now - self._bucket_idle
+        while buckets and (len(buckets) > self.max_tracked or next(iter(buckets.values()))[1] < idle_before):
+            buckets.popitem(last=False)
+        return allowed
+
+    def _expire_callbacks(self, now: float):
+        callbacks = self._callbacks
+        expired_before = now - self.duplicate_window
+        while callbacks:
+            done_at = next(iter(callbacks.values()))
+            if len(callbacks) <= self.max_tracked and (done_at is None or done_at >= expired_before):
+                break
+            callbacks.popitem(last=False)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None or user.id in self.exempt:
+            return await handler(event, data)
+        kind = "callback_query" if isinstance(event, CallbackQuery) else "message"
+        now = time.monotonic()
+        if not self._allow(user.id, now):
+            UPDATES.inc(kind, "throttled")
+            if kind == "callback_query":
+                # Снимаем "часики" с кнопки, но больше ничего не делаем
+                await event.answer()
+            return None
+        if kind == "message":
+            UPDATES.inc(kind, "passed")
+            return await handler(event, data)
+
+        self._expire_callbacks(now)
+        message_id = event.message.message_id if event.message else event.inline_message_id
+        key = (user.id, message_id, event.data)
+        if key in self._callbacks:
+            UPDATES.inc(kind, "duplicate")
+            # Снимаем "часики" с кнопки, но больше ничего не делаем
+            await event.answer()
+            return None
+        UPDATES.inc(kind, "passed")
+        self._callbacks[key] = None
+        try:
+            return await handler(event, data)
+        finally:
+            # Окно повтора отсчитывается от конца обработки
+            self._callbacks.pop(key, None)
+            self._callbacks[key] = time.monotonic()
@@ -0,0 +1,109 @@
+"""
+Сравнение SQLiteStorage с MemoryStorage aiogram на типичной нагрузке воронки.
+
+Для каждого пользователя выполняется то же, что делают хендлеры:
+update_data + set_state при верификации, затем три перехода get_state/get_data/set_state
+и clear в конце. MemoryStorage получает старый формат данных (весь словарь сценария),
+SQLiteStorage - компактный (ключ сценария). Замеряются скорость и память процесса.
+
+Запуск из корня репозитория:
+    python -m benchmarks.fsm_storage --users 20000
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import db
+import scenarios
+from storage import SQLiteStorage
+
+BOT_ID = 42
+STATES = ["UserFlow:step_1", "UserFlow:step_2", "UserFlow:step_3", "UserFlow:step_4"]
+
+
+async def walk_funnel(storage, user_id: int, data: dict, finish: bool):
+    key = StorageKey(bot_id=BOT_ID, chat_id=user_id, user_id=user_id)
+    await storage.get_state(key)
+    await storage.update_data(key, data)
+    await storage.set_state(key, STATES[0])
+    for state in STATES[1:]:
+        await storage.get_state(key)
+        await storage.get_data(key)
+        await storage.set_state(key, state)
+    if finish:
+        await storage.set_state(key, None)
+        await storage.set_data(key, {})
+
+
+async def run(storage, users: int, data: dict, abandon_ratio: float) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    # Часть пользователей бросает воронку, их сессии остаются висеть
+    finish_every = round(1 / (1 - abandon_ratio)) if abandon_ratio < 1 else 0
+    for user_id in range(1, users + 1):
+        await walk_funnel(storage, user_id, data, finish=bool(finish_every) and user_id % finish_every == 0)
+    elapsed = time.perf_counter() - started
+    flush_started = time.perf_counter()
+    if isinstance(storage, SQLiteStorage):
+        await storage.flush()
+    flush_time = time.perf_counter() - flush_started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    ops = users * 12
+    return {
+        "updates_per_second": round(users * 5 / elapsed),
+        "storage_ops_per_second": round(ops / elapsed),
+        "flush_seconds": round(flush_time, 4),
+        "memory_kib": current // 1024,
+        "peak_memory_kib": peak // 1024,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--abandon", type=float, default=0.7, help="доля пользователей, бросивших воронку")
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = parser.parse_args()
+
+    results = {}
+    results["memory_storage"] = await run(
+        MemoryStorage(), args.users, {"scenario": scenarios.read_file()[0]["CA"], "country": "CA"}, args.abandon
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_NAME = os.path.join(tmp, "bench.db")
+        await db.init_db()
+        storage = SQLiteStorage()
+        await storage.start()
+        results["sqlite_storage"] = await run(storage, args.users, {"scenario": "CA", "country": "CA"}, args.abandon)
+        # Выгрузка всех сессий из памяти, как после CACHE_IDLE_TTL
+        storage.cache_idle_ttl = -1
+        started = time.perf_counter()
+        await storage.evict()
+        results["sqlite_storage"]["evict_seconds"] = round(time.perf_counter() - started, 4)
+        results["sqlite_storage"]["sessions_in_memory_after_evict"] = storage.session_count()
+        await storage.close()
+        await db.close_db()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.users} users, {args.abandon:.0%} abandon the funnel")
+    for name, result in results.items():
+        print(f"\n{name}:")
+        for metric, value in result.items():
+            print(f"  {metric}: {value}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,272 @@
+"""
+Нагрузочный тест воронки: приложение из main.py против локальной заглушки Bot API.
+
+Синтетические пользователи проходят /start -> web_app_data -> next_step x3 ->
+open_platform, отправляя апдейты на вебхук так же, как Telegram. Шаг считается
+обработанным, когда бот вызвал в заглушке ожидаемый метод (sendMessage или
+answerCallbackQuery). Результат - пропускная способность и p50/p95/p99 по каждому
+шагу; с --output он сохраняется в JSON для сравнения между коммитами.
+
+Запуск из корня репозитория:
+    python -m benchmarks.loadtest --users 2000 --concurrency 200 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import aiohttp
+
+from benchmarks.mock_bot_api import MockBotAPI
+
+BOT_TOKEN = "123456789:LOADTEST-TOKEN"
+FIRST_USER_ID = 10_000_000
+
+# Координаты для web_app_data: страны со своим сценарием и страна со сценарием DEFAULT
+LOCATIONS = [(43.65, -79.38), (40.42, -3.70), (52.52, 13.40)]
+STEPS = ["start", "web_app_data", "next_step_1", "next_step_2", "next_step_3", "open_platform"]
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+class UpdateFactory:
+    """Собирает JSON апдейтов в формате, который присылает Telegram."""
+
+    def __init__(self):
+        self._update_id = 0
+        self._message_id = 0
+
+    def _next_ids(self):
+        self._update_id += 1
+        self._message_id += 1
+        return self._update_id, self._message_id
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"load{user_id}"}
+
+    def message(self, user_id: int, text: str | None = None, web_app_data: str | None = None) -> dict:
+        update_id, message_id = self._next_ids()
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+        }
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        if web_app_data is not None:
+            message["web_app_data"] = {"data": web_app_data, "button_text": "✅ Verify Location"}
+        return {"update_id": update_id, "message": message}
+
+    def callback(self, user_id: int, data: str) -> tuple[dict, str]:
+        update_id, message_id = self._next_ids()
+        callback_id = f"{user_id}-{update_id}"
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": callback_id,
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": "step",
+                },
+            },
+        }, callback_id
+
+
+class LoadTest:
+    def __init__(self, api: MockBotAPI, webhook_url: str, step_timeout: float):
+        self.api = api
+        self.webhook_url = webhook_url
+        self.step_timeout = step_timeout
+        self.updates = UpdateFactory()
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.failures: dict[str, int] = defaultdict(int)
+        self.completed = 0
+        self.http: aiohttp.ClientSession | None = None
+
+    async def _step(self, name: str, update: dict, method: str, key) -> bool:
+        waiter = self.api.wait_for(method, key)
+        started = time.perf_counter()
+        async with self.http.post(self.webhook_url, json=update) as response:
+            await response.read()
+            if response.status != 200:
+                self.failures[name] += 1
+                waiter.cancel()
+                return False
+        try:
+            finished = await asyncio.wait_for(waiter, self.step_timeout)
+        except asyncio.TimeoutError:
+            self.failures[name] += 1
+            return False
+        self.latencies[name].append(finished - started)
+        return True
+
+    async def walk_funnel(self, user_id: int):
+        lat, lon = random.choice(LOCATIONS)
+        steps = [
+            ("start", self.updates.message(user_id, text="/start"), "sendMessage", user_id),
+            ("web_app_data", self.updates.message(user_id, web_app_data=f"lat:{lat},lon:{lon}"), "sendMessage", user_id),
+        ]
+        for name, update, method, key in steps:
+            if not await self._step(name, update, method, key):
+                return
+        for index in range(1, 4):
+            update, callback_id = self.updates.callback(user_id, f"next_step:{index}")
+            if not await self._step(f"next_step_{index}", update, "answerCallbackQuery", callback_id):
+                return
+        update, callback_id = self.updates.callback(user_id, "open_platform")
+        if await self._step("open_platform", update, "answerCallbackQuery", callback_id):
+            self.completed += 1
+
+    async def run(self, users: int, concurrency: int) -> float:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def user_task(user_id):
+            async with semaphore:
+                await self.walk_funnel(user_id)
+
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as self.http:
+            started = time.perf_counter()
+            await asyncio.gather(*(user_task(FIRST_USER_ID + i) for i in range(users)))
+            return time.perf_counter() - started
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    api = MockBotAPI(args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate)
+    api_url = await api.start()
+
+    # main.py читает настройки при импорте, поэтому окружение готовим заранее
+    os.environ.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "BOT_API_URL": api_url,
+        "BASE_URL": "https://loadtest.invalid",
+        "ADMIN_IDS": "",
+    })
+    if args.webhook_mode:
+        os.environ["WEBHOOK_MODE"] = args.webhook_mode
+    from aiohttp import web
+    import bots
+    import db
+    import main
+    import outbound
+
+    # Логи каждого апдейта искажают замер
+    logging.getLogger().setLevel(logging.WARNING)
+    # Синтетический пользователь жмет кнопки без пауз, живой - нет: лимит чата
+    # не должен растягивать замер пропускной способности бота
+    outbound.PER_CHAT_BURST = len(STEPS)
+    tmp = tempfile.TemporaryDirectory()
+    db.DB_NAME = os.path.join(tmp.name, "loadtest.db")
+    runner = web.AppRunner(main.app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    test = LoadTest(api, f"http://127.0.0.1:{port}{bots.CONFIGS[0].webhook_path}", args.step_timeout)
+    try:
+        elapsed = await test.run(args.users, args.concurrency)
+    finally:
+        await runner.cleanup()
+        await api.stop()
+        tmp.cleanup()
+
+    updates = sum(len(values) for values in test.latencies.values())
+    return {
+        "revision": git_revision(),
+        "config": {
+            "users": args.users,
+            "concurrency": args.concurrency,
+            "latency_ms": args.latency_ms,
+            "jitter_ms": args.jitter_ms,
+            "error_rate": args.error_rate,
+            "webhook_mode": os.environ.get("WEBHOOK_MODE", "queue"),
+        },
+        "elapsed_seconds": round(elapsed, 3),
+        "funnels_completed": test.completed,
+        "funnels_per_second": round(test.completed / elapsed, 2),
+        "updates_per_second": round(updates / elapsed, 2),
+        "steps": {
+            name: {
+                "count": len(test.latencies[name]),
+                "failures": test.failures[name],
+                "mean_ms": round(statistics.fmean(test.latencies[name]) * 1000, 2) if test.latencies[name] else 0.0,
+                "p50_ms": round(percentile(test.latencies[name], 50) * 1000, 2),
+                "p95_ms": round(percentile(test.latencies[name], 95) * 1000, 2),
+                "p99_ms": round(percentile(test.latencies[name], 99) * 1000, 2),
+            }
+            for name in STEPS
+        },
+        "api_calls": dict(api.calls),
+        "api_throttled": dict(api.throttled),
+    }
+
+
+def print_report(result: dict):
+    print(f"revision {result['revision']}, {result['config']}")
+    print(
+        f"{result['funnels_completed']} funnels in {result['elapsed_seconds']} s: "
+        f"{result['funnels_per_second']} funnels/s, {result['updates_per_second']} updates/s"
+    )
+    print(f"{'step':<15}{'count':>8}{'fail':>6}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}  (ms)")
+    for name, step in result["steps"].items():
+        print(
+            f"{name:<15}{step['count']:>8}{step['failures']:>6}{step['mean_ms']:>10}"
+            f"{step['p50_ms']:>10}{step['p95_ms']:>10}{step['p99_ms']:>10}"
+        )
+    if result["api_throttled"]:
+        print(f"429 responses: {result['api_throttled']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100, help="сколько пользователей идут по воронке одновременно")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="задержка ответа заглушки Bot API")
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429 от заглушки")
+    parser.add_argument("--webhook-mode", choices=["queue", "inline"], help="переопределить WEBHOOK_MODE")
+    parser.add_argument("--step-timeout", type=float, default=30.0)
+    parser.add_argument("--output", help="сохранить результат в JSON-файл")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if result["funnels_completed"] < args.users:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
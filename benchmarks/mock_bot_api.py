@@ -0,0 +1,121 @@
+"""
+Локальная заглушка Telegram Bot API для нагрузочных тестов.
+
+Отвечает на методы, которые вызывает бот (sendMessage, editMessageText,
+copyMessage, answerCallbackQuery, setWebhook, ...), с настраиваемой задержкой
+и долей ответов 429 Too Many Requests. Тест может дождаться конкретного
+вызова через wait_for().
+
+Можно запустить и отдельно, указав боту BOT_API_URL=http://127.0.0.1:8081:
+    python -m benchmarks.mock_bot_api --port 8081 --latency-ms 30 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+# Методы, которые возвращают объект Message
+MESSAGE_METHODS = {"sendmessage", "editmessagetext", "senddocument"}
+
+
+class MockBotAPI:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.throttled = Counter()
+        self._message_id = 0
+        self._waiters: dict[tuple, list[asyncio.Future]] = {}
+        self._runner: web.AppRunner | None = None
+        self.url: str | None = None
+
+    def wait_for(self, method: str, key) -> asyncio.Future:
+        """
+        Future, которое завершится при следующем вызове method для key
+        (chat_id для сообщений, callback_query_id для answerCallbackQuery).
+        Завершается и при ответе 429: бот все равно попытался ответить.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault((method.lower(), str(key)), []).append(future)
+        return future
+
+    def _notify(self, method: str, params) -> None:
+        key = params.get("callback_query_id") if method == "answercallbackquery" else params.get("chat_id")
+        for future in self._waiters.pop((method, str(key)), []):
+            if not future.done():
+                future.set_result(time.perf_counter())
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        params = await request.post() if request.body_exists else {}
+        self.calls[method] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.random() * self.jitter)
+        self._notify(method, params)
+
+        if self.error_rate and random.random() < self.error_rate:
+            self.throttled[method] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+
+        if method in MESSAGE_METHODS:
+            self._message_id += 1
+            chat_id = int(params.get("chat_id", 0))
+            result = {
+                "message_id": int(params.get("message_id", self._message_id)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        elif method == "copymessage":
+            self._message_id += 1
+            result = {"message_id": self._message_id}
+        elif method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "Mock", "username": "mock_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запускает сервер и возвращает его адрес (порт 0 - любой свободный)."""
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429")
+    args = parser.parse_args()
+    api = MockBotAPI(args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate)
+    web.run_app(api.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Проверка планов запросов из db.py: ни один запрос не должен читать таблицу целиком.
+
+Скрипт находит в db.py все SQL-строки, передаваемые в cursor.execute и
+cursor.executemany, создает пустую базу с актуальной схемой (migrations.py)
+и для каждого запроса выполняет EXPLAIN QUERY PLAN. Полным проходом
+считается проход таблицы ("SCAN users") и проход обычного индекса; проход
+частичного индекса (например, только активных пользователей) допустим.
+
+Осознанные полные проходы (маленькие по построению таблицы, выгрузки)
+перечислены с причинами в ALLOWED_FULL_SCANS в tests/test_query_plans.py:
+тест падает на любом другом. Скрипт только печатает отчет по всем
+запросам, с полными проходами и функциями, где они стоят:
+    python -m benchmarks.query_plans
+    python benchmarks/query_plans.py -v
+"""
+import argparse
+import ast
+import importlib
+import inspect
+import os
+import re
+import sqlite3
+import sys
+
+if not __package__:
+    # Запуск по пути: модули бота лежат в корне репозитория, а не рядом со скриптом
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import migrations
+
+NAMED_PARAM_RE = re.compile(r"(?<!:):(\w+)")
+NUMBERED_PARAM_RE = re.compile(r"\?(\d+)")
+SCAN_RE = re.compile(r"^SCAN (\w+)(?: AS \w+)?(?: USING (?:COVERING )?INDEX (\w+))?")
+
+
+def _sql_text(node: ast.expr, namespace: dict) -> str | None:
+    """Текст запроса из аргумента execute: строка или выражение из строк и констант модуля."""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    allowed = (ast.Constant, ast.Name, ast.Load, ast.JoinedStr, ast.FormattedValue, ast.BinOp, ast.Add, ast.Call, ast.Attribute)
+    nodes = list(ast.walk(node))
+    # Из вызовов допустим только ", ".join(КОНСТАНТА) - список колонок
+    joins = all(
+        isinstance(n.func, ast.Attribute) and n.func.attr == "join"
+        and isinstance(n.func.value, ast.Constant) and isinstance(n.func.value.value, str)
+        for n in nodes if isinstance(n, ast.Call)
+    )
+    if (
+        joins
+        and all(isinstance(n, allowed) for n in nodes)
+        and all(n.id in namespace for n in nodes if isinstance(n, ast.Name))
+    ):
+        return eval(compile(ast.Expression(node), "<sql>", "eval"), dict(namespace))
+    return None
+
+
+def _params(sql: str):
+    """Параметры-заглушки: план не зависит от значений."""
+    names = NAMED_PARAM_RE.findall(sql)
+    if names:
+        return dict.fromkeys(names)
+    numbers = NUMBERED_PARAM_RE.findall(sql)
+    return [None] * (max(map(int, numbers)) if numbers else sql.count("?"))
+
+
+def _calls(tree: ast.Module):
+    """Вызовы в модуле вместе с именем функции верхнего уровня, где они стоят."""
+    for top in tree.body:
+        function = top.name if isinstance(top, (ast.FunctionDef, ast.AsyncFunctionDef)) else "<module>"
+        for node in ast.walk(top):
+            if isinstance(node, ast.Call):
+                yield function, node
+
+
+def find_queries(module) -> tuple[list[tuple[int, str, str]], list[int]]:
+    """
+    SQL из вызовов cursor.execute/executemany модуля: ([(номер строки, функция, запрос), ...],
+    номера строк, где запрос собирается на лету и проверить его нельзя).
+    """
+    queries, dynamic = [], []
+    for function, node in _calls(ast.parse(inspect.getsource(module))):
+        if not (isinstance(node.func, ast.Attribute) and node.func.attr in ("execute", "executemany") and node.args):
+            continue
+        sql = _sql_text(node.args[0], vars(module))
+        if sql is None:
+            dynamic.append(node.lineno)
+        else:
+            queries.append((node.lineno, function, sql))
+    return sorted(queries), sorted(dynamic)
+
+
+def partial_indexes(conn: sqlite3.Connection) -> set[str]:
+    rows = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL").fetchall()
+    return {name for name, sql in rows if " WHERE " in sql.upper()}
+
+
+def check_query(conn: sqlite3.Connection, sql: str, partial: set[str], allowed=frozenset()) -> list[str]:
+    """Полные проходы в плане запроса, кроме проходов таблиц из allowed (пустой список - план в порядке)."""
+    problems = []
+    for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", _params(sql)):
+        detail = row[-1]
+        match = SCAN_RE.match(detail)
+        if match is None:
+            continue
+        table, index = match.groups()
+        if table in allowed or index in partial:
+            continue
+        problems.append(detail)
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="db", help="модуль с запросами")
+    parser.add_argument("-v", "--verbose", action="store_true", help="печатать план каждого запроса")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(":memory:")
+    migrations.migrate(conn.cursor())
+    conn.commit()
+    partial = partial_indexes(conn)
+
+    module = importlib.import_module(args.module)
+    queries, dynamic = find_queries(module)
+    source = inspect.getsourcefile(module)
+    failures = 0
+    for lineno, function, sql in queries:
+        problems = check_query(conn, sql, partial)
+        query = " ".join(sql.split())
+        if problems:
+            failures += 1
+            print(f"{source}:{lineno}: {function}: full scan: {'; '.join(problems)}\n    {query}")
+        elif args.verbose:
+            plan = "; ".join(row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", _params(sql)))
+            print(f"{source}:{lineno}: {function}: ok: {plan or '-'}\n    {query}")
+    for lineno in dynamic:
+        print(f"{source}:{lineno}: skipped: query is built at runtime")
+
+    print(f"{len(queries)} queries checked, {failures} with full scans, {len(dynamic)} skipped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+Воспроизведение записанных вебхуков (recorder.py, RECORD_DIR) против локальной заглушки Bot API.
+
+Апдейты подаются прямо в Dispatcher из main.py в порядке записи: либо с
+исходными интервалами (--speed 1, или 10 - в десять раз быстрее), либо сразу
+все (--speed 0). Как и в режиме queue, апдейты одного пользователя
+обрабатываются строго по очереди, одновременно - не больше --workers.
+Каждый записанный бот получает свой токен "<bot_id>:REPLAY", поэтому ссылки
+и рассылки по ботам разделены так же, как в записи; база каждый раз новая.
+С --remap-users ID пользователей заменяются на FIRST_USER_ID, FIRST_USER_ID + 1, ...
+в порядке появления.
+
+Результат - задержка от момента прихода апдейта до конца его обработки
+(с ожиданием своей очереди) по видам апдейтов: команда, web_app_data,
+данные кнопки. С --output он сохраняется в JSON, с --compare сравнивается
+с сохраненным: рост p95 больше --tolerance считается регрессией.
+
+Запуск из корня репозитория (код возврата 1 при ошибках в хендлерах или регрессии):
+    python -m benchmarks.replay records/ --speed 0 --output replay.json
+    python -m benchmarks.replay records/20240601-120000-0001.updates.gz --compare replay.json
+"""
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from benchmarks.loadtest import git_revision, percentile
+from benchmarks.mock_bot_api import MockBotAPI
+
+FIRST_USER_ID = 20_000_000
+# Ключи, под которыми в апдейте лежат пользователь или чат с полем id
+ID_KEYS = ("from", "chat", "user")
+
+
+def segment_paths(paths: list[str], suffix: str) -> list[str]:
+    """Файлы сегментов: заданные явно и найденные в каталогах, по порядку записи."""
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result.extend(sorted(glob.glob(os.path.join(path, "*" + suffix))))
+        else:
+            result.append(path)
+    return result
+
+
+class UserRemapper:
+    """Заменяет ID пользователей (и их личных чатов) на последовательные, одинаково во всех апдейтах."""
+
+    def __init__(self, first_id: int):
+        self.next_id = first_id
+        self.ids: dict[int, int] = {}
+
+    def _map(self, user_id: int) -> int:
+        mapped = self.ids.get(user_id)
+        if mapped is None:
+            mapped = self.ids[user_id] = self.next_id
+            self.next_id += 1
+        return mapped
+
+    def __call__(self, value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                # ID групп отрицательные, их не трогаем
+                if key in ID_KEYS and isinstance(item, dict) and isinstance(item.get("id"), int) and item["id"] > 0:
+                    item["id"] = self._map(item["id"])
+                self(item)
+        elif isinstance(value, list):
+            for item in value:
+                self(item)
+        return value
+
+
+def event_label(update: dict) -> str:
+    """Вид апдейта для отчета: message:/start, message:web_app_data, callback_query:next_step и т.п."""
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        if key == "callback_query":
+            return f"callback_query:{str(event.get('data', '')).split(':')[0]}"
+        if key == "message":
+            text = event.get("text") or ""
+            if text.startswith("/"):
+                return f"message:{text.split()[0].split('@')[0]}"
+            if "web_app_data" in event:
+                return "message:web_app_data"
+        return key
+    return "unknown"
+
+
+class Replay:
+    def __init__(self, dispatcher, bots: dict, speed: float, workers: int):
+        self.dispatcher = dispatcher
+        self.bots = bots
+        self.speed = speed
+        self.workers = asyncio.Semaphore(workers)
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        # На сколько подача апдейта отстала от расписания (только при speed > 0)
+        self.lag: list[float] = []
+        # Последняя задача каждого пользователя: следующий его апдейт ждет ее
+        self._last: dict = {}
+
+    async def _process(self, label: str, bot, update: dict, due: float, previous: asyncio.Task | None):
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with self.workers:
+            try:
+                await self.dispatcher.feed_raw_update(bot, update)
+            except Exception:
+                self.errors[label] += 1
+                logging.exception(f"Update {update.get('update_id')} failed")
+                return
+        self.latencies[label].append(time.perf_counter() - due)
+
+    async def run(self, records: list[tuple[float, int, dict]], update_owner) -> float:
+        tasks = []
+        first_arrival = records[0][0]
+        started = time.perf_counter()
+        for arrived_at, bot_id, update in records:
+            due = started + (arrived_at - first_arrival) / self.speed if self.speed else time.perf_counter()
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.speed:
+                self.lag.append(max(0.0, time.perf_counter() - due))
+            owner = (bot_id, update_owner(update))
+            task = asyncio.create_task(
+                self._process(event_label(update), self.bots[bot_id], update, due, self._last.get(owner))
+            )
+            self._last[owner] = task
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+
+
+async def run(args) -> dict:
+    random.seed(args.seed)
+    api = MockBotAPI(args.latency_ms / 1000, args.jitter_ms / 1000)
+    api_url = await api.start()
+    tmp = tempfile.TemporaryDirectory()
+    bots_file = os.path.join(tmp.name, "bots.json")
+
+    # main.py и config читают настройки при импорте, поэтому окружение готовим заранее
+    os.environ.update({
+        "BOTS_FILE": bots_file,
+        "BOT_API_URL": api_url,
+        "BASE_URL": "https://replay.invalid",
+        "ADMIN_IDS": "",
+        "RECORD_DIR": "",
+    })
+    import recorder
+    from ingest import update_owner
+
+    paths = segment_paths(args.segments, recorder.SEGMENT_SUFFIX)
+    remap = UserRemapper(args.remap_users) if args.remap_users is not None else None
+    records = []
+    for path in paths:
+        for arrived_at, bot_id, body in recorder.read_segment(path):
+            update = json.loads(body)
+            records.append((arrived_at, bot_id, remap(update) if remap else update))
+    if not records:
+        raise SystemExit(f"No recorded updates in {', '.join(args.segments)}")
+    bot_ids = sorted({bot_id for _, bot_id, _ in records})
+    with open(bots_file, "w") as f:
+        json.dump([{"name": f"replay-{bot_id}", "token": f"{bot_id}:REPLAY"} for bot_id in bot_ids], f)
+
+    import db
+    import main
+    import outbound
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.speed != 1:
+        # В сжатом времени живой пользователь превращается во флуд: лимиты
+        # anti-flood и чата исказили бы замер, поэтому снимаем их
+        main.dp.message.outer_middleware.unregister(main.antiflood)
+        main.dp.callback_query.outer_middleware.unregister(main.antiflood)
+        outbound.PER_CHAT_BURST = 1_000_000
+    db.DB_NAME = os.path.join(tmp.name, "replay.db")
+    await main.on_startup()
+    replay = Replay(main.dp, {instance.id: instance for instance in main.bot_list}, args.speed, args.workers)
+    try:
+        elapsed = await replay.run(records, update_owner)
+    finally:
+        await main.on_shutdown()
+        await main.session.close()
+        await api.stop()
+        tmp.cleanup()
+
+    labels = sorted(replay.latencies.keys() | replay.errors.keys())
+    return {
+        "revision": git_revision(),
+        "config": {
+            "segments": paths,
+            "speed": args.speed,
+            "workers": args.workers,
+            "remap_users": args.remap_users,
+            "latency_ms": args.latency_ms,
+            "jitter_ms": args.jitter_ms,
+            "seed": args.seed,
+        },
+        "updates": len(records),
+        "recorded_seconds": round(records[-1][0] - records[0][0], 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "updates_per_second": round(len(records) / elapsed, 2),
+        "lag_p99_ms": round(percentile(replay.lag, 99) * 1000, 2),
+        "events": {
+            label: {
+                "count": len(replay.latencies[label]),
+                "errors": replay.errors[label],
+                "mean_ms": round(statistics.fmean(replay.latencies[label]) * 1000, 2) if replay.latencies[label] else 0.0,
+                "p50_ms": round(percentile(replay.latencies[label], 50) * 1000, 2),
+                "p95_ms": round(percentile(replay.latencies[label], 95) * 1000, 2),
+                "p99_ms": round(percentile(replay.latencies[label], 99) * 1000, 2),
+            }
+            for label in labels
+        },
+        "api_calls": dict(api.calls),
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Виды апдейтов, у которых p95 вырос больше чем на tolerance относительно baseline."""
+    regressions = []
+    for label, event in result["events"].items():
+        before = baseline["events"].get(label)
+        if not before or not before["p95_ms"]:
+            continue
+        change = event["p95_ms"] / before["p95_ms"] - 1
+        if change > tolerance:
+            regressions.append(f"{label}: p95 {before['p95_ms']} -> {event['p95_ms']} ms (+{change:.0%})")
+    return regressions
+
+
+def print_report(result: dict):
+    print(f"revision {result['revision']}, {result['config']}")
+    print(
+        f"{result['updates']} updates ({result['recorded_seconds']} s recorded) in {result['elapsed_seconds']} s: "
+        f"{result['updates_per_second']} updates/s, schedule lag p99 {result['lag_p99_ms']} ms"
+    )
+    print(f"{'event':<30}{'count':>8}{'errors':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}  (ms)")
+    for label, event in result["events"].items():
+        print(
+            f"{label:<30}{event['count']:>8}{event['errors']:>8}{event['mean_ms']:>10}"
+            f"{event['p50_ms']:>10}{event['p95_ms']:>10}{event['p99_ms']:>10}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("segments", nargs="+", help="файлы сегментов или каталоги с ними")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 - с исходными интервалами, 0 - без пауз")
+    parser.add_argument("--workers", type=int, default=32, help="сколько апдейтов обрабатывается одновременно")
+    parser.add_argument(
+        "--remap-users", type=int, nargs="?", const=FIRST_USER_ID, default=None, metavar="FIRST_ID",
+        help=f"заменить ID пользователей на последовательные (с {FIRST_USER_ID} или FIRST_ID)",
+    )
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="задержка ответа заглушки Bot API")
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0, help="зерно для случайной задержки заглушки")
+    parser.add_argument("--output", help="сохранить результат в JSON-файл")
+    parser.add_argument("--compare", help="JSON прошлого прогона, с которым сравнить p95")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимый рост p95 при --compare")
+    args = parser.parse_args()
+    if args.speed < 0:
+        parser.error("--speed must be >= 0")
+
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    failed = sum(event["errors"] for event in result["events"].values()) > 0
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        failed = failed or bool(regressions)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
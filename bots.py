@@ -0,0 +1,85 @@
+"""
+Боты, которые обслуживает процесс.
+
+Список читается при импорте из JSON-файла config.BOTS_FILE:
+
+    [
+        {"name": "facebook", "token": "123:AAA", "admins": [111, 222]},
+        {"name": "tiktok", "token": "456:BBB", "admins": [111], "webhook_path": "/webhook/tiktok"}
+    ]
+
+Если файл не задан, бот один - из BOT_TOKEN и ADMIN_IDS. У каждого бота свой
+путь вебхука (по умолчанию /webhook/<token>) и свои админы; партнерские ссылки
+и аудитория рассылок разделены по bot_id в базе. Первый бот в списке -
+основной: ему достаются пользователи и рассылки, созданные до появления
+нескольких ботов.
+"""
+import json
+from dataclasses import dataclass
+
+from config import BOT_TOKEN, ADMIN_IDS, BOTS_FILE
+
+
+@dataclass(frozen=True, slots=True)
+class BotConfig:
+    name: str
+    token: str
+    admin_ids: frozenset[int]
+    webhook_path: str
+
+    @property
+    def bot_id(self) -> int:
+        # ID бота - часть токена до двоеточия, узнавать его у Telegram не нужно
+        return int(self.token.split(":")[0])
+
+
+def _parse(raw: dict, index: int) -> BotConfig:
+    if not isinstance(raw, dict) or not isinstance(raw.get("token"), str) or ":" not in raw["token"]:
+        raise ValueError(f"Bot #{index}: expected an object with a 'token' like '123456:ABC...'")
+    token = raw["token"]
+    admins = raw.get("admins", [])
+    if not isinstance(admins, list) or not all(isinstance(admin_id, int) for admin_id in admins):
+        raise ValueError(f"Bot #{index}: 'admins' must be a list of user IDs")
+    return BotConfig(
+        name=str(raw.get("name") or token.split(":")[0]),
+        token=token,
+        admin_ids=frozenset(admins),
+        webhook_path=raw.get("webhook_path") or f"/webhook/{token}",
+    )
+
+
+def load(path: str | None = BOTS_FILE) -> list[BotConfig]:
+    """Читает список ботов из файла или, если файла нет, собирает одного бота из BOT_TOKEN."""
+    if not path:
+        if not BOT_TOKEN:
+            raise ValueError("Set BOT_TOKEN or BOTS_FILE")
+        return [BotConfig("main", BOT_TOKEN, frozenset(ADMIN_IDS), f"/webhook/{BOT_TOKEN}")]
+    with open(path) as f:
+        raw = json.load(f)
+    if not isinstance(raw, list) or not raw:
+        raise ValueError(f"{path}: expected a non-empty list of bots")
+    configs = [_parse(item, index) for index, item in enumerate(raw)]
+    for field in ("bot_id", "webhook_path"):
+        values = [getattr(config, field) for config in configs]
+        if len(set(values)) != len(values):
+            raise ValueError(f"{path}: every bot needs its own {field}")
+    return configs
+
+
+CONFIGS: list[BotConfig] = load()
+_by_id: dict[int, BotConfig] = {config.bot_id: config for config in CONFIGS}
+
+
+def get(bot_id: int) -> BotConfig | None:
+    return _by_id.get(bot_id)
+
+
+def is_admin(bot_id: int, user_id: int) -> bool:
+    """Админ ли пользователь в этом боте."""
+    config = _by_id.get(bot_id)
+    return config is not None and user_id in config.admin_ids
+
+
+def all_admin_ids() -> set[int]:
+    """Админы всех ботов вместе."""
+    return set().union(*(config.admin_ids for config in CONFIGS))
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import date
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+import db
+import keyboards as kb
+import metrics
+import outbound
+
+# Темп отправки задает планировщик исходящих запросов (outbound): рассылка идет
+# с приоритетом BULK и получает то, что осталось от ответов пользователям.
+
+# Сколько сообщений отправляется одновременно
+SENDER_CONCURRENCY = 20
+# Сколько получателей читать из базы за один запрос
+FETCH_BATCH_SIZE = 500
+# Результаты отправки сохраняются пачками: по размеру или по времени
+RESULTS_BATCH_SIZE = 200
+RESULTS_FLUSH_INTERVAL = 2.0
+# Как часто обновлять сообщение с прогрессом у админа
+PROGRESS_UPDATE_INTERVAL = 15.0
+
+# Запущенные в этом процессе рассылки: job_id -> задача
+_running: dict[int, asyncio.Task] = {}
+# Прогресс запущенных рассылок: job_id -> строка задания со счетчиками, которые растут по мере отправки
+_progress: dict[int, dict] = {}
+# Какой счетчик задания увеличивать для каждого результата отправки
+STATUS_COUNTERS = {db.RECIPIENT_SENT: 'sent', db.RECIPIENT_FAILED: 'failed', db.RECIPIENT_BLOCKED: 'blocked'}
+
+
+def format_progress(job: dict) -> str:
+    """Текст сообщения с прогрессом рассылки."""
+    processed = job['sent'] + job['failed'] + job['blocked']
+    # Аудитория считается в начале рассылки, а пользователи за это время приходят и уходят
+    percent = min(100, processed * 100 // job['total']) if job['total'] else 100
+    status = "✅ Рассылка завершена!" if job['status'] == 'done' else "📢 Рассылка идет..."
+    return (
+        f"{status} (#{job['job_id']})\n"
+        f"Кому: {describe_segment(json.loads(job['segment']))}\n"
+        f"Обработано: {processed} из {job['total']} ({percent}%)\n"
+        f"Успешно отправлено: {job['sent']}\n"
+        f"Заблокировали бота: {job['blocked']}\n"
+        f"Других ошибок: {job['failed']}"
+    )
+
+
+async def update_progress_message(bot: Bot, job_id: int):
+    """Обновляет у админа сообщение с прогрессом рассылки."""
+    job = await db.get_broadcast_job(job_id)
+    if not job or not job['progress_message_id']:
+        return
+    reply_markup = None if job['status'] == 'done' else kb.get_broadcast_progress_keyboard(job_id)
+    try:
+        await bot.edit_message_text(
+            format_progress(job),
+            chat_id=job['admin_chat_id'],
+            message_id=job['progress_message_id'],
+            reply_markup=reply_markup,
+        )
+    except TelegramBadRequest as e:
+        # Текст не изменился с прошлого обновления
+        if "message is not modified" not in e.message:
+            logging.warning(f"Could not update broadcast #{job_id} progress: {e}")
+
+
+def parse_segment(text: str) -> dict:
+    """
+    Разбирает фильтр сегмента из текста админа, например "CA step3 2024-05-01 noclick".
+    Возвращает словарь для db (см. db.SEGMENT_FILTERS); бросает ValueError, если не получилось.
+    """
+    segment = {}
+    for token in text.split():
+        lowered = token.lower()
+        if token == "-":
+            continue
+        if len(token) == 2 and token.isalpha():
+            segment["country"] = token.upper()
+        elif lowered.startswith("step") and lowered[4:].isdigit():
+            segment["min_step"] = int(lowered[4:])
+        elif lowered in ("clicked", "noclick"):
+            segment["clicked"] = int(lowered == "clicked")
+        else:
+            # Дата регистрации: пользователи, пришедшие не раньше этого дня
+            segment["joined_after"] = date.fromisoformat(token).isoformat()
+    return segment
+
+
+def describe_segment(segment: dict) -> str:
+    """Описание сегмента для админа."""
+    parts = []
+    if segment.get("country"):
+        parts.append(f"страна {segment['country']}")
+    if segment.get("min_step"):
+        parts.append(f"дошли до шага {segment['min_step']}")
+    if segment.get("joined_after"):
+        parts.append(f"пришли с {segment['joined_after']}")
+    if segment.get("clicked") is not None:
+        parts.append("переходили по ссылке" if segment["clicked"] else "не переходили по ссылке")
+    return ", ".join(parts) or "все активные пользователи"
+
+
+async def start_broadcast(bot: Bot, admin_chat_id: int, from_chat_id: int, message_id: int, segment: dict | None = None) -> int:
+    """Создает задание рассылки сообщения по сегменту (по умолчанию - всем активным) и запускает его в фоне."""
+    segment = segment or {}
+    job_id = await db.create_broadcast_job(bot.id, admin_chat_id, from_chat_id, message_id, segment)
+    progress = await bot.send_message(
+        admin_chat_id,
+        f"Начинаю рассылку (#{job_id}): {describe_segment(segment)}...",
+        reply_markup=kb.get_broadcast_progress_keyboard(job_id),
+    )
+    await db.set_broadcast_progress_message(job_id, progress.message_id)
+    _spawn(bot, job_id)
+    return job_id
+
+
+async def resume_broadcasts(bots: list[Bot]):
+    """Продолжает рассылки, прерванные перезапуском; каждую - тем ботом, который ее начал."""
+    by_id = {bot.id: bot for bot in bots}
+    for job in await db.get_unfinished_broadcast_jobs():
+        if job['job_id'] in _running:
+            continue
+        bot = by_id.get(job['bot_id'])
+        if bot is None:
+            logging.warning(f"Broadcast #{job['job_id']} belongs to bot {job['bot_id']}, which is not configured")
+            continue
+        logging.info(f"Resuming broadcast #{job['job_id']}")
+        _spawn(bot, job['job_id'])
+
+
+def progress() -> dict[int, dict]:
+    """Счетчики запущенных в этом процессе рассылок (для мониторинга)."""
+    return _progress
+
+
+async def stop_broadcasts():
+    """Останавливает рассылки; неотправленные получатели останутся в базе до перезапуска."""
+    tasks = list(_running.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _spawn(bot: Bot, job_id: int):
+    task = asyncio.create_task(_run_job(bot, job_id))
+    _running[job_id] = task
+    task.add_done_callback(lambda _: _running.pop(job_id, None))
+
+
+async def _send_one(bot: Bot, job: dict, user_id: int) -> int:
+    try:
+        # Копируем сообщение, чтобы сохранить форматирование, фото и т.д.
+        # RetryAfter повторяет планировщик outbound
+        await bot.copy_message(chat_id=user_id, from_chat_id=job['from_chat_id'], message_id=job['message_id'])
+        return db.RECIPIENT_SENT
+    except TelegramForbiddenError:
+        return db.RECIPIENT_BLOCKED
+    except TelegramBadRequest as e:
+        if "bot was blocked by the user" in e.message:
+            return db.RECIPIENT_BLOCKED
+        return db.RECIPIENT_FAILED
+    except Exception as e:
+        logging.error(f"Broadcast #{job['job_id']} failed for {user_id}: {e}")
+        return db.RECIPIENT_FAILED
+
+
+async def _run_job(bot: Bot, job_id: int):
+    # Все запросы этой задачи и ее отправителей уступают ответам пользователям
+    outbound.set_priority(outbound.BULK)
+    job = _progress[job_id] = await db.get_broadcast_job(job_id)
+    queue: asyncio.Queue[int | None] = asyncio.Queue(maxsize=SENDER_CONCURRENCY * 2)
+    results: list[tuple[int, int]] = []
+    last_flush = last_progress = time.monotonic()
+
+    async def flush():
+        nonlocal results, last_flush
+        batch, results = results, []
+        last_flush = time.monotonic()
+        await db.save_broadcast_results(job_id, batch)
+
+    async def sender():
+        nonlocal last_progress
+        while (user_id := await queue.get()) is not None:
+            status = await _send_one(bot, job, user_id)
+            results.append((user_id, status))
+            job[STATUS_COUNTERS[status]] += 1
+            metrics.BROADCAST_MESSAGES.inc(STATUS_COUNTERS[status])
+            now = time.monotonic()
+            if len(results) >= RESULTS_BATCH_SIZE or now - last_flush >= RESULTS_FLUSH_INTERVAL:
+                await flush()
+            if now - last_progress >= PROGRESS_UPDATE_INTERVAL:
+                last_progress = now
+                await update_progress_message(bot, job_id)
+
+    async def count_audience():
+        job['total'] = await db.count_segment_users(job['bot_id'], segment)
+        await db.set_broadcast_total(job_id, job['total'])
+
+    segment = json.loads(job['segment'])
+    senders = [asyncio.create_task(sender()) for _ in range(SENDER_CONCURRENCY)]
+    # Размер аудитории нужен только для прогресса - отправка его не ждет
+    counter = asyncio.create_task(count_audience()) if not job['total'] else None
+    try:
+        async for user_id in db.iter_segment_users(job_id, job['bot_id'], segment, FETCH_BATCH_SIZE):
+            await queue.put(user_id)
+        for _ in senders:
+            await queue.put(None)
+        await asyncio.gather(*senders)
+        await flush()
+        await db.finish_broadcast_job(job_id)
+        await update_progress_message(bot, job_id)
+    except asyncio.CancelledError:
+        for task in senders:
+            task.cancel()
+        await asyncio.gather(*senders, return_exceptions=True)
+        # Сохраняем то, что успели отправить, чтобы после перезапуска не слать повторно
+        await flush()
+        raise
+    except Exception:
+        logging.exception(f"Broadcast #{job_id} crashed")
+        for task in senders:
+            task.cancel()
+        await flush()
+    finally:
+        if counter is not None:
+            counter.cancel()
+        _progress.pop(job_id, None)
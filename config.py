@@ -7,49 +7,51 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 IPINFO_TOKEN = os.getenv("IPINFO_TOKEN")
 BASE_URL = os.getenv("BASE_URL")
+# Адрес своего сервера Bot API (например, локального telegram-bot-api); по умолчанию api.telegram.org
+BOT_API_URL = os.getenv("BOT_API_URL")
 
 # Преобразуем строку с ID администраторов в список целых чисел
 ADMIN_IDS_STR = os.getenv("ADMIN_IDS", "")
 ADMIN_IDS = [int(admin_id) for admin_id in ADMIN_IDS_STR.split(',') if admin_id]
 
+# Несколько ботов в одном процессе: JSON-файл со списком ботов (см. bots.py).
+# Если не задан, процесс обслуживает одного бота из BOT_TOKEN и ADMIN_IDS
+BOTS_FILE = os.getenv("BOTS_FILE")
+
+# Состояния FSM держатся в памяти и пишутся в базу с задержкой.
+# При запуске нескольких воркеров gunicorn выключите: FSM_WRITE_BEHIND=0
+FSM_WRITE_BEHIND = os.getenv("FSM_WRITE_BEHIND", "1") == "1"
+
+# Обработка вебхуков: "queue" - сразу отвечаем Telegram и обрабатываем апдейты пулом воркеров
+# (с сохранением порядка для каждого пользователя), "inline" - как раньше, через SimpleRequestHandler
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "queue")
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "32"))
+# Сколько апдейтов может ждать обработки, прежде чем вебхук начнет отвечать 503
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "10000"))
+
+# Запись входящих вебхуков для воспроизведения (benchmarks/replay.py): каталог
+# для сегментов; не задан - не записывать. Размер одного сжатого сегмента, МБ
+RECORD_DIR = os.getenv("RECORD_DIR")
+RECORD_SEGMENT_MB = float(os.getenv("RECORD_SEGMENT_MB", "64"))
+
+# Обслуживание базы: раз в MAINTENANCE_INTERVAL_HOURS часов (0 - выключено) пользователи,
+# неактивные дольше ARCHIVE_INACTIVE_DAYS дней, переносятся в архив, а файл базы сжимается
+MAINTENANCE_INTERVAL_HOURS = float(os.getenv("MAINTENANCE_INTERVAL_HOURS", "24"))
+ARCHIVE_INACTIVE_DAYS = int(os.getenv("ARCHIVE_INACTIVE_DAYS", "90"))
+
+# Если задан, /metrics отдается только с заголовком "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
 # Список запрещенных стран [cite: 396, 469]
 BANNED_COUNTRIES = ["RU"] 
 
-# Сценарии для разных стран [cite: 408, 677, 703]
+# Сценарии для разных стран [cite: 408, 677, 703] лежат в файле и перечитываются на лету:
+# командой /reload_scenarios или автоматически, когда меняется время изменения файла.
 # Фактические тексты должны быть предоставлены заказчиком [cite: 666]
-SCENARIOS = {
-    "CA": {
-        "lang": "en",
-        "currency": "CAD$",
-        "texts": {
-            "step1": "Step 1/4: Welcome! This service will guide you through the setup process. Please follow the instructions carefully.",
-            "step2": "Step 2/4: Great. Now, make sure you are in a supported region and have a stable connection.",
-            "step3": "Step 3/4: Almost there. Our platform offers various features. Remember to use it responsibly.",
-            "step4": "Step 4/4: All set! Click the button below to access the platform.",
-            "final_button": "Open Platform"
-        }
-    },
-    "ES": {
-        "lang": "es",
-        "currency": "€",
-        "texts": {
-            "step1": "Paso 1/4: ¡Bienvenido! Este servicio te guiará a través del proceso de configuración. Sigue las instrucciones.",
-            "step2": "Paso 2/4: Genial. Ahora, asegúrate de estar en una región compatible y tener una conexión estable.",
-            "step3": "Paso 3/4: Casi listo. Nuestra plataforma ofrece varias funciones. Recuerda usarla de manera responsable.",
-            "step4": "Paso 4/4: ¡Todo listo! Haz clic en el botón de abajo para acceder a la plataforma.",
-            "final_button": "Abrir Plataforma"
-        }
-    },
-    # Можно добавить другие страны по аналогии
-    "DEFAULT": {
-        "lang": "en",
-        "currency": "$",
-        "texts": {
-            "step1": "Step 1/4: Welcome! This service will guide you through the setup process. Please follow the instructions carefully.",
-            "step2": "Step 2/4: Great. Now, make sure you are in a supported region and have a stable connection.",
-            "step3": "Step 3/4: Almost there. Our platform offers various features. Remember to use it responsibly.",
-            "step4": "Step 4/4: All set! Click the button below to access the platform.",
-            "final_button": "Open Platform"
-        }
-    }
-}
\ No newline at end of file
+SCENARIOS_FILE = os.getenv("SCENARIOS_FILE", "data/scenarios.json")
+# Как часто проверять, не изменился ли файл сценариев, секунды (0 - не следить)
+SCENARIOS_CHECK_INTERVAL = float(os.getenv("SCENARIOS_CHECK_INTERVAL", "10"))
+
+# Апдейты, обработка которых заняла больше стольких секунд, пишутся в лог
+# с разбивкой по фазам (db, FSM, Bot API...); 0 - не замерять
+SLOW_UPDATE_SECONDS = float(os.getenv("SLOW_UPDATE_SECONDS", "1.0"))
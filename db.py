@@ -1,128 +1,858 @@
-# db.py
+import asyncio
+import json
+import logging
 import sqlite3
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import metrics
+import migrations
+import profiler
+
 DB_NAME = 'bot_database.db'
 
-def init_db():
-    """Инициализирует базу данных и создает таблицы, если их нет."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        
-        # Таблица пользователей [cite: 513]
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                country TEXT,
-                joined_at DATETIME,
-                completed_steps INTEGER DEFAULT 0,
-                ref_clicks INTEGER DEFAULT 0,
-                is_active BOOLEAN DEFAULT TRUE
+# Сколько потоков-читателей держать открытыми (у каждого свое соединение)
+READ_POOL_SIZE = 4
+# Сколько ждать снятия блокировки, прежде чем SQLite вернет "database is locked"
+BUSY_TIMEOUT_MS = 5000
+# Мелкие частые записи (новые пользователи, клики, деактивации) копятся и
+# коммитятся пачкой: не дольше GROUP_COMMIT_DELAY секунд и не больше GROUP_COMMIT_SIZE штук
+GROUP_COMMIT_DELAY = 0.005
+GROUP_COMMIT_SIZE = 256
+# Как часто сверять версию кеша партнерских ссылок с базой (другие воркеры могли ее изменить)
+LINKS_VERSION_CHECK_INTERVAL = 5.0
+
+# Один поток-писатель (SQLite все равно допускает только одного писателя)
+# и пул потоков-читателей. Соединения живут все время работы бота.
+_writer: ThreadPoolExecutor | None = None
+_readers: ThreadPoolExecutor | None = None
+_local = threading.local()
+# Записи, ждущие группового коммита: (func, args, future, время постановки)
+_group: list[tuple] = []
+_group_timer: asyncio.TimerHandle | None = None
+_group_flushes: set[asyncio.Task] = set()
+_connections: list[sqlite3.Connection] = []
+_connections_lock = threading.Lock()
+
+
+def _connect(readonly: bool) -> sqlite3.Connection:
+    """Открывает долгоживущее соединение для текущего потока пула."""
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
+    else:
+        # Действует только для новой базы (до первой таблицы); старую переводит maintenance
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        # В режиме WAL этого достаточно для сохранности данных и экономит fsync
+        conn.execute("PRAGMA synchronous = NORMAL")
+    with _connections_lock:
+        _connections.append(conn)
+    return conn
+
+
+def _thread_connection(readonly: bool) -> sqlite3.Connection:
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _local.conn = _connect(readonly)
+    return conn
+
+
+def _run_read(func, args):
+    return func(_thread_connection(readonly=True).cursor(), *args)
+
+
+def _run_write(func, args):
+    conn = _thread_connection(readonly=False)
+    # Контекстный менеджер соединения делает commit или rollback
+    with conn:
+        return func(conn.cursor(), *args)
+
+
+async def _read(func, *args):
+    """Выполняет func(cursor, *args) в пуле читателей, не блокируя event loop."""
+    return await _timed(_readers, _run_read, 'read', func, args)
+
+
+async def _write(func, *args):
+    """Выполняет func(cursor, *args) в потоке-писателе в одной транзакции."""
+    return await _timed(_writer, _run_write, 'write', func, args)
+
+
+async def _timed(executor, runner, kind, func, args):
+    # Имя запроса для метрик - имя sync-функции без подчеркивания (_get_stats -> get_stats)
+    query = func.__name__.lstrip('_')
+    started = time.perf_counter()
+    try:
+        with profiler.phase("db"):
+            return await asyncio.get_running_loop().run_in_executor(executor, runner, func, args)
+    except Exception:
+        metrics.DB_ERRORS.inc(kind, query)
+        raise
+    finally:
+        metrics.DB_DURATION.observe(time.perf_counter() - started, kind, query)
+
+
+def _run_group(cursor, ops):
+    # Без BEGIN каждый SAVEPOINT открыл бы свою транзакцию, а RELEASE ее бы закоммитил.
+    # Пачка - одна транзакция, ее коммитит _run_write
+    if not cursor.connection.in_transaction:
+        cursor.execute("BEGIN IMMEDIATE")
+    # Каждая запись в своем savepoint: ошибка одной не откатывает остальные записи пачки
+    outcomes = []
+    for func, args in ops:
+        cursor.execute("SAVEPOINT group_op")
+        try:
+            outcomes.append((True, func(cursor, *args)))
+        except Exception as e:
+            cursor.execute("ROLLBACK TO group_op")
+            outcomes.append((False, e))
+        cursor.execute("RELEASE group_op")
+    return outcomes
+
+
+async def _write_grouped(func, *args):
+    """Как _write, но func выполняется в общей транзакции с другими записями; результат - после коммита пачки."""
+    global _group_timer
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    _group.append((func, args, future, time.perf_counter()))
+    if len(_group) >= GROUP_COMMIT_SIZE:
+        _flush_group_soon()
+    elif _group_timer is None:
+        _group_timer = loop.call_later(GROUP_COMMIT_DELAY, _flush_group_soon)
+    with profiler.phase("db"):
+        return await future
+
+
+def _flush_group_soon():
+    global _group, _group_timer
+    if _group_timer is not None:
+        _group_timer.cancel()
+        _group_timer = None
+    if _group:
+        # Пачку забираем сразу: записи, пришедшие до старта задачи, пойдут уже в следующую
+        batch, _group = _group, []
+        task = asyncio.create_task(_flush_group(batch))
+        _group_flushes.add(task)
+        task.add_done_callback(_group_flushes.discard)
+
+
+async def _flush_group(batch):
+    metrics.DB_GROUP_SIZE.observe(len(batch))
+    try:
+        # Поток-писатель один, поэтому пачки коммитятся в том порядке, в каком собраны
+        outcomes = await _write(_run_group, [(func, args) for func, args, _, _ in batch])
+    except Exception as e:
+        outcomes = [(False, e)] * len(batch)
+    finished = time.perf_counter()
+    for (func, _, future, queued_at), (ok, result) in zip(batch, outcomes):
+        query = func.__name__.lstrip('_')
+        metrics.DB_DURATION.observe(finished - queued_at, 'write', query)
+        if not ok:
+            metrics.DB_ERRORS.inc('write', query)
+        if future.done():
+            continue
+        if ok:
+            future.set_result(result)
+        else:
+            future.set_exception(result)
+
+
+async def flush_writes():
+    """Коммитит накопленные записи, не дожидаясь таймера, и ждет завершения всех пачек."""
+    _flush_group_soon()
+    while _group_flushes:
+        await asyncio.gather(*_group_flushes, return_exceptions=True)
+
+
+async def init_db():
+    """Открывает пул соединений и применяет недостающие миграции схемы."""
+    global _writer, _readers
+    if _writer is None:
+        _writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        _readers = ThreadPoolExecutor(max_workers=READ_POOL_SIZE, thread_name_prefix='db-reader')
+    applied = await _write(migrations.migrate)
+    if applied:
+        logging.info(f"Database migrated to schema version {applied[-1]}")
+    await load_affiliate_links()
+
+
+async def close_db():
+    """Дожидается незавершенных запросов и закрывает все соединения."""
+    global _writer, _readers
+    if _writer is None:
+        return
+    await flush_writes()
+    writer, readers = _writer, _readers
+    _writer = _readers = None
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, writer.shutdown)
+    await loop.run_in_executor(None, readers.shutdown)
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+
+
+def _current_hour() -> int:
+    return int(time.time()) // 3600 * 3600
+
+
+def _bump_country_stats(cursor, country, active_users=0, clicks=0):
+    cursor.execute(
+        "INSERT INTO stats_countries (country, active_users, clicks) VALUES (?, ?, ?) "
+        "ON CONFLICT(country) DO UPDATE SET active_users = active_users + excluded.active_users, "
+        "clicks = clicks + excluded.clicks",
+        (country, active_users, clicks)
+    )
+
+
+def _bump_hourly_stats(cursor, country, new_users=0, clicks=0, deactivated=0):
+    cursor.execute(
+        "INSERT INTO stats_hourly (hour, country, new_users, clicks, deactivated) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(hour, country) DO UPDATE SET new_users = new_users + excluded.new_users, "
+        "clicks = clicks + excluded.clicks, deactivated = deactivated + excluded.deactivated",
+        (_current_hour(), country, new_users, clicks, deactivated)
+    )
+
+
+def _bump_archived_stats(cursor, bot_id, country, users=0, clicks=0):
+    cursor.execute(
+        "INSERT INTO stats_archived (bot_id, country, users, clicks) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(bot_id, country) DO UPDATE SET users = users + excluded.users, clicks = clicks + excluded.clicks",
+        (bot_id, country, users, clicks)
+    )
+
+
+def _restore_archived_user(cursor, user_id):
+    cursor.execute(
+        "DELETE FROM users_archive WHERE user_id = ? RETURNING joined_at, completed_steps, ref_clicks, bot_id, country",
+        (user_id,)
+    )
+    archived = cursor.fetchone()
+    if archived:
+        _bump_archived_stats(cursor, archived[3], archived[4], users=-1, clicks=-archived[2])
+    return archived
+
+
+def _add_or_update_user(cursor, user_id, username, country_code, bot_id):
+    cursor.execute("SELECT country, is_active FROM users WHERE user_id = ?", (user_id,))
+    previous = cursor.fetchone()
+    # Вернувшийся из архива пользователь сохраняет дату регистрации, шаги и клики
+    archived = _restore_archived_user(cursor, user_id) if previous is None else None
+    joined_at, completed_steps, ref_clicks = archived[:3] if archived else (datetime.now(), 0, 0)
+    cursor.execute(
+        "INSERT INTO users (user_id, username, country, joined_at, completed_steps, ref_clicks, bot_id) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET country = excluded.country, is_active = TRUE, deactivated_at = NULL, "
+        "bot_id = excluded.bot_id",
+        (user_id, username, country_code, joined_at, completed_steps, ref_clicks, bot_id)
+    )
+    if previous is None:
+        if archived is None:
+            _bump_hourly_stats(cursor, country_code, new_users=1)
+    elif previous[1]:
+        if previous[0] == country_code:
+            return
+        _bump_country_stats(cursor, previous[0], active_users=-1)
+    _bump_country_stats(cursor, country_code, active_users=1)
+
+async def add_or_update_user(user_id: int, username: str, country_code: str, bot_id: int = 0):
+    """
+    Добавляет нового пользователя или обновляет страну существующего.
+    bot_id - бот, через который пользователь прошел проверку последним: ему же достаются рассылки.
+    """
+    await _write_grouped(_add_or_update_user, user_id, username, country_code, bot_id)
+
+
+def _assign_legacy_bot(cursor, bot_id):
+    cursor.execute("UPDATE users SET bot_id = ? WHERE bot_id = 0", (bot_id,))
+    users = cursor.rowcount
+    cursor.execute("UPDATE broadcast_jobs SET bot_id = ? WHERE bot_id = 0", (bot_id,))
+    return users
+
+async def assign_legacy_bot(bot_id: int) -> int:
+    """Отдает основному боту пользователей и рассылки, созданные до появления нескольких ботов."""
+    return await _write(_assign_legacy_bot, bot_id)
+
+
+def _get_user_country(cursor, user_id):
+    cursor.execute("SELECT country FROM users WHERE user_id = ?", (user_id,))
+    result = cursor.fetchone()
+    return result[0] if result else None
+
+async def get_user_country(user_id: int) -> str | None:
+    """Получает код страны пользователя."""
+    return await _read(_get_user_country, user_id)
+
+
+# Партнерские ссылки меняются редко, поэтому держим их в памяти целиком.
+# Версия в таблице meta увеличивается при каждом изменении, и по ней
+# каждый воркер дешево замечает, что его копия устарела.
+# Ключ - (bot_id, страна); ссылки с bot_id = 0 общие для всех ботов.
+_links: dict[tuple[int, str], str] = {}
+_links_version = -1
+_links_checked_at = 0.0
+
+
+def _get_links_version(cursor):
+    cursor.execute("SELECT value FROM meta WHERE key = 'affiliate_links_version'")
+    return cursor.fetchone()[0]
+
+
+def _load_affiliate_links(cursor):
+    version = _get_links_version(cursor)
+    cursor.execute("SELECT bot_id, country, url FROM affiliate_links")
+    return version, {(bot_id, country): url for bot_id, country, url in cursor.fetchall()}
+
+async def load_affiliate_links():
+    """Загружает таблицу партнерских ссылок в память."""
+    global _links, _links_version, _links_checked_at
+    _links_version, _links = await _read(_load_affiliate_links)
+    _links_checked_at = time.monotonic()
+
+
+async def _refresh_links_if_stale():
+    global _links_checked_at
+    if time.monotonic() - _links_checked_at < LINKS_VERSION_CHECK_INTERVAL:
+        return
+    # Отмечаем проверку сразу, чтобы параллельные вызовы не ходили в базу
+    _links_checked_at = time.monotonic()
+    if await _read(_get_links_version) != _links_version:
+        await load_affiliate_links()
+
+async def get_affiliate_link(country_code: str, bot_id: int = 0) -> str:
+    """Получает партнерскую ссылку бота для страны."""
+    await _refresh_links_if_stale()
+    # Своя ссылка бота, затем общая; если для страны ссылки нет - ссылка по умолчанию (тоже сначала своя)
+    return (
+        _links.get((bot_id, country_code)) or _links.get((0, country_code))
+        or _links.get((bot_id, 'DEFAULT')) or _links[(0, 'DEFAULT')]
+    )
+
+
+def _update_affiliate_link(cursor, country_code, new_url, bot_id):
+    # Страна должна быть среди общих ссылок; ссылка бота добавляется или обновляется
+    cursor.execute(
+        "INSERT INTO affiliate_links (bot_id, country, url) "
+        "SELECT ?, country, ? FROM affiliate_links WHERE bot_id = 0 AND country = ? "
+        "ON CONFLICT(bot_id, country) DO UPDATE SET url = excluded.url",
+        (bot_id, new_url, country_code)
+    )
+    # Если такой страны нет в таблице, ничего не обновится
+    if cursor.rowcount == 0:
+        return None
+    cursor.execute("UPDATE meta SET value = value + 1 WHERE key = 'affiliate_links_version'")
+    return _get_links_version(cursor)
+
+async def update_affiliate_link(country_code: str, new_url: str, bot_id: int = 0) -> bool:
+    """Обновляет партнерскую ссылку бота (bot_id = 0 - общую). [cite: 488]"""
+    global _links_version
+    version = await _write(_update_affiliate_link, country_code, new_url, bot_id)
+    if version is None:
+        return False
+    # Write-through: обновляем свою копию, не перечитывая таблицу
+    if version == _links_version + 1:
+        _links[(bot_id, country_code)] = new_url
+        _links_version = version
+    else:
+        # Пока мы писали, ссылки менял кто-то еще
+        await load_affiliate_links()
+    return True
+
+
+def _log_final_click(cursor, user_id):
+    cursor.execute("UPDATE users SET ref_clicks = ref_clicks + 1 WHERE user_id = ? RETURNING country", (user_id,))
+    result = cursor.fetchone()
+    if result:
+        _bump_country_stats(cursor, result[0], clicks=1)
+        _bump_hourly_stats(cursor, result[0], clicks=1)
+
+async def log_final_click(user_id: int):
+    """Логирует нажатие на финальную кнопку. [cite: 447]"""
+    await _write_grouped(_log_final_click, user_id)
+
+
+def _get_stats(cursor, period_hours):
+    # Итоги по странам хранятся готовыми, запрос читает по строке на страну
+    cursor.execute("SELECT country, active_users, clicks FROM stats_countries ORDER BY country")
+    totals = cursor.fetchall()
+
+    # Счетчики за период складываются из почасовых корзин
+    cursor.execute(
+        "SELECT country, SUM(new_users), SUM(clicks), SUM(deactivated) FROM stats_hourly "
+        "WHERE hour >= ? GROUP BY country ORDER BY country",
+        (_current_hour() - (period_hours - 1) * 3600,)
+    )
+    period = cursor.fetchall()
+
+    cursor.execute("SELECT COALESCE(SUM(users), 0) FROM stats_archived")
+    archived_users = cursor.fetchone()[0]
+
+    return {
+        "total_users": sum(row[1] for row in totals),
+        "archived_users": archived_users,
+        "users_by_country": [(country, active) for country, active, _ in totals if active > 0],
+        "clicks_by_country": [(country, clicks) for country, _, clicks in totals if clicks > 0],
+        "total_clicks": sum(row[2] for row in totals),
+        "period_hours": period_hours,
+        "period_new_users": [(row[0], row[1]) for row in period if row[1]],
+        "period_clicks": [(row[0], row[2]) for row in period if row[2]],
+        "period_deactivated": sum(row[3] for row in period),
+    }
+
+async def get_stats(period_hours: int = 24):
+    """Собирает статистику для админа: итоги и счетчики за последние period_hours часов. [cite: 481]"""
+    return await _read(_get_stats, period_hours)
+
+
+def _log_funnel_events(cursor, events):
+    cursor.executemany(
+        "INSERT INTO funnel_events (user_id, step, country, scenario, ts) VALUES (?, ?, ?, ?, ?)",
+        events
+    )
+    cursor.executemany(
+        "UPDATE users SET completed_steps = ? WHERE user_id = ? AND completed_steps < ?",
+        [(step, user_id, step) for user_id, step, *_ in events]
+    )
+
+async def log_funnel_events(events: list[tuple]):
+    """Записывает пачку событий воронки [(user_id, step, country, scenario, ts), ...] одной транзакцией."""
+    if events:
+        await _write(_log_funnel_events, events)
+
+
+def _get_funnel_report(cursor, since, steps):
+    cursor.execute("SELECT country FROM stats_countries ORDER BY country")
+    countries = [row[0] for row in cursor.fetchall()]
+    report = {}
+    for country in countries:
+        users_per_step = []
+        step_times = []
+        for step in steps:
+            cursor.execute(
+                "SELECT COUNT(DISTINCT user_id) FROM funnel_events WHERE country = ? AND step = ? AND ts >= ?",
+                (country, step, since)
             )
-        ''')
-        
-        # Таблица партнерских ссылок [cite: 520]
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS affiliate_links (
-                country TEXT PRIMARY KEY,
-                url TEXT NOT NULL
+            users_per_step.append(cursor.fetchone()[0])
+        if not users_per_step[0]:
+            continue
+        for step in steps[:-1]:
+            # Время от первого показа шага до первого перехода на следующий
+            cursor.execute(
+                "SELECT MIN(e2.ts) - MIN(e.ts) FROM funnel_events e "
+                "JOIN funnel_events e2 ON e2.user_id = e.user_id AND e2.step = ? AND e2.ts >= e.ts "
+                "WHERE e.country = ? AND e.step = ? AND e.ts >= ? GROUP BY e.user_id",
+                (step + 1, country, step, since)
             )
-        ''')
-        
-        # Добавляем начальные ссылки, если их нет [cite: 524]
-        initial_links = [('CA', 'https://example.com/ca/ref123'), ('ES', 'https://example.com/es/ref456'), ('DEFAULT', 'https://example.com/default/ref789')]
-        cursor.executemany("INSERT OR IGNORE INTO affiliate_links (country, url) VALUES (?, ?)", initial_links)
-        
-        conn.commit()
-
-def add_or_update_user(user_id: int, username: str, country_code: str):
-    """Добавляет нового пользователя или обновляет страну существующего."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO users (user_id, username, country, joined_at) VALUES (?, ?, ?, ?) "
-            "ON CONFLICT(user_id) DO UPDATE SET country = excluded.country, is_active = TRUE",
-            (user_id, username, country_code, datetime.now())
-        )
-        conn.commit()
+            durations = [row[0] for row in cursor.fetchall()]
+            step_times.append(statistics.median(durations) if durations else None)
+        report[country] = {"users": users_per_step, "median_seconds": step_times}
+    return report
 
-def get_user_country(user_id: int) -> str | None:
-    """Получает код страны пользователя."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT country FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
+async def get_funnel_report(since: float, steps: list[int]) -> dict:
+    """
+    Отчет по воронке с момента since (unix time): для каждой страны число
+    пользователей, дошедших до каждого шага, и медианное время между шагами.
+    """
+    return await _read(_get_funnel_report, since, steps)
+
+
+# --- Выгрузки ---
+
+# Сколько строк читать из курсора за раз: память выгрузки не зависит от размера таблицы
+EXPORT_CHUNK_SIZE = 5000
+EXPORT_USER_COLUMNS = (
+    "user_id", "username", "country", "joined_at", "completed_steps", "ref_clicks", "is_active", "bot_id"
+)
+# Те же колонки из архива (там все неактивны)
+_EXPORT_ARCHIVE_COLUMNS = "user_id, username, country, joined_at, completed_steps, ref_clicks, FALSE, bot_id"
+EXPORT_CLICK_COLUMNS = ("user_id", "country", "scenario", "ts")
+
+
+def _stream(cursor, consume):
+    while rows := cursor.fetchmany(EXPORT_CHUNK_SIZE):
+        consume(rows)
+
+
+def _export_all_users(cursor, consume, since):
+    cursor.execute(
+        f"SELECT {', '.join(EXPORT_USER_COLUMNS)} FROM users WHERE (?1 IS NULL OR joined_at >= ?1) ORDER BY user_id",
+        (since,)
+    )
+    _stream(cursor, consume)
+    # Архивные пользователи выгружаются следом за остальными
+    cursor.execute(
+        f"SELECT {_EXPORT_ARCHIVE_COLUMNS} FROM users_archive WHERE (?1 IS NULL OR joined_at >= ?1) ORDER BY user_id",
+        (since,)
+    )
+    _stream(cursor, consume)
+
+
+def _export_country_users(cursor, consume, country, since):
+    # Отдельный запрос, чтобы фильтр по стране шел по индексу, а не проверялся для каждой строки
+    cursor.execute(
+        f"SELECT {', '.join(EXPORT_USER_COLUMNS)} FROM users "
+        "WHERE country = ?1 AND (?2 IS NULL OR joined_at >= ?2) ORDER BY user_id",
+        (country, since)
+    )
+    _stream(cursor, consume)
+    cursor.execute(
+        f"SELECT {_EXPORT_ARCHIVE_COLUMNS} FROM users_archive "
+        "WHERE country = ?1 AND (?2 IS NULL OR joined_at >= ?2) ORDER BY user_id",
+        (country, since)
+    )
+    _stream(cursor, consume)
 
-def get_affiliate_link(country_code: str) -> str:
-    """Получает партнерскую ссылку для страны."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT url FROM affiliate_links WHERE country = ?", (country_code,))
+
+def _export_users(cursor, consume, country, since):
+    if country is None:
+        _export_all_users(cursor, consume, since)
+    else:
+        _export_country_users(cursor, consume, country, since)
+
+async def export_users(consume, country: str | None = None, since: datetime | None = None):
+    """
+    Читает пользователей (EXPORT_USER_COLUMNS), затем архивных, порциями и передает каждую в consume(rows).
+    consume вызывается в потоке-читателе, а не в event loop.
+    """
+    await _read(_export_users, consume, country, since)
+
+
+def _export_clicks(cursor, consume, country, since, step):
+    cursor.execute(
+        f"SELECT {', '.join(EXPORT_CLICK_COLUMNS)} FROM funnel_events "
+        "WHERE step = ?3 AND (?1 IS NULL OR country = ?1) AND (?2 IS NULL OR ts >= ?2) ORDER BY ts",
+        (country, since, step)
+    )
+    _stream(cursor, consume)
+
+async def export_clicks(consume, step: int, country: str | None = None, since: float | None = None):
+    """Как export_users, но для событий воронки шага step (EXPORT_CLICK_COLUMNS)."""
+    await _read(_export_clicks, consume, country, since, step)
+
+
+# --- Состояния FSM ---
+
+def _load_fsm_session(cursor, key):
+    cursor.execute("SELECT state, data, updated_at FROM fsm_sessions WHERE key = ?", (key,))
+    return cursor.fetchone()
+
+async def load_fsm_session(key: str) -> tuple | None:
+    """Возвращает (state, data_json, updated_at) сессии FSM или None."""
+    return await _read(_load_fsm_session, key)
+
+
+def _get_fsm_session_keys(cursor):
+    cursor.execute("SELECT key FROM fsm_sessions")
+    return [row[0] for row in cursor.fetchall()]
+
+async def get_fsm_session_keys() -> list[str]:
+    """Возвращает ключи всех сохраненных сессий FSM."""
+    return await _read(_get_fsm_session_keys)
+
+
+def _save_fsm_sessions(cursor, upserts, deletes):
+    cursor.executemany(
+        "INSERT INTO fsm_sessions (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at",
+        upserts
+    )
+    cursor.executemany("DELETE FROM fsm_sessions WHERE key = ?", [(key,) for key in deletes])
+
+async def save_fsm_sessions(upserts: list[tuple], deletes: list[str]):
+    """Сохраняет измененные сессии [(key, state, data_json, updated_at), ...] и удаляет пустые."""
+    if upserts or deletes:
+        await _write(_save_fsm_sessions, upserts, deletes)
+
+
+def _delete_expired_fsm_sessions(cursor, before):
+    cursor.execute("DELETE FROM fsm_sessions WHERE updated_at < ? RETURNING key", (before,))
+    return [row[0] for row in cursor.fetchall()]
+
+async def delete_expired_fsm_sessions(before: float) -> list[str]:
+    """Удаляет сессии, не менявшиеся с момента before (unix time). Возвращает их ключи."""
+    return await _write(_delete_expired_fsm_sessions, before)
+
+
+def _deactivate_users(cursor, user_ids):
+    for user_id in user_ids:
+        cursor.execute(
+            "UPDATE users SET is_active = FALSE, deactivated_at = ? WHERE user_id = ? AND is_active = TRUE "
+            "RETURNING country",
+            (time.time(), user_id)
+        )
         result = cursor.fetchone()
+        # Счетчики меняем, только если пользователь действительно был активен
         if result:
-            return result[0]
-        # Если для страны нет ссылки, возвращаем ссылку по умолчанию
-        cursor.execute("SELECT url FROM affiliate_links WHERE country = 'DEFAULT'")
-        return cursor.fetchone()[0]
-
-def update_affiliate_link(country_code: str, new_url: str) -> bool:
-    """Обновляет партнерскую ссылку. [cite: 488]"""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        # Проверяем, существует ли такая страна в таблице
-        cursor.execute("SELECT 1 FROM affiliate_links WHERE country = ?", (country_code,))
-        if cursor.fetchone():
-            cursor.execute("UPDATE affiliate_links SET url = ? WHERE country = ?", (new_url, country_code))
-            conn.commit()
-            return True
-        return False
+            _bump_country_stats(cursor, result[0], active_users=-1)
+            _bump_hourly_stats(cursor, result[0], deactivated=1)
 
-def log_final_click(user_id: int):
-    """Логирует нажатие на финальную кнопку. [cite: 447]"""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET ref_clicks = ref_clicks + 1 WHERE user_id = ?", (user_id,))
-        conn.commit()
-
-def get_stats():
-    """Собирает статистику для админа. [cite: 481]"""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        
-        # Общее количество пользователей
-        cursor.execute("SELECT COUNT(user_id) FROM users WHERE is_active = TRUE")
-        total_users = cursor.fetchone()[0]
-        
-        # Распределение по странам
-        cursor.execute("SELECT country, COUNT(user_id) FROM users WHERE is_active = TRUE GROUP BY country")
-        users_by_country = cursor.fetchall()
-        
-        # Общее количество кликов и по странам
-        cursor.execute("SELECT u.country, SUM(u.ref_clicks) FROM users u JOIN affiliate_links al ON u.country = al.country WHERE u.ref_clicks > 0 GROUP BY u.country")
-        clicks_by_country = cursor.fetchall()
-        
-        cursor.execute("SELECT SUM(ref_clicks) FROM users")
-        total_clicks = cursor.fetchone()[0] or 0
-        
-        return {
-            "total_users": total_users,
-            "users_by_country": users_by_country,
-            "clicks_by_country": clicks_by_country,
-            "total_clicks": total_clicks
-        }
-
-def get_all_user_ids():
-    """Возвращает ID всех активных пользователей для рассылки. [cite: 494]"""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM users WHERE is_active = TRUE")
-        return [row[0] for row in cursor.fetchall()]
-
-def set_user_inactive(user_id: int):
+
+def _set_user_inactive(cursor, user_id):
+    _deactivate_users(cursor, [user_id])
+
+async def set_user_inactive(user_id: int):
     """Деактивирует пользователя, который заблокировал бота."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET is_active = FALSE WHERE user_id = ?", (user_id,))
-        conn.commit()
\ No newline at end of file
+    await _write_grouped(_set_user_inactive, user_id)
+
+
+# --- Задания рассылки ---
+
+# Статусы доставки получателю рассылки
+RECIPIENT_SENT = 1
+RECIPIENT_FAILED = 2
+RECIPIENT_BLOCKED = 3
+
+_BROADCAST_JOB_COLUMNS = (
+    "job_id", "admin_chat_id", "from_chat_id", "message_id", "progress_message_id",
+    "status", "total", "sent", "failed", "blocked", "created_at", "finished_at", "segment", "bot_id"
+)
+_BROADCAST_JOB_SELECT = f"SELECT {', '.join(_BROADCAST_JOB_COLUMNS)} FROM broadcast_jobs"
+
+# Фильтры сегмента рассылки; параметр со значением None не ограничивает выборку.
+# country - код страны, min_step - пройденный шаг воронки не ниже, joined_after -
+# дата регистрации не раньше ('YYYY-MM-DD'), clicked - переходил ли по ссылке (1/0)
+SEGMENT_FILTERS = ("country", "min_step", "joined_after", "clicked")
+_SEGMENT_CONDITIONS = (
+    "(:min_step IS NULL OR completed_steps >= :min_step) "
+    "AND (:joined_after IS NULL OR joined_at >= :joined_after) "
+    "AND (:clicked IS NULL OR (ref_clicks > 0) = :clicked)"
+)
+
+# Пропускаем тех, кому эта рассылка уже ушла (важно при продолжении после перезапуска)
+_SEGMENT_PAGE_TAIL = (
+    " AND NOT EXISTS (SELECT 1 FROM broadcast_recipients r WHERE r.job_id = :job_id AND r.user_id = users.user_id)"
+    " ORDER BY user_id LIMIT :limit"
+)
+
+
+def _segment_params(segment: dict, **extra) -> dict:
+    return {name: segment.get(name) for name in SEGMENT_FILTERS} | extra
+
+
+def _create_broadcast_job(cursor, bot_id, admin_chat_id, from_chat_id, message_id, segment):
+    cursor.execute(
+        "INSERT INTO broadcast_jobs (bot_id, admin_chat_id, from_chat_id, message_id, created_at, segment) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (bot_id, admin_chat_id, from_chat_id, message_id, datetime.now(), json.dumps(segment))
+    )
+    return cursor.lastrowid
+
+async def create_broadcast_job(bot_id: int, admin_chat_id: int, from_chat_id: int, message_id: int, segment: dict) -> int:
+    """
+    Создает задание рассылки бота bot_id по сегменту его активных пользователей (см. SEGMENT_FILTERS).
+    Получатели не копируются заранее: их перебирает iter_segment_users. Возвращает job_id.
+    """
+    return await _write(_create_broadcast_job, bot_id, admin_chat_id, from_chat_id, message_id, segment)
+
+
+# Два варианта запроса, чтобы с фильтром по стране работал индекс (bot_id, country, user_id),
+# а без него - частичный индекс активных пользователей бота (bot_id, user_id)
+def _count_segment_users(cursor, bot_id, segment):
+    if segment.get("country"):
+        cursor.execute(
+            "SELECT COUNT(*) FROM users WHERE is_active = TRUE AND bot_id = :bot_id AND country = :country AND "
+            + _SEGMENT_CONDITIONS,
+            _segment_params(segment, bot_id=bot_id)
+        )
+    else:
+        cursor.execute(
+            "SELECT COUNT(*) FROM users WHERE is_active = TRUE AND bot_id = :bot_id AND " + _SEGMENT_CONDITIONS,
+            _segment_params(segment, bot_id=bot_id)
+        )
+    return cursor.fetchone()[0]
+
+async def count_segment_users(bot_id: int, segment: dict) -> int:
+    """Число активных пользователей бота в сегменте."""
+    return await _read(_count_segment_users, bot_id, segment)
+
+
+def _get_segment_users_page(cursor, job_id, bot_id, segment, after_user_id, limit):
+    params = _segment_params(segment, job_id=job_id, bot_id=bot_id, after=after_user_id, limit=limit)
+    if segment.get("country"):
+        cursor.execute(
+            "SELECT user_id FROM users WHERE is_active = TRUE AND bot_id = :bot_id AND country = :country "
+            "AND user_id > :after AND " + _SEGMENT_CONDITIONS + _SEGMENT_PAGE_TAIL,
+            params
+        )
+    else:
+        cursor.execute(
+            "SELECT user_id FROM users WHERE is_active = TRUE AND bot_id = :bot_id AND user_id > :after AND "
+            + _SEGMENT_CONDITIONS + _SEGMENT_PAGE_TAIL,
+            params
+        )
+    return [row[0] for row in cursor.fetchall()]
+
+async def iter_segment_users(job_id: int, bot_id: int, segment: dict, batch_size: int = 500):
+    """
+    Асинхронно перебирает получателей рассылки job_id из сегмента пользователей бота bot_id
+    по возрастанию user_id (keyset-пагинация порциями по batch_size), пропуская уже обработанных.
+    """
+    after_user_id = 0
+    while user_ids := await _read(_get_segment_users_page, job_id, bot_id, segment, after_user_id, batch_size):
+        for user_id in user_ids:
+            yield user_id
+        after_user_id = user_ids[-1]
+
+
+def _set_broadcast_total(cursor, job_id, total):
+    cursor.execute("UPDATE broadcast_jobs SET total = ? WHERE job_id = ?", (total, job_id))
+
+async def set_broadcast_total(job_id: int, total: int):
+    """Запоминает размер аудитории рассылки."""
+    await _write(_set_broadcast_total, job_id, total)
+
+
+def _set_broadcast_progress_message(cursor, job_id, progress_message_id):
+    cursor.execute("UPDATE broadcast_jobs SET progress_message_id = ? WHERE job_id = ?", (progress_message_id, job_id))
+
+async def set_broadcast_progress_message(job_id: int, progress_message_id: int):
+    """Запоминает сообщение, в котором показывается прогресс рассылки."""
+    await _write(_set_broadcast_progress_message, job_id, progress_message_id)
+
+
+def _get_broadcast_job(cursor, job_id):
+    cursor.execute(f"{_BROADCAST_JOB_SELECT} WHERE job_id = ?", (job_id,))
+    row = cursor.fetchone()
+    return dict(zip(_BROADCAST_JOB_COLUMNS, row)) if row else None
+
+async def get_broadcast_job(job_id: int) -> dict | None:
+    """Возвращает задание рассылки со счетчиками прогресса."""
+    return await _read(_get_broadcast_job, job_id)
+
+
+def _get_unfinished_broadcast_jobs(cursor):
+    cursor.execute(f"{_BROADCAST_JOB_SELECT} WHERE status = 'running' ORDER BY job_id")
+    return [dict(zip(_BROADCAST_JOB_COLUMNS, row)) for row in cursor.fetchall()]
+
+async def get_unfinished_broadcast_jobs() -> list[dict]:
+    """Возвращает рассылки, прерванные перезапуском бота."""
+    return await _read(_get_unfinished_broadcast_jobs)
+
+
+def _save_broadcast_results(cursor, job_id, results):
+    cursor.executemany(
+        "INSERT OR REPLACE INTO broadcast_recipients (job_id, user_id, status) VALUES (?, ?, ?)",
+        [(job_id, user_id, status) for user_id, status in results]
+    )
+    statuses = [status for _, status in results]
+    cursor.execute(
+        "UPDATE broadcast_jobs SET sent = sent + ?, failed = failed + ?, blocked = blocked + ? WHERE job_id = ?",
+        (statuses.count(RECIPIENT_SENT), statuses.count(RECIPIENT_FAILED), statuses.count(RECIPIENT_BLOCKED), job_id)
+    )
+    # Заблокировавших бота деактивируем той же транзакцией
+    _deactivate_users(cursor, [user_id for user_id, status in results if status == RECIPIENT_BLOCKED])
+
+async def save_broadcast_results(job_id: int, results: list[tuple[int, int]]):
+    """Сохраняет пачку результатов отправки [(user_id, status), ...] одной транзакцией."""
+    if results:
+        await _write(_save_broadcast_results, job_id, results)
+
+
+def _finish_broadcast_job(cursor, job_id):
+    cursor.execute(
+        "UPDATE broadcast_jobs SET status = 'done', finished_at = ? WHERE job_id = ?",
+        (datetime.now(), job_id)
+    )
+
+async def finish_broadcast_job(job_id: int):
+    """Помечает рассылку завершенной."""
+    await _write(_finish_broadcast_job, job_id)
+
+
+# --- Обслуживание базы ---
+
+_ARCHIVE_COLUMNS = "user_id, username, country, joined_at, completed_steps, ref_clicks, bot_id, deactivated_at"
+# Значение PRAGMA auto_vacuum, при котором работает incremental_vacuum
+AUTO_VACUUM_INCREMENTAL = 2
+# Сколько страниц освобождать за одну транзакцию (по 4 КБ - 4 МБ)
+VACUUM_STEP_PAGES = 1024
+# Сколько строк индекса просматривает ANALYZE из PRAGMA optimize
+ANALYSIS_LIMIT = 400
+
+
+def _archive_inactive_users(cursor, before, limit):
+    cursor.execute(
+        f"INSERT OR REPLACE INTO users_archive ({_ARCHIVE_COLUMNS}, archived_at) "
+        f"SELECT {_ARCHIVE_COLUMNS}, ? FROM users WHERE is_active = FALSE AND deactivated_at < ? "
+        "ORDER BY deactivated_at LIMIT ? RETURNING user_id, bot_id, country, ref_clicks",
+        (time.time(), before, limit)
+    )
+    archived = cursor.fetchall()
+    cursor.executemany("DELETE FROM users WHERE user_id = ?", [(row[0],) for row in archived])
+    totals = {}
+    for _, bot_id, country, ref_clicks in archived:
+        users, clicks = totals.get((bot_id, country), (0, 0))
+        totals[(bot_id, country)] = (users + 1, clicks + ref_clicks)
+    for (bot_id, country), (users, clicks) in totals.items():
+        _bump_archived_stats(cursor, bot_id, country, users=users, clicks=clicks)
+    return len(archived)
+
+async def archive_inactive_users(before: float, limit: int) -> int:
+    """
+    Переносит в архив до limit пользователей, неактивных с момента before (unix time),
+    и добавляет их в итоги архива. Возвращает, сколько перенесено.
+    """
+    return await _write(_archive_inactive_users, before, limit)
+
+
+def _get_page_stats(cursor):
+    stats = {}
+    stats["auto_vacuum"] = cursor.execute("PRAGMA auto_vacuum").fetchone()[0]
+    stats["page_size"] = cursor.execute("PRAGMA page_size").fetchone()[0]
+    stats["page_count"] = cursor.execute("PRAGMA page_count").fetchone()[0]
+    stats["freelist_count"] = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+    return stats
+
+async def get_page_stats() -> dict:
+    """Режим auto_vacuum, размер страницы, число страниц файла и свободных среди них."""
+    return await _read(_get_page_stats)
+
+
+def _incremental_vacuum(cursor):
+    # Прагма освобождает по странице на каждый шаг выполнения; execute делает
+    # только первый шаг, executescript - все
+    cursor.executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})")
+    cursor.execute("PRAGMA freelist_count")
+    return cursor.fetchone()[0]
+
+async def incremental_vacuum() -> int:
+    """Возвращает системе до VACUUM_STEP_PAGES свободных страниц. Возвращает, сколько свободных осталось."""
+    return await _write(_incremental_vacuum)
+
+
+def _enable_incremental_vacuum(cursor):
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    # Режим меняется только полной пересборкой файла
+    cursor.execute("VACUUM")
+
+async def enable_incremental_vacuum():
+    """Переводит существующую базу на auto_vacuum = INCREMENTAL. Блокирует запись на все время VACUUM."""
+    await _write(_enable_incremental_vacuum)
+
+
+def _optimize(cursor):
+    # ANALYZE только для таблиц, где статистика устарела, и по выборке строк
+    cursor.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+    cursor.execute("PRAGMA optimize")
+
+async def optimize():
+    """Обновляет статистику планировщика запросов."""
+    await _write(_optimize)
+
+
+def _checkpoint(cursor):
+    # PASSIVE не ждет читателей: что не успело, перенесется следующим checkpoint
+    cursor.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    return cursor.fetchone()
+
+async def checkpoint():
+    """Переносит WAL в файл базы, чтобы освобожденные страницы ушли с диска."""
+    await _write(_checkpoint)
+
@@ -0,0 +1,124 @@
+"""
+Выгрузка пользователей и кликов в сжатый файл для админа.
+
+Строки читаются из базы порциями (db.EXPORT_CHUNK_SIZE) и сразу пишутся
+в .csv.gz или .ndjson.gz на диске, поэтому память не зависит от размера
+таблицы. Чтение, форматирование и сжатие идут в потоке-читателе db,
+event loop в это время обслуживает остальных пользователей. Одновременно
+выполняется только одна выгрузка.
+"""
+import asyncio
+import csv
+import gzip
+import json
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+import db
+import funnel
+
+DATASETS = ("users", "clicks")
+FORMATS = ("csv", "ndjson")
+# Куда складывать файлы выгрузки до отправки (по умолчанию - системный tmp)
+EXPORT_DIR = None
+# Telegram не принимает от бота документы больше 50 МБ
+MAX_FILE_SIZE = 50 * 1024 * 1024
+COMPRESS_LEVEL = 6
+
+_lock = asyncio.Lock()
+
+
+class ExportError(Exception):
+    """Выгрузку нельзя выполнить или отправить."""
+
+
+@dataclass(frozen=True, slots=True)
+class ExportResult:
+    path: str
+    filename: str
+    rows: int
+    size: int
+    seconds: float
+
+
+class _Writer:
+    """Пишет порции строк в gzip-файл в выбранном формате; вызывается из потока-читателя."""
+
+    def __init__(self, path: str, fmt: str, columns: tuple[str, ...]):
+        self._file = gzip.open(path, "wt", encoding="utf-8", newline="", compresslevel=COMPRESS_LEVEL)
+        self._columns = columns
+        self._fmt = fmt
+        self.rows = 0
+        self.cancelled = False
+        if fmt == "csv":
+            self._csv = csv.writer(self._file)
+            self._csv.writerow(columns)
+
+    def __call__(self, rows: list[tuple]):
+        if self.cancelled:
+            raise ExportError("Export cancelled")
+        if self._fmt == "csv":
+            self._csv.writerows(rows)
+        else:
+            self._file.writelines(
+                json.dumps(dict(zip(self._columns, row)), ensure_ascii=False, default=str) + "\n" for row in rows
+            )
+        self.rows += len(rows)
+
+    def close(self):
+        self._file.close()
+
+
+async def _run(writer: _Writer, read):
+    task = asyncio.ensure_future(read)
+    try:
+        await asyncio.shield(task)
+    except asyncio.CancelledError:
+        # Поток-читатель отменой не остановить: просим его прерваться на следующей
+        # порции и ждем, чтобы не закрыть файл у него из-под рук
+        writer.cancelled = True
+        await asyncio.gather(task, return_exceptions=True)
+        raise
+    finally:
+        writer.close()
+
+
+def is_running() -> bool:
+    return _lock.locked()
+
+
+async def export(dataset: str, fmt: str, country: str | None = None, days: int | None = None) -> ExportResult:
+    """
+    Выгружает dataset ("users" или "clicks") в файл формата fmt ("csv" или "ndjson").
+    Файл удаляет вызывающий, после отправки.
+    """
+    if dataset not in DATASETS or fmt not in FORMATS:
+        raise ExportError(f"Unknown export {dataset}/{fmt}")
+    if _lock.locked():
+        raise ExportError("Another export is already running")
+
+    async with _lock:
+        started = time.monotonic()
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        filename = f"{dataset}{'-' + country if country else ''}{f'-{days}d' if days else ''}-{stamp}.{fmt}.gz"
+        fd, path = tempfile.mkstemp(suffix=f".{fmt}.gz", prefix="export-", dir=EXPORT_DIR)
+        os.close(fd)
+        try:
+            if dataset == "users":
+                writer = _Writer(path, fmt, db.EXPORT_USER_COLUMNS)
+                since = datetime.now() - timedelta(days=days) if days else None
+                await _run(writer, db.export_users(writer, country, since))
+            else:
+                writer = _Writer(path, fmt, db.EXPORT_CLICK_COLUMNS)
+                since = time.time() - days * 24 * 60 * 60 if days else None
+                await _run(writer, db.export_clicks(writer, funnel.STEP_CLICKED, country, since))
+            size = os.path.getsize(path)
+            if size > MAX_FILE_SIZE:
+                raise ExportError(f"Export is {size // (1024 * 1024)} MB, Telegram accepts up to 50 MB; narrow the filter")
+        except BaseException:
+            os.remove(path)
+            raise
+        return ExportResult(path, filename, writer.rows, size, time.monotonic() - started)
@@ -0,0 +1,67 @@
+"""
+Журнал событий воронки.
+
+Хендлеры только добавляют событие в буфер в памяти, а фоновая задача раз в
+FLUSH_INTERVAL секунд (или когда набралось FLUSH_SIZE событий) записывает
+всю пачку в базу одной транзакцией.
+"""
+import asyncio
+import logging
+import time
+
+import db
+
+# Номера шагов: 1-4 - показан соответствующий шаг сценария, 5 - клик по финальной кнопке
+STEP_CLICKED = 5
+STEPS = [1, 2, 3, 4, STEP_CLICKED]
+
+FLUSH_INTERVAL = 1.0
+FLUSH_SIZE = 500
+
+_buffer: list[tuple] = []
+_flush_requested = asyncio.Event()
+_flusher: asyncio.Task | None = None
+
+
+def log_step(user_id: int, step: int, country: str, scenario: str):
+    """Отмечает, что пользователь дошел до шага. Не ждет записи в базу."""
+    _buffer.append((user_id, step, country, scenario, time.time()))
+    if len(_buffer) >= FLUSH_SIZE:
+        _flush_requested.set()
+
+
+async def flush():
+    """Записывает накопленные события в базу."""
+    global _buffer
+    batch, _buffer = _buffer, []
+    try:
+        await db.log_funnel_events(batch)
+    except Exception:
+        logging.exception(f"Could not write {len(batch)} funnel events")
+
+
+async def _run():
+    while True:
+        try:
+            await asyncio.wait_for(_flush_requested.wait(), timeout=FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _flush_requested.clear()
+        await flush()
+
+
+def start():
+    """Запускает фоновую запись событий."""
+    global _flusher
+    if _flusher is None:
+        _flusher = asyncio.create_task(_run())
+
+
+async def stop():
+    """Останавливает фоновую запись и сбрасывает остаток буфера."""
+    global _flusher
+    if _flusher is not None:
+        _flusher.cancel()
+        await asyncio.gather(_flusher, return_exceptions=True)
+        _flusher = None
+    await flush()
@@ -0,0 +1,201 @@
+"""
+Офлайн-определение страны по координатам, которые присылает Web App.
+
+Границы стран берутся из data/countries.json (Natural Earth 1:110m, public domain).
+При загрузке строится сетка из ячеек 1°x1°: ячейка, целиком лежащая внутри
+одной страны (или в океане), сразу хранит ответ, а для ячеек на границе
+хранится короткий список стран-кандидатов, которые проверяются point-in-polygon.
+
+В 1:110m нет мелких островов и государств: Балеарские и Канарские острова,
+остров Ванкувер не попадают ни в одну страну, а Сингапур и Монако - в соседние.
+Для таких мест есть data/places.json (GeoNames, CC BY 4.0): населенные пункты,
+которые границы 1:110m относят не к своей стране, и все пункты в NEAR_PLACE_KM
+от них. Если рядом с точкой есть такой пункт, страна берется по ближайшему,
+иначе - по границам.
+"""
+import json
+import math
+import os
+
+COUNTRIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'countries.json')
+PLACES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'places.json')
+
+# Размер ячейки сетки в градусах
+GRID_CELL_DEGREES = 1.0
+# В каком радиусе искать населенный пункт из PLACES_FILE, км
+NEAR_PLACE_KM = 25.0
+EARTH_RADIUS_KM = 6371.0
+
+
+class _Ring:
+    """Один контур полигона страны (внешний или дырка) со своим bbox."""
+    __slots__ = ('min_x', 'min_y', 'max_x', 'max_y', 'xs', 'ys')
+
+    def __init__(self, flat: list[float]):
+        self.xs = flat[0::2]
+        self.ys = flat[1::2]
+        self.min_x, self.max_x = min(self.xs), max(self.xs)
+        self.min_y, self.max_y = min(self.ys), max(self.ys)
+
+    def contains(self, x: float, y: float) -> bool:
+        if not (self.min_x <= x <= self.max_x and self.min_y <= y <= self.max_y):
+            return False
+        xs, ys = self.xs, self.ys
+        inside = False
+        j = len(xs) - 1
+        for i in range(len(xs)):
+            yi, yj = ys[i], ys[j]
+            if (yi > y) != (yj > y) and x < (xs[j] - xs[i]) * (y - yi) / (yj - yi) + xs[i]:
+                inside = not inside
+            j = i
+        return inside
+
+    def edges(self):
+        xs, ys = self.xs, self.ys
+        for i in range(len(xs)):
+            yield xs[i - 1], ys[i - 1], xs[i], ys[i]
+
+
+class CountryResolver:
+    """Сопоставляет координаты (lat, lon) с ISO-кодом страны без обращений к сети."""
+
+    def __init__(
+        self,
+        countries: dict[str, list[list[float]]],
+        places: dict[str, list[float]] | None = None,
+        cell: float = GRID_CELL_DEGREES,
+    ):
+        self._cell = cell
+        self._cols = math.ceil(360 / cell)
+        self._rows = math.ceil(180 / cell)
+        self._rings = {code: [_Ring(flat) for flat in rings] for code, rings in countries.items()}
+        # (col, row) -> код страны, если ячейка целиком внутри нее,
+        # или кортеж кандидатов, если через ячейку проходит граница
+        self._grid: dict[tuple[int, int], str | tuple[str, ...]] = {}
+        # (col, row) -> населенные пункты ячейки: (lat, lon, код страны)
+        self._places: dict[tuple[int, int], list[tuple[float, float, str]]] = {}
+        self._build()
+        for code, flat in (places or {}).items():
+            for lon, lat in zip(flat[0::2], flat[1::2]):
+                self._places.setdefault((self._col(lon), self._row(lat)), []).append((lat, lon, code))
+
+    @classmethod
+    def from_file(cls, path: str = COUNTRIES_FILE, places_path: str | None = PLACES_FILE) -> 'CountryResolver':
+        with open(path, encoding='utf-8') as f:
+            countries = json.load(f)['countries']
+        places = None
+        if places_path:
+            with open(places_path, encoding='utf-8') as f:
+                places = json.load(f)['places']
+        return cls(countries, places)
+
+    def _col(self, lon: float) -> int:
+        return min(int((lon + 180) // self._cell), self._cols - 1)
+
+    def _row(self, lat: float) -> int:
+        return min(int((lat + 90) // self._cell), self._rows - 1)
+
+    def _build(self):
+        boundary: set[tuple[int, int]] = set()
+        # Ребра, пересекающие горизонталь через центр каждого ряда ячеек
+        row_edges: dict[int, list[tuple[str, float, float, float, float]]] = {}
+        for code, rings in self._rings.items():
+            for ring in rings:
+                for x1, y1, x2, y2 in ring.edges():
+                    rows = range(self._row(min(y1, y2)), self._row(max(y1, y2)) + 1)
+                    cols = range(self._col(min(x1, x2)), self._col(max(x1, x2)) + 1)
+                    for row in rows:
+                        row_edges.setdefault(row, []).append((code, x1, y1, x2, y2))
+                        boundary.update((col, row) for col in cols)
+
+        # Ячейки без границ внутри: заливаем построчно по правилу even-odd
+        for row, edges in row_edges.items():
+            yc = (row + 0.5) * self._cell - 90
+            crossings: dict[str, list[float]] = {}
+            for code, x1, y1, x2, y2 in edges:
+                if (y1 > yc) != (y2 > yc):
+                    crossings.setdefault(code, []).append(x1 + (yc - y1) * (x2 - x1) / (y2 - y1))
+            for code, xs in crossings.items():
+                xs.sort()
+                for start, end in zip(xs[0::2], xs[1::2]):
+                    first = math.ceil((start + 180) / self._cell - 0.5)
+                    last = math.floor((end + 180) / self._cell - 0.5)
+                    for col in range(first, last + 1):
+                        if (col, row) not in boundary:
+                            self._grid[(col, row)] = code
+
+        # Граничные ячейки: кандидаты — страны, чей bbox задевает ячейку
+        candidates: dict[tuple[int, int], list[str]] = {}
+        for code, rings in self._rings.items():
+            cells = set()
+            for ring in rings:
+                for row in range(self._row(ring.min_y), self._row(ring.max_y) + 1):
+                    for col in range(self._col(ring.min_x), self._col(ring.max_x) + 1):
+                        if (col, row) in boundary:
+                            cells.add((col, row))
+            for cell in cells:
+                candidates.setdefault(cell, []).append(code)
+        for cell, codes in candidates.items():
+            self._grid[cell] = tuple(codes)
+
+    def contains(self, code: str, lat: float, lon: float) -> bool:
+        # Дырки в полигоне учитываются четностью: точка внутри нечетного числа контуров
+        inside = False
+        for ring in self._rings[code]:
+            if ring.contains(lon, lat):
+                inside = not inside
+        return inside
+
+    def nearest_place(self, lat: float, lon: float, max_km: float = NEAR_PLACE_KM) -> str | None:
+        """Страна ближайшего населенного пункта из places не дальше max_km или None."""
+        if not self._places:
+            return None
+        cos_lat = math.cos(math.radians(lat))
+        span_lat = math.degrees(max_km / EARTH_RADIUS_KM)
+        # У полюсов градус долготы короткий: смотрим всю широтную полосу
+        span_lon = math.degrees(max_km / EARTH_RADIUS_KM / cos_lat) if cos_lat > 0.01 else 180
+        cols = range(self._col(max(lon - span_lon, -180)), self._col(min(lon + span_lon, 180)) + 1)
+        if lon - span_lon < -180 or lon + span_lon > 180:
+            cols = range(self._cols)
+        best, best_km = None, max_km
+        for row in range(self._row(max(lat - span_lat, -90)), self._row(min(lat + span_lat, 90)) + 1):
+            for col in cols:
+                for place_lat, place_lon, code in self._places.get((col, row), ()):
+                    # Равнопромежуточная проекция: на десятках километров ошибка меньше процента
+                    dx = math.radians((place_lon - lon + 180) % 360 - 180) * math.cos(math.radians((lat + place_lat) / 2))
+                    km = EARTH_RADIUS_KM * math.hypot(dx, math.radians(place_lat - lat))
+                    if km <= best_km:
+                        best, best_km = code, km
+        return best
+
+    def resolve(self, lat: float, lon: float) -> str | None:
+        """Возвращает ISO 3166-1 alpha-2 код страны или None (океан, неизвестная территория)."""
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            return None
+        # Рядом с мелкими островами и государствами границы 1:110m врут
+        code = self.nearest_place(lat, lon)
+        if code is not None:
+            return code
+        entry = self._grid.get((self._col(lon), self._row(lat)))
+        if entry is None or isinstance(entry, str):
+            return entry
+        for code in entry:
+            if self.contains(code, lat, lon):
+                return code
+        return None
+
+
+_resolver: CountryResolver | None = None
+
+
+def get_resolver() -> CountryResolver:
+    """Возвращает общий экземпляр резолвера, загружая данные при первом обращении."""
+    global _resolver
+    if _resolver is None:
+        _resolver = CountryResolver.from_file()
+    return _resolver
+
+
+def resolve_country(lat: float, lon: float) -> str | None:
+    """Определяет страну по координатам."""
+    return get_resolver().resolve(lat, lon)
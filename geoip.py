@@ -0,0 +1,192 @@
+"""
+Асинхронный клиент geo-IP (ipinfo.io) для пути, где известен IP клиента.
+IP обязателен: без него провайдер определил бы страну по IP самого бота.
+Сейчас такого пути нет (Web App присылает координаты, а не IP, и страна
+определяется по ним в geo.py), поэтому клиент нигде не вызывается.
+
+Все запросы идут через одну aiohttp-сессию с keep-alive и жесткими таймаутами.
+Ответы кешируются (TTL + LRU) по IP и по user_id, одновременные запросы
+одного ключа склеиваются в один, а при падении провайдера circuit breaker
+перестает ходить в сеть и сразу возвращает ошибку.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+from config import IPINFO_TOKEN
+import metrics
+import profiler
+
+IPINFO_URL = "https://ipinfo.io/{ip}/json"
+
+# Таймауты на запрос к провайдеру, секунды
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=2.0, connect=1.0)
+# Сколько держать ответ в кеше и сколько ключей помнить
+CACHE_TTL = 6 * 60 * 60
+CACHE_MAX_SIZE = 50_000
+# Сколько ошибок подряд открывают breaker и на сколько секунд
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30.0
+
+
+class GeoIPError(Exception):
+    """Провайдер недоступен или вернул некорректный ответ."""
+
+
+class TTLCache:
+    """LRU-кеш с ограниченным временем жизни записей."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self._ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CircuitBreaker:
+    """
+    После серии ошибок перестает пропускать запросы на reset_timeout секунд.
+    Затем пропускает один пробный запрос (half-open): его успех закрывает
+    breaker, ошибка снова открывает его на reset_timeout.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: float | None = None
+        # Когда ушел пробный запрос (None - пробы нет)
+        self._probe_started: float | None = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None and time.monotonic() - self._opened_at < self._reset_timeout
+
+    def allow(self) -> bool:
+        if self._opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self._opened_at < self._reset_timeout:
+            return False
+        # Проба, которая так и не закончилась (например, ее отменили), не держит breaker вечно
+        if self._probe_started is not None and now - self._probe_started < self._reset_timeout:
+            return False
+        self._probe_started = now
+        return True
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+        self._probe_started = None
+
+    def record_failure(self):
+        self._failures += 1
+        if self._probe_started is not None or self._failures >= self._failure_threshold:
+            self._opened_at = time.monotonic()
+            self._probe_started = None
+
+
+class GeoIPClient:
+    """Клиент ipinfo.io с кешем, склейкой запросов и circuit breaker."""
+
+    def __init__(self, token: str | None = IPINFO_TOKEN):
+        self._token = token
+        self._session: aiohttp.ClientSession | None = None
+        self._cache = TTLCache(CACHE_MAX_SIZE, CACHE_TTL)
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=100, keepalive_timeout=60, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=REQUEST_TIMEOUT)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def lookup(self, ip: str, user_id: int | None = None) -> str | None:
+        """
+        Возвращает код страны для IP клиента.
+        Бросает GeoIPError, если провайдер недоступен.
+        """
+        if not ip:
+            raise ValueError("Client IP is required: without it ipinfo returns the bot server's own country")
+        for key in (('user', user_id) if user_id is not None else None, ('ip', ip)):
+            if key is not None and (country := self._cache.get(key)) is not None:
+                return country
+
+        future = self._inflight.get(ip)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(ip))
+            self._inflight[ip] = future
+            future.add_done_callback(lambda _: self._inflight.pop(ip, None))
+        # shield: отмена одного ожидающего не должна отменять общий запрос
+        with profiler.phase("geoip"):
+            country = await asyncio.shield(future)
+
+        if country:
+            if user_id is not None:
+                self._cache.set(('user', user_id), country)
+            self._cache.set(('ip', ip), country)
+        return country
+
+    async def _fetch(self, ip: str) -> str | None:
+        if not self.breaker.allow():
+            raise GeoIPError("geo-IP provider is unavailable (circuit open)")
+        url = IPINFO_URL.format(ip=ip)
+        started = time.perf_counter()
+        try:
+            async with self._get_session().get(url, params={'token': self._token} if self._token else None) as response:
+                response.raise_for_status()
+                data = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            metrics.GEOIP_ERRORS.inc()
+            self.breaker.record_failure()
+            logging.error(f"IPInfo API error: {e}")
+            raise GeoIPError(str(e)) from e
+        finally:
+            metrics.GEOIP_DURATION.observe(time.perf_counter() - started)
+        self.breaker.record_success()
+        return data.get("country")
+
+
+_client: GeoIPClient | None = None
+
+
+def get_client() -> GeoIPClient:
+    """Общий клиент для всего процесса."""
+    global _client
+    if _client is None:
+        _client = GeoIPClient()
+    return _client
+
+
+async def close():
+    """Закрывает HTTP-сессию клиента."""
+    if _client is not None:
+        await _client.close()
@@ -1,28 +1,37 @@
 # handlers/admin.py
-import asyncio
+import os
+import time
 from aiogram import Router, F, Bot
-from aiogram.types import Message, CallbackQuery
-from aiogram.filters import Command, Filter
+from aiogram.types import Message, CallbackQuery, FSInputFile, BufferedInputFile
+from aiogram.filters import Command, CommandObject, Filter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.exceptions import TelegramBadRequest
 
+import broadcast
 import db
-from config import ADMIN_IDS
+import export
+import bots
+import funnel
+import maintenance
+import profiler
+import scenarios
 import keyboards as kb
 
 router = Router()
 
-# --- Фильтр для проверки, является ли пользователь админом ---
+# --- Фильтр для проверки, является ли пользователь админом этого бота ---
 class AdminFilter(Filter):
-    async def __call__(self, message: Message) -> bool:
-        return message.from_user.id in ADMIN_IDS
+    async def __call__(self, message: Message, bot: Bot) -> bool:
+        return bots.is_admin(bot.id, message.from_user.id)
 
 # --- Состояния для админских действий ---
 class AdminStates(StatesGroup):
     set_link_country = State()
     set_link_url = State()
+    broadcast_segment = State()
     broadcast_message = State()
+    export_filter = State()
 
 # --- Основные команды админа ---
 
@@ -33,24 +42,152 @@ async def cmd_admin_panel(message: Message):
     """
     await message.answer("Админ-панель:", reply_markup=kb.get_admin_keyboard())
 
-@router.callback_query(F.data == "admin_stats", AdminFilter())
-async def show_stats(callback: CallbackQuery):
+@router.message(Command("reload_scenarios"), AdminFilter())
+async def cmd_reload_scenarios(message: Message):
     """
-    Показывает статистику.
+    Перечитывает файл сценариев. Пользователи, уже идущие по воронке, остаются на своей версии.
     """
-    stats = db.get_stats()
-    
+    try:
+        registry, changed = scenarios.reload()
+    except (OSError, scenarios.ScenarioError) as e:
+        await message.answer(f"❌ Сценарии не обновлены, действует версия {scenarios.current().version}:\n{e}")
+        return
+    status = "✅ Загружена новая версия" if changed else "Файл не изменился, версия"
+    await message.answer(f"{status} {registry.version}: {', '.join(registry.scenarios)}")
+
+# Длительность профилирования по умолчанию, секунды
+PROFILE_DEFAULT_SECONDS = 10
+
+@router.message(Command("profile"), AdminFilter())
+async def cmd_profile(message: Message, command: CommandObject):
+    """
+    Снимает профиль живого бота: /profile [секунды]. Присылает файл collapsed stacks.
+    """
+    try:
+        seconds = float(command.args) if command.args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await message.answer("Укажите длительность в секундах, например: /profile 30")
+        return
+    if not 0 < seconds <= profiler.MAX_PROFILE_SECONDS:
+        await message.answer(f"Длительность - от 0 до {profiler.MAX_PROFILE_SECONDS} секунд.")
+        return
+    if profiler.is_running():
+        await message.answer("Профайлер уже запущен, дождитесь результата.")
+        return
+
+    status = await message.answer(f"⏳ Профилирую {seconds:g} с...")
+    try:
+        result = await profiler.profile(seconds)
+    except profiler.ProfilerBusy:
+        await status.edit_text("Профайлер уже запущен, дождитесь результата.")
+        return
+    filename = f"profile-{time.strftime('%Y%m%d-%H%M%S')}.collapsed.txt"
+    await message.answer_document(
+        BufferedInputFile(result.collapsed().encode(), filename=filename),
+        caption=f"{result.samples} сэмплов, {len(result.stacks)} стеков. Открыть: speedscope.app или flamegraph.pl",
+    )
+    await status.delete()
+
+@router.message(Command("db_maintenance"), AdminFilter())
+async def cmd_db_maintenance(message: Message):
+    """
+    Запускает обслуживание базы вне расписания: архив неактивных, vacuum, optimize.
+    """
+    if maintenance.is_running():
+        await message.answer("Обслуживание базы уже идет, дождитесь результата.")
+        return
+    status = await message.answer("⏳ Обслуживание базы...")
+    report = await maintenance.run()
+    await status.edit_text(
+        f"✅ Обслуживание базы завершено\n"
+        f"В архив: {report.archived_users} польз. за {report.archive_seconds:.1f} с\n"
+        f"Освобождено: {report.reclaimed_bytes / 1024 / 1024:.1f} МБ за {report.vacuum_seconds:.1f} с\n"
+        f"Статистика запросов: {report.optimize_seconds:.1f} с\n"
+        f"Размер базы: {report.size_before / 1024 / 1024:.1f} → {report.size_after / 1024 / 1024:.1f} МБ"
+    )
+
+# Подписи периодов статистики (в часах)
+STATS_PERIODS = {24: "24 часа", 168: "7 дней", 720: "30 дней"}
+
+def format_stats(stats: dict) -> str:
     users_by_country_str = "\n".join([f"  - {country}: {count}" for country, count in stats['users_by_country']])
     clicks_by_country_str = "\n".join([f"  - {country}: {count}" for country, count in stats['clicks_by_country']])
-    
-    stats_text = (
+    new_users_str = "\n".join([f"  - {country}: {count}" for country, count in stats['period_new_users']])
+    period_clicks_str = "\n".join([f"  - {country}: {count}" for country, count in stats['period_clicks']])
+    period = STATS_PERIODS[stats['period_hours']]
+
+    return (
         f"📊 **Статистика Бота**\n\n"
-        f"👤 **Всего пользователей:** {stats['total_users']}\n\n"
+        f"👤 **Всего пользователей:** {stats['total_users']}\n"
+        f"🗄 **В архиве (давно неактивны):** {stats['archived_users']}\n\n"
         f"🌍 **Пользователей по странам:**\n{users_by_country_str or 'Нет данных'}\n\n"
         f"🖱️ **Всего переходов по ссылкам:** {stats['total_clicks']}\n\n"
-        f"📈 **Переходов по странам:**\n{clicks_by_country_str or 'Нет данных'}"
+        f"📈 **Переходов по странам:**\n{clicks_by_country_str or 'Нет данных'}\n\n"
+        f"🕒 **За {period}:**\n"
+        f"Новых пользователей:\n{new_users_str or '  Нет данных'}\n"
+        f"Переходов:\n{period_clicks_str or '  Нет данных'}\n"
+        f"Заблокировали бота: {stats['period_deactivated']}"
     )
-    await callback.message.answer(stats_text, parse_mode="Markdown")
+
+@router.callback_query(F.data == "admin_stats", AdminFilter())
+async def show_stats(callback: CallbackQuery):
+    """
+    Показывает статистику.
+    """
+    stats = await db.get_stats()
+    await callback.message.answer(format_stats(stats), parse_mode="Markdown", reply_markup=kb.get_stats_period_keyboard())
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("admin_stats:"), AdminFilter())
+async def show_stats_period(callback: CallbackQuery):
+    """
+    Переключает период статистики в уже отправленном сообщении.
+    """
+    period_hours = int(callback.data.split(":")[1])
+    if period_hours not in STATS_PERIODS:
+        await callback.answer()
+        return
+    stats = await db.get_stats(period_hours)
+    try:
+        await callback.message.edit_text(format_stats(stats), parse_mode="Markdown", reply_markup=kb.get_stats_period_keyboard())
+    except TelegramBadRequest:
+        # Статистика не изменилась с прошлого нажатия
+        pass
+    await callback.answer()
+
+# Отчет по воронке строится за последние FUNNEL_REPORT_DAYS дней
+FUNNEL_REPORT_DAYS = 7
+
+def format_duration(seconds: float | None) -> str:
+    if seconds is None:
+        return "—"
+    if seconds < 60:
+        return f"{seconds:.0f} с"
+    return f"{seconds / 60:.1f} мин"
+
+@router.callback_query(F.data == "admin_funnel", AdminFilter())
+async def show_funnel(callback: CallbackQuery):
+    """
+    Показывает конверсию между шагами воронки и медианное время на шаге по странам.
+    """
+    since = time.time() - FUNNEL_REPORT_DAYS * 24 * 60 * 60
+    report = await db.get_funnel_report(since, funnel.STEPS)
+
+    lines = [f"📉 Воронка за {FUNNEL_REPORT_DAYS} дней\n"]
+    for country, data in report.items():
+        users = data['users']
+        lines.append(f"🌍 {country}: начали {users[0]}, перешли по ссылке {users[-1]}")
+        for i, seconds in enumerate(data['median_seconds']):
+            conversion = users[i + 1] * 100 / users[i] if users[i] else 0
+            name = "клик" if funnel.STEPS[i + 1] == funnel.STEP_CLICKED else f"шаг {funnel.STEPS[i + 1]}"
+            lines.append(
+                f"  шаг {funnel.STEPS[i]} → {name}: {users[i + 1]} ({conversion:.0f}%), "
+                f"медиана {format_duration(seconds)}"
+            )
+    if len(lines) == 1:
+        lines.append("Нет данных")
+
+    await callback.message.answer("\n".join(lines))
     await callback.answer()
 
 # --- Логика изменения ссылки ---
@@ -69,12 +206,12 @@ async def set_link_country(message: Message, state: FSMContext):
     await state.set_state(AdminStates.set_link_url)
 
 @router.message(AdminStates.set_link_url, AdminFilter())
-async def set_link_url(message: Message, state: FSMContext):
+async def set_link_url(message: Message, state: FSMContext, bot: Bot):
     new_url = message.text
     data = await state.get_data()
     country_code = data['country_code']
     
-    if db.update_affiliate_link(country_code, new_url):
+    if await db.update_affiliate_link(country_code, new_url, bot.id):
         await message.answer(f"✅ Ссылка для страны {country_code} успешно обновлена.")
     else:
         await message.answer(f"❌ Ошибка: страна {country_code} не найдена в базе. Используйте CA, ES или DEFAULT.")
@@ -85,37 +222,100 @@ async def set_link_url(message: Message, state: FSMContext):
 
 @router.callback_query(F.data == "admin_broadcast", AdminFilter())
 async def broadcast_start(callback: CallbackQuery, state: FSMContext):
-    await callback.message.answer("Введите сообщение для рассылки всем пользователям:")
-    await state.set_state(AdminStates.broadcast_message)
+    await callback.message.answer(
+        "Кому отправить? Укажите фильтры через пробел:\n"
+        "  • код страны, например CA\n"
+        "  • step3 - дошли до шага 3 воронки\n"
+        "  • 2024-05-01 - пришли не раньше этой даты\n"
+        "  • clicked / noclick - переходили или нет по ссылке\n"
+        "Например: «CA step3 noclick». Отправьте «-», чтобы разослать всем активным."
+    )
+    await state.set_state(AdminStates.broadcast_segment)
     await callback.answer()
 
+@router.message(AdminStates.broadcast_segment, AdminFilter())
+async def broadcast_segment(message: Message, state: FSMContext, bot: Bot):
+    try:
+        segment = broadcast.parse_segment(message.text or "")
+    except ValueError:
+        await message.answer("Не понял фильтр. Пример: «CA step3 noclick» или «-».")
+        return
+    total = await db.count_segment_users(bot.id, segment)
+    await state.update_data(broadcast_segment=segment)
+    await state.set_state(AdminStates.broadcast_message)
+    await message.answer(
+        f"Получатели: {broadcast.describe_segment(segment)} ({total}).\n"
+        f"Введите сообщение для рассылки:"
+    )
+
 @router.message(AdminStates.broadcast_message, AdminFilter())
 async def process_broadcast(message: Message, state: FSMContext, bot: Bot):
+    data = await state.get_data()
     await state.clear()
-    user_ids = db.get_all_user_ids()
-    
-    success_count = 0
-    error_count = 0
-    
-    await message.answer(f"Начинаю рассылку для {len(user_ids)} пользователей...")
-    
-    for user_id in user_ids:
-        try:
-            # Копируем сообщение, чтобы сохранить форматирование, фото и т.д.
-            await bot.copy_message(chat_id=user_id, from_chat_id=message.chat.id, message_id=message.message_id)
-            success_count += 1
-        except TelegramBadRequest as e:
-            if "bot was blocked by the user" in e.message:
-                db.set_user_inactive(user_id) # Деактивируем пользователя
-                error_count += 1
-            else:
-                error_count += 1
-        except Exception:
-            error_count += 1
-        await asyncio.sleep(0.1) # Небольшая задержка, чтобы не превышать лимиты Telegram
-        
-    await message.answer(
-        f"✅ Рассылка завершена!\n"
-        f"Успешно отправлено: {success_count}\n"
-        f"Ошибок (включая заблокировавших): {error_count}"
-    )
\ No newline at end of file
+    # Рассылка идет в фоне, прогресс показывается в отдельном сообщении
+    await broadcast.start_broadcast(
+        bot, message.chat.id, message.chat.id, message.message_id, data.get('broadcast_segment')
+    )
+
+@router.callback_query(F.data.startswith("broadcast_progress:"), AdminFilter())
+async def refresh_broadcast_progress(callback: CallbackQuery, bot: Bot):
+    job_id = int(callback.data.split(":")[1])
+    await broadcast.update_progress_message(bot, job_id)
+    await callback.answer()
+
+# --- Выгрузка данных ---
+
+@router.callback_query(F.data == "admin_export", AdminFilter())
+async def export_start(callback: CallbackQuery):
+    await callback.message.answer("Что выгрузить?", reply_markup=kb.get_export_keyboard())
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("admin_export:"), AdminFilter())
+async def export_choose(callback: CallbackQuery, state: FSMContext):
+    _, dataset, fmt = callback.data.split(":")
+    await state.update_data(export_dataset=dataset, export_format=fmt)
+    await state.set_state(AdminStates.export_filter)
+    await callback.message.answer(
+        "Введите фильтр: код страны и/или число дней, например «CA 30», «CA» или «7». "
+        "Отправьте «-», чтобы выгрузить все."
+    )
+    await callback.answer()
+
+def parse_export_filter(text: str) -> tuple[str | None, int | None]:
+    """Разбирает фильтр выгрузки "CA 30" -> ("CA", 30); бросает ValueError, если не получилось."""
+    country = days = None
+    for token in text.split():
+        if token == "-":
+            continue
+        if token.isdigit() and int(token) > 0:
+            days = int(token)
+        elif len(token) == 2 and token.isalpha():
+            country = token.upper()
+        else:
+            raise ValueError(token)
+    return country, days
+
+@router.message(AdminStates.export_filter, AdminFilter())
+async def export_run(message: Message, state: FSMContext):
+    try:
+        country, days = parse_export_filter(message.text or "")
+    except ValueError:
+        await message.answer("Не понял фильтр. Пример: «CA 30», «7» или «-».")
+        return
+    data = await state.get_data()
+    await state.clear()
+
+    status = await message.answer("⏳ Готовлю выгрузку...")
+    try:
+        result = await export.export(data['export_dataset'], data['export_format'], country, days)
+    except export.ExportError as e:
+        await status.edit_text(f"❌ Выгрузка не удалась: {e}")
+        return
+    try:
+        await message.answer_document(
+            FSInputFile(result.path, filename=result.filename),
+            caption=f"{result.rows} строк, {result.size / 1024 / 1024:.1f} МБ, {result.seconds:.1f} с",
+        )
+    finally:
+        os.remove(result.path)
+    await status.delete()
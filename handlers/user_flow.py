@@ -1,14 +1,16 @@
 # handlers/user_flow.py
 import logging
-import requests
 from aiogram import Router, F, Bot
 from aiogram.types import Message, CallbackQuery, WebAppInfo
-from aiogram.filters import CommandStart
+from aiogram.filters import CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from config import BANNED_COUNTRIES, IPINFO_TOKEN, SCENARIOS
+from config import BANNED_COUNTRIES
 import db
+import funnel
+import geo
+import scenarios
 import keyboards as kb
 
 # Создаем роутер для этого файла
@@ -49,36 +51,24 @@ async def process_webapp_data(message: Message, state: FSMContext, bot: Bot):
     # Данные приходят как 'lat:xx,lon:yy'
     try:
         lat, lon = web_app_data.split(',')
-        lat = lat.split(':')[1]
-        lon = lon.split(':')[1]
+        lat = float(lat.split(':')[1])
+        lon = float(lon.split(':')[1])
     except (IndexError, ValueError) as e:
         logging.error(f"Error parsing web_app_data: {e}")
         await message.answer("Invalid location data format. Please try again.")
         return
 
-    # Определяем страну по IP, используя ipinfo.io
-    # Примечание: для большей точности лучше использовать координаты, 
-    # но ipinfo бесплатен для IP и прост в использовании.
-    # Мы получим IP пользователя из запроса к Telegram API (если он доступен)
-    # или используем IP, с которого пришел запрос на наш веб-сервер.
-    # Для простоты, мы используем сторонний сервис, который по координатам даст нам IP/страну.
-    # Однако, ipinfo.io не работает напрямую с lat/lon в бесплатных планах.
-    # Поэтому мы используем IP пользователя. В реальном проекте, Web App передал бы IP.
-    # Для демонстрации, мы будем использовать API ipinfo для определения по IP.
-    # **ВАЖНО**: Этот метод не идеален, так как IP может быть от VPN.
-    # Запрос на ipinfo.io
-    try:
-        response = requests.get(f'https://ipinfo.io/json?token={IPINFO_TOKEN}')
-        response.raise_for_status()
-        data = response.json()
-        country_code = data.get("country")
-    except requests.RequestException as e:
-        logging.error(f"IPInfo API error: {e}")
-        await message.answer("There was an error verifying your location. Please contact support.")
-        return
-        
+    # Определяем страну по координатам локально, без запросов во внешние сервисы.
+    # **ВАЖНО**: координаты присылает клиент, поэтому их можно подделать, как и IP через VPN.
+    country_code = geo.resolve_country(lat, lon)
+
     if not country_code:
-        await message.answer("Could not determine your country. Please try again.")
+        # Точка в океане или вдали от известных мест. Страну по IP здесь не определить:
+        # Web App не передает IP пользователя, и ipinfo увидел бы IP сервера
+        await message.answer(
+            "Could not determine your country. Please send your location again.",
+            reply_markup=kb.get_verify_keyboard()
+        )
         return
 
     # Проверка на запрещенные страны
@@ -87,81 +77,79 @@ async def process_webapp_data(message: Message, state: FSMContext, bot: Bot):
         return
 
     # Сохраняем пользователя и его страну в БД
-    db.add_or_update_user(message.from_user.id, message.from_user.username, country_code)
+    await db.add_or_update_user(message.from_user.id, message.from_user.username, country_code, bot.id)
     
     # Получаем нужный сценарий
-    scenario = SCENARIOS.get(country_code, SCENARIOS["DEFAULT"])
-    await state.update_data(scenario=scenario)
+    registry = scenarios.current()
+    scenario_key = scenarios.key_for_country(country_code)
+    step = registry.scenarios[scenario_key].steps[0]
+    # В FSM храним только ключ и версию сценария: пользователь пройдет воронку
+    # на тех текстах, с которых начал, даже если сценарии перезагрузят
+    await state.update_data(scenario=scenario_key, scenario_version=registry.version, country=country_code)
     
     # Переходим к первому шагу воронки
     await state.set_state(UserFlow.step_1)
-    await message.answer(scenario["texts"]["step1"], reply_markup=kb.get_next_keyboard())
-
-
-# --- Хендлеры для шагов воронки ---
-
-@router.callback_query(F.data == "next_step", UserFlow.step_1)
-async def go_to_step_2(callback: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    scenario = data.get("scenario")
-    await callback.message.edit_text(
-        scenario["texts"]["step2"],
-        reply_markup=kb.get_next_keyboard()
-    )
-    await state.set_state(UserFlow.step_2)
-    await callback.answer()
-
-@router.callback_query(F.data == "next_step", UserFlow.step_2)
-async def go_to_step_3(callback: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    scenario = data.get("scenario")
-    await callback.message.edit_text(
-        scenario["texts"]["step3"],
-        reply_markup=kb.get_next_keyboard()
-    )
-    await state.set_state(UserFlow.step_3)
-    await callback.answer()
-
-@router.callback_query(F.data == "next_step", UserFlow.step_3)
-async def go_to_step_4(callback: CallbackQuery, state: FSMContext):
+    await message.answer(step.text, reply_markup=step.reply_markup)
+    funnel.log_step(message.from_user.id, 1, country_code, scenario_key)
+
+
+# --- Хендлер для шагов воронки ---
+
+# Переходы по кнопке "Next": текущее состояние -> (индекс следующего шага, его состояние)
+TRANSITIONS = {
+    UserFlow.step_1.state: (1, UserFlow.step_2),
+    UserFlow.step_2.state: (2, UserFlow.step_3),
+    UserFlow.step_3.state: (3, UserFlow.step_4),
+}
+
+@router.callback_query(F.data.startswith("next_step"), StateFilter(UserFlow.step_1, UserFlow.step_2, UserFlow.step_3))
+async def go_to_next_step(callback: CallbackQuery, state: FSMContext, raw_state: str):
+    index, next_state = TRANSITIONS[raw_state]
+    # В данных кнопки - номер шага, на котором она нажата ("next_step" без номера - у сообщений,
+    # отправленных до его появления). Второе нажатие двойного тапа приходит, когда воронка
+    # уже на следующем шаге: снимаем "часики" и больше ничего не делаем
+    _, _, tapped_step = callback.data.partition(":")
+    if tapped_step and tapped_step != str(index):
+        await callback.answer()
+        return
     data = await state.get_data()
-    scenario = data.get("scenario")
-    await callback.message.edit_text(
-        scenario["texts"]["step4"],
-        reply_markup=kb.get_final_keyboard(scenario["texts"]["final_button"])
-    )
-    await state.set_state(UserFlow.step_4)
+    step = scenarios.get(data["scenario"], data.get("scenario_version")).steps[index]
+    await callback.message.edit_text(step.text, reply_markup=step.reply_markup)
+    await state.set_state(next_state)
     await callback.answer()
+    funnel.log_step(callback.from_user.id, index + 1, data["country"], data["scenario"])
     
 # --- Хендлер для финальной кнопки ---
 
 @router.callback_query(F.data == "open_platform", UserFlow.step_4)
-async def open_platform(callback: CallbackQuery, state: FSMContext):
+async def open_platform(callback: CallbackQuery, state: FSMContext, bot: Bot):
     user_id = callback.from_user.id
     
     # Получаем страну пользователя из БД
-    country_code = db.get_user_country(user_id)
+    country_code = await db.get_user_country(user_id)
     if not country_code:
         await callback.message.answer("Error: Could not find your data. Please restart the bot with /start.")
         await callback.answer()
         return
 
-    # Получаем партнерскую ссылку
-    affiliate_link = db.get_affiliate_link(country_code)
+    # Получаем партнерскую ссылку этого бота
+    affiliate_link = await db.get_affiliate_link(country_code, bot.id)
     
     # Логируем клик
-    db.log_final_click(user_id)
+    await db.log_final_click(user_id)
     
     # Получаем текст кнопки из сценария
     data = await state.get_data()
-    scenario = data.get("scenario")
+    scenario = scenarios.get(data["scenario"], data.get("scenario_version"))
     
     # Отправляем сообщение с прямой ссылкой
     await callback.message.edit_text(
         "Here is your personal link to the platform:",
-        reply_markup=kb.get_url_keyboard(scenario["texts"]["final_button"], affiliate_link)
+        reply_markup=kb.get_url_keyboard(scenario.final_button, affiliate_link)
     )
     
+    funnel.log_step(user_id, funnel.STEP_CLICKED, country_code, data["scenario"])
+
     # Завершаем состояние FSM
     await state.clear()
     await callback.answer(text="Link generated!", show_alert=False)
\ No newline at end of file
@@ -0,0 +1,162 @@
+"""
+Прием вебхуков с немедленным ответом Telegram и обработкой апдейтов пулом воркеров.
+
+Апдейт кладется в очередь в памяти, и Telegram сразу получает 200. Воркеры
+обрабатывают апдейты параллельно, но апдейты одного пользователя строго по
+очереди и только одним воркером за раз. Если в очереди уже max_pending
+апдейтов, вебхук отвечает 503, и Telegram повторит доставку позже.
+
+Один обработчик (и один пул воркеров) обслуживает сразу несколько ботов:
+каждый регистрируется на своем пути вебхука, и бот определяется по пути.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Dict
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+# Сколько секунд ждать обработки оставшихся апдейтов при остановке
+DRAIN_TIMEOUT = 10.0
+
+
+def update_owner(update: Dict[str, Any]) -> Any:
+    """Ключ упорядочивания апдейта: ID пользователя, иначе ID чата, иначе сам апдейт."""
+    for key, event in update.items():
+        if key == 'update_id' or not isinstance(event, dict):
+            continue
+        if 'from' in event:
+            return event['from']['id']
+        if 'chat' in event:
+            return event['chat']['id']
+        if 'user' in event:
+            return event['user']['id']
+    return ('update', update.get('update_id'))
+
+
+class IngestStats:
+    """Счетчики очереди апдейтов."""
+
+    def __init__(self):
+        self.received = 0
+        self.processed = 0
+        self.rejected = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def snapshot(self, depth: int, busy: int) -> dict:
+        return {
+            "depth": depth,
+            "busy_workers": busy,
+            "max_depth": self.max_depth,
+            "received": self.received,
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "wait_seconds_avg": self.wait_seconds_total / self.processed if self.processed else 0.0,
+            "wait_seconds_max": self.wait_seconds_max,
+        }
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """Обработчик вебхука: быстрый ответ, ограниченная очередь и порядок апдейтов по пользователю."""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int, max_pending: int, **kwargs: Any):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **kwargs)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.stats = IngestStats()
+        # Очереди апдейтов по пользователям и очередь пользователей, чьи апдейты готовы к обработке
+        self._by_owner: dict[Any, deque] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._pending = 0
+        self._busy = 0
+        self._accepting = True
+        self._tasks: list[asyncio.Task] = []
+        # Путь вебхука -> бот
+        self._bots: dict[str, Bot] = {}
+
+    def register(self, app: web.Application, /, path: str, bot: Bot | None = None, **kwargs: Any) -> None:
+        """Добавляет маршрут вебхука для бота bot (по умолчанию - для бота из конструктора)."""
+        self._bots[path] = bot or self.bot
+        if len(self._bots) > 1:
+            # Воркеры и закрытие уже подключены при первой регистрации
+            app.router.add_route("POST", path, self.handle, **kwargs)
+            return
+        app.on_startup.append(self._handle_start)
+        super().register(app, path=path, **kwargs)
+
+    async def resolve_bot(self, request: web.Request) -> Bot:
+        return self._bots[request.match_info.route.resource.canonical]
+
+    async def _handle_start(self, app: web.Application) -> None:
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def snapshot(self) -> dict:
+        """Текущее состояние очереди для мониторинга."""
+        return self.stats.snapshot(self._pending, self._busy)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+        if not self._accepting or self._pending >= self.max_pending:
+            self.stats.rejected += 1
+            return web.Response(status=503)
+
+        update = await request.json(loads=bot.session.json_loads)
+        self._enqueue(update_owner(update), (time.monotonic(), bot, update))
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    def _enqueue(self, owner: Any, item: tuple):
+        self.stats.received += 1
+        self._pending += 1
+        self.stats.max_depth = max(self.stats.max_depth, self._pending)
+        queue = self._by_owner.get(owner)
+        if queue is not None:
+            # Пользователь уже в работе или ждет воркера - просто встаем за его апдейтами
+            queue.append(item)
+            return
+        self._by_owner[owner] = deque([item])
+        self._ready.put_nowait(owner)
+
+    async def _worker(self):
+        while True:
+            owner = await self._ready.get()
+            queue = self._by_owner[owner]
+            enqueued_at, bot, update = queue.popleft()
+            wait = time.monotonic() - enqueued_at
+            self.stats.wait_seconds_total += wait
+            self.stats.wait_seconds_max = max(self.stats.wait_seconds_max, wait)
+            self._busy += 1
+            try:
+                await self._background_feed_update(bot=bot, update=update)
+            except Exception:
+                self.stats.errors += 1
+                logging.exception(f"Failed to process update {update.get('update_id')}")
+            finally:
+                self._busy -= 1
+                self._pending -= 1
+                self.stats.processed += 1
+                if queue:
+                    self._ready.put_nowait(owner)
+                else:
+                    del self._by_owner[owner]
+
+    async def close(self) -> None:
+        """Перестает принимать апдейты, дожидается обработки очереди и закрывает сессию бота."""
+        self._accepting = False
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while self._pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._pending:
+            logging.warning(f"Dropping {self._pending} unprocessed updates on shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await super().close()
@@ -1,28 +1,38 @@
 # keyboards.py
+from functools import lru_cache
+
 from aiogram.types import InlineKeyboardButton, WebAppInfo
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from config import BASE_URL
+import static
+
+# Клавиатуры воронки не зависят от пользователя, поэтому собираются один раз
+# и дальше отдаются один и тот же (неизменяемый) объект.
 
+@lru_cache(maxsize=None)
 def get_verify_keyboard():
     """Клавиатура для запроса верификации через Web App."""
     builder = InlineKeyboardBuilder()
-    # А вот так - правильно:
-    web_app = WebAppInfo(url=f"{BASE_URL}/web_app/index.html") 
+    # Ссылка с версией файла: клиент кеширует страницу, пока она не изменится
+    web_app = WebAppInfo(url=f"{BASE_URL}{static.web_app.url('index.html')}")
     builder.add(InlineKeyboardButton(text="✅ Verify Location", web_app=web_app))
     return builder.as_markup()
 
-def get_next_keyboard(text: str = "Next ➡️"):
-    """Клавиатура с кнопкой 'Next'. [cite: 424]"""
+@lru_cache(maxsize=None)
+def get_next_keyboard(step: int, text: str = "Next ➡️"):
+    """Клавиатура с кнопкой 'Next' для шага step (номер шага - в данных кнопки). [cite: 424]"""
     builder = InlineKeyboardBuilder()
-    builder.add(InlineKeyboardButton(text=text, callback_data="next_step"))
+    builder.add(InlineKeyboardButton(text=text, callback_data=f"next_step:{step}"))
     return builder.as_markup()
 
+@lru_cache(maxsize=None)
 def get_final_keyboard(button_text: str):
     """Финальная кнопка для перехода на платформу (сначала как callback). [cite: 444, 446]"""
     builder = InlineKeyboardBuilder()
     builder.add(InlineKeyboardButton(text=button_text, callback_data="open_platform"))
     return builder.as_markup()
 
+@lru_cache(maxsize=1024)
 def get_url_keyboard(button_text: str, url: str):
     """Кнопка с прямой ссылкой. [cite: 430]"""
     builder = InlineKeyboardBuilder()
@@ -33,7 +43,33 @@ def get_admin_keyboard():
     """Интерактивная админ-панель (опционально, но улучшает UX). [cite: 508]"""
     builder = InlineKeyboardBuilder()
     builder.button(text="📊 Статистика", callback_data="admin_stats")
+    builder.button(text="📉 Воронка", callback_data="admin_funnel")
     builder.button(text="✏️ Изменить ссылку", callback_data="admin_set_link")
     builder.button(text="📢 Рассылка", callback_data="admin_broadcast")
+    builder.button(text="📤 Выгрузка", callback_data="admin_export")
     builder.adjust(1) # Все кнопки в один столбец
-    return builder.as_markup()
\ No newline at end of file
+    return builder.as_markup()
+
+def get_stats_period_keyboard():
+    """Переключение периода статистики."""
+    builder = InlineKeyboardBuilder()
+    builder.button(text="24 часа", callback_data="admin_stats:24")
+    builder.button(text="7 дней", callback_data="admin_stats:168")
+    builder.button(text="30 дней", callback_data="admin_stats:720")
+    return builder.as_markup()
+
+def get_broadcast_progress_keyboard(job_id: int):
+    """Кнопка обновления прогресса рассылки."""
+    builder = InlineKeyboardBuilder()
+    builder.button(text="🔄 Обновить", callback_data=f"broadcast_progress:{job_id}")
+    return builder.as_markup()
+
+def get_export_keyboard():
+    """Выбор данных и формата выгрузки."""
+    builder = InlineKeyboardBuilder()
+    builder.button(text="👤 Пользователи, CSV", callback_data="admin_export:users:csv")
+    builder.button(text="👤 Пользователи, NDJSON", callback_data="admin_export:users:ndjson")
+    builder.button(text="🖱️ Клики, CSV", callback_data="admin_export:clicks:csv")
+    builder.button(text="🖱️ Клики, NDJSON", callback_data="admin_export:clicks:ndjson")
+    builder.adjust(2)
+    return builder.as_markup()
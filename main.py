@@ -5,51 +5,105 @@ import logging
 
 from aiohttp import web
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
-from config import BOT_TOKEN, BASE_URL
+from config import (
+    BASE_URL, BOT_API_URL, FSM_WRITE_BEHIND, WEBHOOK_MODE, UPDATE_WORKERS, UPDATE_QUEUE_SIZE, METRICS_TOKEN,
+    RECORD_DIR, RECORD_SEGMENT_MB,
+)
 from handlers import user_flow, admin
+from antiflood import AntiFloodMiddleware
+import bots
+import broadcast
 import db
+import funnel
+import geo
+import geoip
+import maintenance
+import metrics
+import outbound
+import profiler
+import recorder
+import scenarios
+import static
+from ingest import QueuedRequestHandler
+from storage import SQLiteStorage
 
 # --- Global Setup ---
 
 # Configure logging to print info messages
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Webhook and Web App paths
-WEBHOOK_PATH = f"/webhook/{BOT_TOKEN}"
-WEBHOOK_URL = f"{BASE_URL}{WEBHOOK_PATH}"
-WEBAPP_PATH = "/web_app"
-
-# Create Bot, Dispatcher, and Storage instances
-storage = MemoryStorage()
+# Create Bot, Dispatcher, and Storage instances.
+# All bots from bots.CONFIGS share one dispatcher, one FSM storage (keys include
+# the bot ID) and one HTTP session, so they also share its connection pool
+storage = SQLiteStorage(write_behind=FSM_WRITE_BEHIND)
 default_properties = DefaultBotProperties(parse_mode="HTML")
-bot = Bot(token=BOT_TOKEN, default=default_properties)
+session = AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)) if BOT_API_URL else AiohttpSession()
+bot_list = [Bot(token=config.token, session=session, default=default_properties) for config in bots.CONFIGS]
+# The primary bot owns users and broadcasts created before there were several bots
+bot = bot_list[0]
 dp = Dispatcher(storage=storage)
+# Dispatcher falls back to MemoryStorage when the storage it gets is falsy:
+# fail loudly instead of silently losing FSM state on restart
+if dp.storage is not storage:
+    raise RuntimeError("Dispatcher replaced SQLiteStorage with its default storage")
 
 # Include routers from the 'handlers' directory
 dp.include_router(admin.router)
 dp.include_router(user_flow.router)
 
+# Drop floods and repeated button taps before they reach FSM, handlers and geo lookups
+antiflood = AntiFloodMiddleware(exempt=bots.all_admin_ids())
+dp.message.outer_middleware(antiflood)
+dp.callback_query.outer_middleware(antiflood)
+
+# Log updates slower than SLOW_UPDATE_SECONDS with a per-phase breakdown (FSM, db, API, geo-IP)
+profiler.setup(dp)
+
 
 # --- Startup and Shutdown Logic ---
 
 # CORRECTION: Removed the 'bot_instance' argument.
 # The function will now use the global 'bot' object defined above.
 async def on_startup():
-    """Actions on startup: initialize DB and set webhook."""
+    """Actions on startup: initialize DB, resume broadcasts, load geo data and set webhook."""
     logging.info("Initializing database...")
-    db.init_db()
-    logging.info(f"Setting webhook to {WEBHOOK_URL}")
-    await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True)
+    await db.init_db()
+    await db.assign_legacy_bot(bot.id)
+    await storage.start()
+    funnel.start()
+    scenarios.start_watcher()
+    await broadcast.resume_broadcasts(bot_list)
+    maintenance.start()
+    logging.info("Loading country boundaries...")
+    geo.get_resolver()
+    if update_recorder is not None:
+        update_recorder.start()
+    for config, instance in zip(bots.CONFIGS, bot_list):
+        logging.info(f"Setting webhook for bot {config.name} ({config.bot_id})")
+        await instance.set_webhook(f"{BASE_URL}{config.webhook_path}", drop_pending_updates=True)
 
 # CORRECTION: Removed the 'bot_instance' argument.
 async def on_shutdown():
-    """Actions on shutdown: delete webhook."""
+    """Actions on shutdown: delete webhook, stop broadcasts and close DB and HTTP connections."""
     logging.warning('Shutting down..')
-    await bot.delete_webhook()
+    for instance in bot_list:
+        await instance.delete_webhook()
+    if update_recorder is not None:
+        await update_recorder.stop()
+    await broadcast.stop_broadcasts()
+    await geoip.close()
+    await scenarios.stop_watcher()
+    await funnel.stop()
+    await maintenance.stop()
+    await storage.close()
+    # Commit user upserts and clicks still waiting for their group transaction
+    await db.flush_writes()
+    await db.close_db()
 
 # Register the startup and shutdown functions
 dp.startup.register(on_startup)
@@ -61,20 +115,73 @@ dp.shutdown.register(on_shutdown)
 # Create the web application instance. Gunicorn will look for this.
 app = web.Application()
 
-# Create a webhook handler
-webhook_requests_handler = SimpleRequestHandler(
-    dispatcher=dp,
-    bot=bot,
-)
-
-# Register the handler in the app to process requests from Telegram
-webhook_requests_handler.register(app, path=WEBHOOK_PATH)
+# Optionally record accepted webhook updates with their arrival times into
+# compressed segment files, to replay the traffic later (benchmarks/replay.py)
+update_recorder = None
+if RECORD_DIR:
+    update_recorder = recorder.UpdateRecorder(
+        RECORD_DIR,
+        {config.webhook_path: config.bot_id for config in bots.CONFIGS},
+        segment_bytes=int(RECORD_SEGMENT_MB * 1024 * 1024),
+    )
+    app.middlewares.append(update_recorder.middleware)
+
+# Create a webhook handler: either acknowledge at once and process updates
+# in a worker pool shared by all bots, or let aiogram handle them as it does by default
+if WEBHOOK_MODE == "queue":
+    webhook_requests_handler = QueuedRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        workers=UPDATE_WORKERS,
+        max_pending=UPDATE_QUEUE_SIZE,
+    )
+    # Register every bot's webhook path in the app to process requests from Telegram
+    for config, instance in zip(bots.CONFIGS, bot_list):
+        webhook_requests_handler.register(app, path=config.webhook_path, bot=instance)
+else:
+    for config, instance in zip(bots.CONFIGS, bot_list):
+        webhook_requests_handler = SimpleRequestHandler(
+            dispatcher=dp,
+            bot=instance,
+        )
+        webhook_requests_handler.register(app, path=config.webhook_path)
 
 # Set up the rest of the aiogram components for the web app
-setup_application(app, dp, bot=bot)
-
-# Add a route to serve the static files for our Web App (for geolocation)
-app.router.add_static(WEBAPP_PATH, path='web_app', name='webapp')
+setup_application(app, dp, bots=bot_list)
+
+# Pace outbound Bot API calls: funnel replies go first, broadcasts get what is left.
+# Registered before metrics so that API timings exclude the time spent queued
+outbound_scheduler = outbound.OutboundScheduler()
+session.middleware(outbound_scheduler)
+
+# Expose Prometheus metrics: handler, DB and outbound request timings are
+# recorded as they happen, the gauges below are computed on each scrape
+metrics.setup(app, dp, bot, token=METRICS_TOKEN)  # the bots share one session
+metrics.Gauge("bot_fsm_sessions", "FSM sessions held in memory", collect=lambda: {(): storage.session_count()})
+metrics.Gauge(
+    "bot_broadcast_total", "Recipients of running broadcasts", ["job_id"],
+    collect=lambda: {(job_id,): job['total'] for job_id, job in broadcast.progress().items()},
+)
+metrics.Gauge(
+    "bot_broadcast_processed", "Processed recipients of running broadcasts", ["job_id"],
+    collect=lambda: {(job_id,): job['sent'] + job['failed'] + job['blocked'] for job_id, job in broadcast.progress().items()},
+)
+metrics.Gauge(
+    "bot_antiflood_tracked", "Users and button taps held by the anti-flood middleware", ["kind"],
+    collect=lambda: {(kind,): value for kind, value in antiflood.tracked().items()},
+)
+metrics.Gauge(
+    "bot_outbound_waiting", "Bot API requests waiting in the outbound scheduler", ["priority"],
+    collect=lambda: {(priority,): value for priority, value in outbound_scheduler.snapshot().items()},
+)
+if isinstance(webhook_requests_handler, QueuedRequestHandler):
+    metrics.Gauge(
+        "bot_update_queue", "Webhook update queue state", ["field"],
+        collect=lambda: {(field,): value for field, value in webhook_requests_handler.snapshot().items()},
+    )
+
+# Serve the Web App (for geolocation) from memory, precompressed and with ETag caching
+static.web_app.register(app)
 
 # This block is for local testing without Gunicorn
 if __name__ == '__main__':
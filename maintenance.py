@@ -0,0 +1,152 @@
+"""
+Плановое обслуживание базы.
+
+Раз в MAINTENANCE_INTERVAL_HOURS часов фоновая задача:
+- переносит пользователей, неактивных дольше ARCHIVE_INACTIVE_DAYS дней, из
+  users в users_archive, а их число и клики - в итоги архива (stats_archived);
+- возвращает системе свободные страницы файла (incremental vacuum);
+- обновляет статистику планировщика (PRAGMA optimize).
+
+Все делается короткими транзакциями с паузами между ними: поток-писатель
+один, и между пачками успевают записи воронки. Итог прохода - перенесенные
+пользователи, освобожденное место и время каждого этапа - пишется в лог и в
+метрики; вручную проход запускается командой /db_maintenance.
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+
+import db
+import metrics
+from config import MAINTENANCE_INTERVAL_HOURS, ARCHIVE_INACTIVE_DAYS
+
+# Через сколько секунд после запуска бота первый проход
+START_DELAY = 300
+# Сколько пользователей переносить в архив одной транзакцией
+ARCHIVE_BATCH_SIZE = 500
+# Пауза между транзакциями, секунды
+STEP_PAUSE = 0.05
+# Полный VACUUM (чтобы включить incremental vacuum у старой базы) блокирует
+# запись на все время; делаем его сами только для небольшой базы
+FULL_VACUUM_MAX_BYTES = 64 * 1024 * 1024
+
+DURATION = metrics.Histogram("bot_db_maintenance_seconds", "Time spent on database maintenance", ["task"])
+ARCHIVED = metrics.Counter("bot_users_archived_total", "Inactive users moved to the archive")
+RECLAIMED = metrics.Counter("bot_db_reclaimed_bytes_total", "Bytes returned to the filesystem by incremental vacuum")
+
+_lock = asyncio.Lock()
+_task: asyncio.Task | None = None
+
+
+@dataclass(slots=True)
+class MaintenanceReport:
+    archived_users: int = 0
+    archive_seconds: float = 0.0
+    reclaimed_bytes: int = 0
+    vacuum_seconds: float = 0.0
+    # skipped - освобождать нечего, incremental - по шагам, full - пересборка файла
+    vacuum_mode: str = "skipped"
+    optimize_seconds: float = 0.0
+    # Размер базы в страницах (без WAL, который зависит от checkpoint), байт
+    size_before: int = 0
+    size_after: int = 0
+
+    def summary(self) -> str:
+        return (
+            f"archived {self.archived_users} users in {self.archive_seconds:.2f} s, "
+            f"vacuum ({self.vacuum_mode}) reclaimed {self.reclaimed_bytes / 1024 / 1024:.1f} MB "
+            f"in {self.vacuum_seconds:.2f} s, optimize {self.optimize_seconds:.2f} s, "
+            f"database {self.size_before / 1024 / 1024:.1f} -> {self.size_after / 1024 / 1024:.1f} MB"
+        )
+
+
+def is_running() -> bool:
+    return _lock.locked()
+
+
+async def _archive(report: MaintenanceReport):
+    started = time.perf_counter()
+    before = time.time() - ARCHIVE_INACTIVE_DAYS * 86400
+    while archived := await db.archive_inactive_users(before, ARCHIVE_BATCH_SIZE):
+        report.archived_users += archived
+        await asyncio.sleep(STEP_PAUSE)
+    report.archive_seconds = time.perf_counter() - started
+    ARCHIVED.inc(amount=report.archived_users)
+    DURATION.observe(report.archive_seconds, "archive")
+
+
+def _size(pages: dict) -> int:
+    return pages["page_count"] * pages["page_size"]
+
+
+async def _vacuum(report: MaintenanceReport):
+    started = time.perf_counter()
+    pages = await db.get_page_stats()
+    if pages["auto_vacuum"] != db.AUTO_VACUUM_INCREMENTAL:
+        if _size(pages) > FULL_VACUUM_MAX_BYTES:
+            logging.warning(
+                "Incremental vacuum is off for this database and it is too large to convert online; "
+                "run 'PRAGMA auto_vacuum = INCREMENTAL; VACUUM;' once while the bot is stopped"
+            )
+            return
+        await db.enable_incremental_vacuum()
+        report.vacuum_mode = "full"
+    elif pages["freelist_count"]:
+        free = pages["freelist_count"]
+        while free:
+            left = await db.incremental_vacuum()
+            if left >= free:
+                break
+            free = left
+            await asyncio.sleep(STEP_PAUSE)
+        report.vacuum_mode = "incremental"
+    else:
+        return
+    after = await db.get_page_stats()
+    report.reclaimed_bytes = max(0, _size(pages) - _size(after))
+    report.vacuum_seconds = time.perf_counter() - started
+    RECLAIMED.inc(amount=report.reclaimed_bytes)
+    DURATION.observe(report.vacuum_seconds, "vacuum")
+
+
+async def run() -> MaintenanceReport:
+    """Один проход обслуживания; одновременно выполняется только один."""
+    async with _lock:
+        report = MaintenanceReport(size_before=_size(await db.get_page_stats()))
+        await _archive(report)
+        await _vacuum(report)
+        started = time.perf_counter()
+        await db.optimize()
+        report.optimize_seconds = time.perf_counter() - started
+        DURATION.observe(report.optimize_seconds, "optimize")
+        await db.checkpoint()
+        report.size_after = _size(await db.get_page_stats())
+        logging.info(f"Database maintenance: {report.summary()}")
+        return report
+
+
+async def _run_periodically():
+    await asyncio.sleep(START_DELAY)
+    while True:
+        try:
+            await run()
+        except Exception:
+            logging.exception("Database maintenance failed")
+        await asyncio.sleep(MAINTENANCE_INTERVAL_HOURS * 3600)
+
+
+def start():
+    """Запускает плановое обслуживание (если MAINTENANCE_INTERVAL_HOURS > 0)."""
+    global _task
+    if _task is None and MAINTENANCE_INTERVAL_HOURS > 0:
+        _task = asyncio.create_task(_run_periodically())
+
+
+async def stop():
+    """Останавливает плановое обслуживание, прерывая текущий проход."""
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
@@ -0,0 +1,192 @@
+"""
+Метрики в текстовом формате Prometheus для маршрута /metrics.
+
+Счетчики и гистограммы обновляются прямо в горячем пути (хендлеры, вызовы db,
+запросы к Bot API и geo-IP), поэтому устроены максимально просто: словарь
+по кортежу меток и поиск корзины через bisect, без блокировок - все
+обновления идут из event loop. Гейджи вроде числа FSM-сессий не хранятся,
+а считаются функцией в момент запроса /metrics.
+"""
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Dict, Iterable
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import Response, TelegramMethod
+from aiogram.types import TelegramObject
+from aiohttp import web
+
+import profiler
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Корзины гистограмм по умолчанию, секунды
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics: list["_Metric"] = []
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _metrics.append(self)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик."""
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Gauge(_Metric):
+    """Текущее значение; если задан collect, значения берутся из него при каждом запросе /metrics."""
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 collect: Callable[[], Dict[tuple, float]] | None = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+        self._collect = collect
+
+    def set(self, *labels, value: float):
+        self._values[labels] = value
+
+    def set_function(self, collect: Callable[[], Dict[tuple, float]]):
+        self._collect = collect
+
+    def samples(self):
+        values = self._collect() if self._collect is not None else self._values
+        for labels, value in values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам (по умолчанию - длительности в секундах)."""
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [счетчики по корзинам (последняя - +Inf), сумма]
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+
+def render() -> str:
+    """Все метрики процесса в текстовом формате Prometheus."""
+    return "\n".join(metric.render() for metric in _metrics) + "\n"
+
+
+# --- Метрики, общие для всего бота ---
+
+HANDLER_DURATION = Histogram("bot_handler_duration_seconds", "Handler processing time", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Exceptions raised by handlers", ["handler", "error"])
+DB_DURATION = Histogram("bot_db_duration_seconds", "DB call time including the wait for a pool thread", ["kind", "query"])
+DB_GROUP_SIZE = Histogram("bot_db_group_commit_size", "Writes committed in one group transaction",
+                          buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500))
+DB_ERRORS = Counter("bot_db_errors_total", "Failed DB calls", ["kind", "query"])
+API_DURATION = Histogram("bot_api_request_duration_seconds", "Bot API request time", ["method"])
+API_ERRORS = Counter("bot_api_errors_total", "Failed Bot API requests", ["method", "error"])
+GEOIP_DURATION = Histogram("bot_geoip_request_duration_seconds", "geo-IP provider request time")
+GEOIP_ERRORS = Counter("bot_geoip_errors_total", "Failed geo-IP provider requests")
+BROADCAST_MESSAGES = Counter("bot_broadcast_messages_total", "Broadcast messages by delivery result", ["status"])
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время работы и ошибки хендлеров; подключается как inner middleware, чтобы знать, какой хендлер сработал."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - started, name)
+
+
+class RequestMetricsMiddleware(BaseRequestMiddleware):
+    """Время и ошибки запросов к Bot API по методам."""
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod) -> Response:
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            with profiler.phase("api"):
+                return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            API_DURATION.observe(time.perf_counter() - started, name)
+
+
+def setup(app: web.Application, dispatcher, bot: Bot, path: str = "/metrics", token: str | None = None):
+    """Подключает middleware к диспетчеру и сессии бота и добавляет маршрут с метриками."""
+    for name, observer in dispatcher.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(HandlerMetricsMiddleware())
+    bot.session.middleware(RequestMetricsMiddleware())
+
+    async def handle(request: web.Request) -> web.Response:
+        if token and request.headers.get("Authorization") != f"Bearer {token}":
+            return web.Response(status=401)
+        return web.Response(body=render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    app.router.add_get(path, handle)
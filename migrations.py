@@ -0,0 +1,288 @@
+"""
+Версионные миграции схемы базы.
+
+Каждая миграция - функция migration(version, description), которая получает
+cursor и меняет схему. Номер последней примененной миграции хранится в
+таблице schema_version; migrate() применяет все более новые по порядку
+в одной транзакции, поэтому при ошибке база остается на прежней версии.
+Уже выпущенные миграции не меняются - любое изменение схемы добавляется
+новой миграцией в конец файла.
+"""
+import logging
+import sqlite3
+import time
+from typing import Callable
+
+# Зарегистрированные миграции по возрастанию номера: (version, description, func)
+MIGRATIONS: list[tuple[int, str, Callable[[sqlite3.Cursor], None]]] = []
+
+
+def migration(version: int, description: str):
+    """Регистрирует функцию func(cursor) как миграцию с номером version."""
+    def register(func):
+        if MIGRATIONS and version <= MIGRATIONS[-1][0]:
+            raise ValueError(f"Migration {version} must be newer than {MIGRATIONS[-1][0]}")
+        MIGRATIONS.append((version, description, func))
+        return func
+    return register
+
+
+def latest_version() -> int:
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def migrate(cursor: sqlite3.Cursor) -> list[int]:
+    """Применяет недостающие миграции; возвращает их номера."""
+    # Сразу берем блокировку на запись: иначе два воркера, стартующие одновременно,
+    # прочитают одну и ту же версию и оба начнут применять миграции
+    if not cursor.connection.in_transaction:
+        cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    current = cursor.fetchone()[0]
+    if current > latest_version():
+        logging.warning(f"Database schema version {current} is newer than this code ({latest_version()})")
+
+    applied = []
+    for version, description, func in MIGRATIONS:
+        if version <= current:
+            continue
+        logging.info(f"Applying migration {version}: {description}")
+        func(cursor)
+        cursor.execute(
+            "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+            (version, description, time.time())
+        )
+        applied.append(version)
+    return applied
+
+
+@migration(1, "initial schema")
+def _initial_schema(cursor: sqlite3.Cursor):
+    # Таблицы создаются с IF NOT EXISTS: база, созданная до появления миграций,
+    # просто получает версию 1
+
+    # Таблица пользователей [cite: 513]
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            country TEXT,
+            joined_at DATETIME,
+            completed_steps INTEGER DEFAULT 0,
+            ref_clicks INTEGER DEFAULT 0,
+            is_active BOOLEAN DEFAULT TRUE
+        )
+    ''')
+
+    # Таблица партнерских ссылок [cite: 520]
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS affiliate_links (
+            country TEXT PRIMARY KEY,
+            url TEXT NOT NULL
+        )
+    ''')
+
+    # Добавляем начальные ссылки, если их нет [cite: 524]
+    initial_links = [('CA', 'https://example.com/ca/ref123'), ('ES', 'https://example.com/es/ref456'), ('DEFAULT', 'https://example.com/default/ref789')]
+    cursor.executemany("INSERT OR IGNORE INTO affiliate_links (country, url) VALUES (?, ?)", initial_links)
+
+    # Служебные значения, например версия партнерских ссылок
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('affiliate_links_version', 0)")
+
+    # Агрегаты для статистики, обновляются вместе с записью в users:
+    # итоги по странам и почасовые счетчики для отчетов за период
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_countries (
+            country TEXT PRIMARY KEY,
+            active_users INTEGER NOT NULL DEFAULT 0,
+            clicks INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_hourly (
+            hour INTEGER NOT NULL,
+            country TEXT NOT NULL,
+            new_users INTEGER NOT NULL DEFAULT 0,
+            clicks INTEGER NOT NULL DEFAULT 0,
+            deactivated INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, country)
+        ) WITHOUT ROWID
+    ''')
+    # Журнал прохождения воронки: кто, какой шаг, по какому сценарию и когда
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS funnel_events (
+            user_id INTEGER NOT NULL,
+            step INTEGER NOT NULL,
+            country TEXT NOT NULL,
+            scenario TEXT NOT NULL,
+            ts REAL NOT NULL
+        )
+    ''')
+    # Покрывающие индексы для отчета: счетчики по стране и шагу и поиск следующего шага пользователя
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_funnel_country_step_ts ON funnel_events (country, step, ts, user_id)"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_funnel_user_step_ts ON funnel_events (user_id, step, ts)")
+
+    # Состояния FSM (см. storage.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_sessions (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_sessions_updated_at ON fsm_sessions (updated_at)")
+
+    # Для базы, созданной до появления агрегатов, один раз считаем итоги по users
+    cursor.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('stats_backfilled', 0)")
+    cursor.execute("SELECT value FROM meta WHERE key = 'stats_backfilled'")
+    if not cursor.fetchone()[0]:
+        cursor.execute(
+            "INSERT OR REPLACE INTO stats_countries (country, active_users, clicks) "
+            "SELECT country, SUM(is_active = TRUE), SUM(ref_clicks) FROM users GROUP BY country"
+        )
+        cursor.execute("UPDATE meta SET value = 1 WHERE key = 'stats_backfilled'")
+
+    # Задания рассылки и статус доставки каждому получателю
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_chat_id INTEGER NOT NULL,
+            from_chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            progress_message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME,
+            finished_at DATETIME
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_pending "
+        "ON broadcast_recipients (job_id, status, user_id)"
+    )
+
+
+@migration(2, "indexes for active-user and per-country queries on users")
+def _users_indexes(cursor: sqlite3.Cursor):
+    # Частичный индекс только по активным: выборка получателей рассылки
+    # читает его, а не всю таблицу вместе с отписавшимися
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users (user_id) WHERE is_active = TRUE")
+    # Активные пользователи страны в порядке user_id (сегменты и выгрузки по стране)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_active_country ON users (country, user_id) WHERE is_active = TRUE"
+    )
+    # Покрывающий индекс для сводок по странам (пересчет stats_countries)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_country ON users (country, is_active, ref_clicks)")
+
+
+@migration(3, "broadcast segments instead of a recipient snapshot")
+def _broadcast_segments(cursor: sqlite3.Cursor):
+    # Получатели больше не копируются в broadcast_recipients заранее: там остаются
+    # только результаты доставки, а задание хранит фильтр сегмента (JSON)
+    cursor.execute("ALTER TABLE broadcast_jobs ADD COLUMN segment TEXT NOT NULL DEFAULT '{}'")
+    # Незавершенные рассылки продолжатся по всем активным, минус уже обработанные
+    cursor.execute("DELETE FROM broadcast_recipients WHERE status = 0")
+    cursor.execute("DROP INDEX IF EXISTS idx_broadcast_recipients_pending")
+
+
+@migration(4, "bot_id on users, broadcast jobs and affiliate links for several bots in one process")
+def _multi_bot(cursor: sqlite3.Cursor):
+    # 0 - строки, созданные до появления нескольких ботов: пользователей и
+    # рассылки при запуске забирает основной бот (db.assign_legacy_bot)
+    cursor.execute("ALTER TABLE users ADD COLUMN bot_id INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE broadcast_jobs ADD COLUMN bot_id INTEGER NOT NULL DEFAULT 0")
+    # Получатели рассылки выбираются в пределах одного бота
+    cursor.execute("DROP INDEX IF EXISTS idx_users_active")
+    cursor.execute("DROP INDEX IF EXISTS idx_users_active_country")
+    cursor.execute("CREATE INDEX idx_users_bot_active ON users (bot_id, user_id) WHERE is_active = TRUE")
+    cursor.execute(
+        "CREATE INDEX idx_users_bot_active_country ON users (bot_id, country, user_id) WHERE is_active = TRUE"
+    )
+    # Первичный ключ через ALTER не поменять, поэтому таблица ссылок пересоздается.
+    # Ссылки с bot_id = 0 общие для всех ботов, ссылка бота перекрывает общую
+    cursor.execute('''
+        CREATE TABLE affiliate_links_new (
+            bot_id INTEGER NOT NULL DEFAULT 0,
+            country TEXT NOT NULL,
+            url TEXT NOT NULL,
+            PRIMARY KEY (bot_id, country)
+        )
+    ''')
+    cursor.execute("INSERT INTO affiliate_links_new (bot_id, country, url) SELECT 0, country, url FROM affiliate_links")
+    cursor.execute("DROP TABLE affiliate_links")
+    cursor.execute("ALTER TABLE affiliate_links_new RENAME TO affiliate_links")
+
+
+@migration(5, "deactivated_at on users and an archive for long-inactive users")
+def _users_archive(cursor: sqlite3.Cursor):
+    cursor.execute("ALTER TABLE users ADD COLUMN deactivated_at REAL")
+    # Когда отписались уже неактивные пользователи, неизвестно: отсчитываем от миграции
+    cursor.execute("UPDATE users SET deactivated_at = ? WHERE is_active = FALSE", (time.time(),))
+    # Частичный индекс только по неактивным: кандидаты в архив по давности отписки
+    cursor.execute("CREATE INDEX idx_users_inactive ON users (deactivated_at) WHERE is_active = FALSE")
+    # Давно неактивные пользователи переносятся сюда (db.archive_inactive_users) и
+    # возвращаются в users, если снова пройдут проверку
+    cursor.execute('''
+        CREATE TABLE users_archive (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            country TEXT,
+            joined_at DATETIME,
+            completed_steps INTEGER NOT NULL DEFAULT 0,
+            ref_clicks INTEGER NOT NULL DEFAULT 0,
+            bot_id INTEGER NOT NULL DEFAULT 0,
+            deactivated_at REAL,
+            archived_at REAL NOT NULL
+        )
+    ''')
+    # Итоги по архиву для статистики, чтобы не читать архив целиком
+    cursor.execute('''
+        CREATE TABLE stats_archived (
+            bot_id INTEGER NOT NULL,
+            country TEXT NOT NULL,
+            users INTEGER NOT NULL DEFAULT 0,
+            clicks INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bot_id, country)
+        ) WITHOUT ROWID
+    ''')
+
+
+@migration(6, "drop idx_users_country, which no query uses")
+def _drop_users_country_index(cursor: sqlite3.Cursor):
+    # Индекс был нужен только пересчету итогов в миграции 1, а он выполняется раньше.
+    # Из-за ref_clicks в нем каждый клик и каждое обновление пользователя платили за его обновление
+    cursor.execute("DROP INDEX IF EXISTS idx_users_country")
+
+
+@migration(7, "per-country indexes for user exports")
+def _users_export_indexes(cursor: sqlite3.Cursor):
+    # Выгрузка по стране (db._export_country_users) идет по ним в порядке user_id
+    cursor.execute("CREATE INDEX idx_users_country_user ON users (country, user_id)")
+    cursor.execute("CREATE INDEX idx_users_archive_country ON users_archive (country, user_id)")
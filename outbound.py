@@ -0,0 +1,185 @@
+"""
+Планировщик исходящих запросов к Bot API.
+
+Подключается как middleware сессии, поэтому через него проходят все вызовы:
+ответы в воронке, прогресс и копии сообщений рассылки. Ограничиваются только
+методы, которые отправляют или меняют сообщения (send*, copy*, forward*,
+edit*); answerCallbackQuery, setWebhook и т.п. идут сразу.
+
+У каждого бота общий token bucket (~30 сообщений в секунду у Telegram) и
+свой bucket на каждый чат. Приоритет задается contextvar: по умолчанию
+INTERACTIVE, рассылка переключает свою задачу на BULK (set_priority).
+Интерактивный запрос ждет только лимит своего чата: он забирает токен из
+общего bucket сразу, даже в долг, а массовые запросы по одному в порядке
+очереди ждут, пока в общем bucket появится токен. Так рассылка получает
+только то, что осталось от живых пользователей.
+
+RetryAfter обрабатывается здесь же: все запросы бота встают на паузу на
+указанное время, а запрос повторяется (не больше MAX_RETRIES раз).
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+
+import metrics
+import profiler
+
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+# Общий лимит бота: сообщений в секунду и запас на всплеск
+GLOBAL_RATE = 28.0
+GLOBAL_BURST = 5
+# Лимит одного чата
+PER_CHAT_RATE = 1.0
+PER_CHAT_BURST = 3
+# Сколько секунд в долг могут забрать интерактивные запросы из общего bucket
+MAX_DEBT_SECONDS = 1.0
+# Сколько раз повторять запрос после RetryAfter
+MAX_RETRIES = 5
+# Максимум чатов в памяти на бота
+MAX_TRACKED_CHATS = 100_000
+LIMITED_PREFIXES = ("send", "copy", "forward", "edit")
+
+WAIT = metrics.Histogram("bot_outbound_wait_seconds", "Time Bot API requests waited in the outbound scheduler", ["priority"])
+RETRIES = metrics.Counter("bot_outbound_retry_after_total", "RetryAfter responses retried by the outbound scheduler", ["method"])
+
+_priority: ContextVar[int] = ContextVar("outbound_priority", default=INTERACTIVE)
+
+
+def set_priority(priority: int):
+    """Задает приоритет исходящих запросов текущей задачи (и задач, созданных из нее после вызова)."""
+    _priority.set(priority)
+
+
+class _Bucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now: float) -> float:
+        """Через сколько секунд появится целый токен."""
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class _Lane:
+    """Очередь исходящих запросов одного бота."""
+
+    def __init__(self, now: float):
+        self.bucket = _Bucket(GLOBAL_RATE, GLOBAL_BURST, now)
+        self.chats: OrderedDict[int | str, _Bucket] = OrderedDict()
+        # Массовые запросы ждут по одному, в порядке поступления
+        self.bulk_lock = asyncio.Lock()
+        self.paused_until = 0.0
+        self.waiting = {INTERACTIVE: 0, BULK: 0}
+
+    def chat(self, chat_id, now: float) -> _Bucket:
+        chats = self.chats
+        # Чат, чей bucket успел наполниться, ничем не отличается от нового.
+        # Чистим до поиска, чтобы не выбросить bucket, который сейчас вернем
+        idle_before = now - PER_CHAT_BURST / PER_CHAT_RATE
+        while chats and (len(chats) >= MAX_TRACKED_CHATS or next(iter(chats.values())).updated_at < idle_before):
+            chats.popitem(last=False)
+        bucket = chats.get(chat_id)
+        if bucket is None:
+            bucket = chats[chat_id] = _Bucket(PER_CHAT_RATE, PER_CHAT_BURST, now)
+        else:
+            chats.move_to_end(chat_id)
+        return bucket
+
+    def _wait_time(self, chat: _Bucket | None, priority: int, now: float) -> float:
+        wait = self.paused_until - now
+        if chat is not None:
+            wait = max(wait, chat.wait_time(now))
+        if priority == BULK:
+            wait = max(wait, self.bucket.wait_time(now))
+        return wait
+
+    def _take(self, chat: _Bucket | None, now: float):
+        if chat is not None:
+            chat.tokens -= 1
+        self.bucket.refill(now)
+        self.bucket.tokens = max(self.bucket.tokens - 1, -MAX_DEBT_SECONDS * self.bucket.rate)
+
+    async def _wait_turn(self, chat_id, priority: int):
+        while True:
+            now = time.monotonic()
+            chat = self.chat(chat_id, now) if chat_id is not None else None
+            wait = self._wait_time(chat, priority, now)
+            if wait <= 0:
+                self._take(chat, now)
+                return
+            await asyncio.sleep(wait)
+
+    async def acquire(self, chat_id, priority: int):
+        self.waiting[priority] += 1
+        try:
+            if priority == BULK:
+                async with self.bulk_lock:
+                    await self._wait_turn(chat_id, priority)
+            else:
+                await self._wait_turn(chat_id, priority)
+        finally:
+            self.waiting[priority] -= 1
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Middleware сессии: лимиты и приоритеты исходящих запросов, центральная обработка RetryAfter."""
+
+    def __init__(self):
+        # bot_id -> очередь бота (сессия может быть общей у нескольких ботов)
+        self._lanes: dict[int, _Lane] = {}
+
+    def snapshot(self) -> dict:
+        """Сколько запросов ждет своей очереди, по приоритетам (для мониторинга)."""
+        waiting = {name: 0 for name in PRIORITY_NAMES.values()}
+        for lane in self._lanes.values():
+            for priority, count in lane.waiting.items():
+                waiting[PRIORITY_NAMES[priority]] += count
+        return waiting
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod) -> Response:
+        name = method.__api_method__
+        limited = name.startswith(LIMITED_PREFIXES)
+        lane = self._lanes.get(bot.id)
+        if lane is None:
+            lane = self._lanes[bot.id] = _Lane(time.monotonic())
+        priority = _priority.get()
+        chat_id = getattr(method, "chat_id", None)
+        retries = 0
+        while True:
+            started = time.monotonic()
+            with profiler.phase("api_wait"):
+                if limited:
+                    await lane.acquire(chat_id, priority)
+                elif lane.paused_until > started:
+                    await asyncio.sleep(lane.paused_until - started)
+            WAIT.observe(time.monotonic() - started, PRIORITY_NAMES[priority])
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if retries >= MAX_RETRIES:
+                    raise
+                retries += 1
+                RETRIES.inc(name)
+                # Telegram просит подождать: притормаживаем все запросы бота сразу
+                lane.pause(e.retry_after)
@@ -0,0 +1,223 @@
+"""
+Профилирование по запросу и разбор медленных апдейтов.
+
+Сэмплирующий профайлер (profile()) - отдельный поток, который каждые
+SAMPLE_INTERVAL секунд снимает стеки всех потоков через sys._current_frames(). Код бота
+при этом не инструментируется, поэтому накладные расходы малы, и включать его
+можно прямо на живом боте. Результат - collapsed stacks ("поток;f1;f2 N" на
+строку), их понимают flamegraph.pl и speedscope.app.
+
+Медленные апдейты: SlowUpdateMiddleware засекает время каждого апдейта и
+собирает время по фазам - до хендлера (middleware, фильтры, чтение состояния),
+FSM, db, запросы к Bot API (и ожидание в планировщике outbound), geo-IP.
+Фазы отмечаются через phase() в местах вызова; если фаза уже открыта,
+вложенная не считается отдельно (чтение сессии FSM из базы - это fsm, а не db).
+Апдейт дольше порога пишется в лог с разбивкой.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from config import SLOW_UPDATE_SECONDS
+
+# Как часто снимать стеки, секунды
+SAMPLE_INTERVAL = 0.01
+MAX_PROFILE_SECONDS = 300
+# Глубина стека, дальше которой кадры не разбираются
+MAX_STACK_DEPTH = 128
+
+
+class ProfilerBusy(Exception):
+    """Профайлер уже запущен."""
+
+
+# --- Сэмплирующий профайлер ---
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Поток, который с интервалом interval снимает стеки остальных потоков процесса."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.stacks: Counter[str] = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if frames.keys() - names.keys():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+
+    async def stop(self):
+        self._stop.set()
+        await asyncio.to_thread(self._thread.join)
+
+    def collapsed(self) -> str:
+        """Стеки в формате collapsed: самые частые сверху."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+_running: SamplingProfiler | None = None
+
+
+def is_running() -> bool:
+    return _running is not None
+
+
+async def profile(seconds: float) -> SamplingProfiler:
+    """Сэмплирует все потоки процесса seconds секунд; одновременно работает только один профайлер."""
+    global _running
+    if _running is not None:
+        raise ProfilerBusy("Profiler is already running")
+    profiler = _running = SamplingProfiler()
+    try:
+        profiler.start()
+        await asyncio.sleep(min(seconds, MAX_PROFILE_SECONDS))
+    finally:
+        await profiler.stop()
+        _running = None
+    return profiler
+
+
+# --- Медленные апдейты ---
+
+class UpdateTiming:
+    """Время одного апдейта по фазам."""
+    __slots__ = ("task", "started", "handler", "dispatch", "phases", "counts", "open")
+
+    def __init__(self):
+        # Фоновые задачи, запущенные из хендлера, наследуют контекст; их время к апдейту не относится
+        self.task = asyncio.current_task()
+        self.started = time.perf_counter()
+        self.handler = None
+        # Время до вызова хендлера за вычетом отмеченных фаз
+        self.dispatch = 0.0
+        self.phases: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.open = False
+
+    def add(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+
+_timing: ContextVar[UpdateTiming | None] = ContextVar("update_timing", default=None)
+
+
+@contextmanager
+def phase(name: str):
+    """Отмечает фазу обработки текущего апдейта (вне апдейта ничего не делает)."""
+    timing = _timing.get()
+    if timing is None or timing.open or timing.task is not asyncio.current_task():
+        yield
+        return
+    timing.open = True
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.open = False
+        timing.add(name, time.perf_counter() - started)
+
+
+def _format_ms(seconds: float) -> str:
+    return f"{seconds * 1000:.1f} ms"
+
+
+def format_timing(timing: UpdateTiming, total: float) -> str:
+    parts = [f"dispatch {_format_ms(timing.dispatch)}"]
+    for name, seconds in timing.phases.items():
+        parts.append(f"{name} {_format_ms(seconds)} x{timing.counts[name]}")
+    other = total - timing.dispatch - sum(timing.phases.values())
+    parts.append(f"other {_format_ms(max(other, 0.0))}")
+    return ", ".join(parts)
+
+
+class SlowUpdateMiddleware(BaseMiddleware):
+    """Outer middleware апдейта: пишет в лог апдейты дольше threshold с разбивкой по фазам."""
+
+    def __init__(self, threshold: float = SLOW_UPDATE_SECONDS):
+        self.threshold = threshold
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        timing = UpdateTiming()
+        token = _timing.set(timing)
+        try:
+            return await handler(event, data)
+        finally:
+            _timing.reset(token)
+            total = time.perf_counter() - timing.started
+            if total >= self.threshold:
+                logging.warning(
+                    f"Slow update {event.update_id} ({event.event_type}, handler {timing.handler or '-'}): "
+                    f"{_format_ms(total)} total; {format_timing(timing, total)}"
+                )
+
+
+class _HandlerStartMiddleware(BaseMiddleware):
+    """Inner middleware: отмечает, какой хендлер сработал и сколько ушло на путь до него."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        timing = _timing.get()
+        if timing is not None:
+            timing.handler = data["handler"].callback.__name__
+            timing.dispatch = time.perf_counter() - timing.started - sum(timing.phases.values())
+        return await handler(event, data)
+
+
+def setup(dispatcher, threshold: float = SLOW_UPDATE_SECONDS):
+    """Подключает замер медленных апдейтов к диспетчеру (threshold <= 0 - выключено)."""
+    if threshold <= 0:
+        return
+    # Встроенные middleware aiogram (ошибки, контекст пользователя, FSM) уже
+    # подключены; ставим замер перед ними, чтобы чтение состояния FSM попало в апдейт
+    builtin = list(dispatcher.update.outer_middleware)
+    for middleware in builtin:
+        dispatcher.update.outer_middleware.unregister(middleware)
+    dispatcher.update.outer_middleware(SlowUpdateMiddleware(threshold))
+    for middleware in builtin:
+        dispatcher.update.outer_middleware(middleware)
+    for name, observer in dispatcher.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(_HandlerStartMiddleware())
@@ -0,0 +1,157 @@
+"""
+Запись входящих вебхуков для воспроизведения нагрузки (benchmarks/replay.py).
+
+Тело каждого принятого вебхука пишется как есть, без разбора JSON, вместе со
+временем прихода и ID бота. Записи копятся в памяти, и раз в FLUSH_INTERVAL
+секунд пачка сжимается и дописывается в конец файла-сегмента в отдельном
+потоке. Сегмент - один gzip-поток, его можно смотреть обычным zcat. После
+каждой пачки поток сбрасывается (Z_SYNC_FLUSH), поэтому при падении процесса
+теряется только последняя пачка, а сегмент остается читаемым. Когда сегмент
+дорастает до segment_bytes, начинается следующий.
+
+Формат записи: заголовок RECORD_HEADER (время прихода unix, bot_id, длина
+тела), затем тело.
+"""
+import asyncio
+import logging
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+from aiohttp import web
+
+import metrics
+
+RECORD_HEADER = struct.Struct("<dqI")
+SEGMENT_SUFFIX = ".updates.gz"
+FLUSH_INTERVAL = 1.0
+COMPRESS_LEVEL = 6
+# gzip-обертка потока zlib
+GZIP_WBITS = 31
+READ_CHUNK_SIZE = 1024 * 1024
+
+RECORDED = metrics.Counter("bot_recorder_updates_total", "Webhook updates written by the recorder", ["bot_id"])
+WRITTEN = metrics.Counter("bot_recorder_bytes_total", "Compressed bytes written by the recorder")
+
+
+class _Segment:
+    """Открытый сегмент; вызывается только из потока записи."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "ab")
+        self._compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+        self.size = 0
+
+    def write(self, records: list[bytes]):
+        data = self._compressor.compress(b"".join(records)) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self._file.write(data)
+        self._file.flush()
+        self.size += len(data)
+        WRITTEN.inc(amount=len(data))
+
+    def close(self):
+        data = self._compressor.flush(zlib.Z_FINISH)
+        self._file.write(data)
+        self._file.close()
+        WRITTEN.inc(amount=len(data))
+
+
+class UpdateRecorder:
+    """Пишет тела вебхуков с путей paths (путь -> bot_id) в сегменты в каталоге directory."""
+
+    def __init__(self, directory: str, paths: dict[str, int], segment_bytes: int):
+        self.directory = directory
+        self.paths = paths
+        self.segment_bytes = segment_bytes
+        self._buffer: list[bytes] = []
+        self._segment: _Segment | None = None
+        self._segments = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recorder")
+        self._flusher: asyncio.Task | None = None
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        bot_id = self.paths.get(request.path)
+        if bot_id is None or request.method != "POST":
+            return await handler(request)
+        arrived_at = time.time()
+        # aiohttp кэширует тело, обработчик вебхука прочитает его еще раз без затрат
+        body = await request.read()
+        response = await handler(request)
+        # Отклоненный апдейт (401, 503) Telegram пришлет снова - тогда и запишем
+        if response.status == 200:
+            self._buffer.append(RECORD_HEADER.pack(arrived_at, bot_id, len(body)) + body)
+            RECORDED.inc(str(bot_id))
+        return response
+
+    def _write(self, records: list[bytes]):
+        if self._segment is None:
+            # Имена сортируются в порядке записи: время начала и номер сегмента с запуска процесса
+            self._segments += 1
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{self._segments:04d}"
+            self._segment = _Segment(os.path.join(self.directory, name + SEGMENT_SUFFIX))
+            logging.info(f"Recording webhook updates to {self._segment.path}")
+        self._segment.write(records)
+        if self._segment.size >= self.segment_bytes:
+            self._close_segment()
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    async def flush(self):
+        """Дописывает накопленные записи в текущий сегмент."""
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._write, batch)
+        except OSError:
+            logging.exception(f"Could not record {len(batch)} webhook updates")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self.flush()
+
+    def start(self):
+        """Запускает фоновую запись."""
+        os.makedirs(self.directory, exist_ok=True)
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает запись, дописывает остаток и закрывает сегмент."""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close_segment)
+
+
+def read_segment(path: str) -> Iterator[tuple[float, int, bytes]]:
+    """Записи сегмента: (время прихода, bot_id, тело). Недописанный хвост пропускается."""
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    pending = b""
+    with open(path, "rb") as f:
+        while chunk := f.read(READ_CHUNK_SIZE):
+            try:
+                pending += decompressor.decompress(chunk)
+            except zlib.error:
+                logging.warning(f"{path}: corrupted data, stopping at this point")
+                break
+            offset = 0
+            while len(pending) - offset >= RECORD_HEADER.size:
+                arrived_at, bot_id, length = RECORD_HEADER.unpack_from(pending, offset)
+                end = offset + RECORD_HEADER.size + length
+                if end > len(pending):
+                    break
+                yield arrived_at, bot_id, pending[offset + RECORD_HEADER.size:end]
+                offset = end
+            pending = pending[offset:]
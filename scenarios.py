@@ -0,0 +1,195 @@
+"""
+Сценарии воронки из файла config.SCENARIOS_FILE с заменой на лету.
+
+Файл разбирается, проверяется и собирается в неизменяемые объекты Scenario,
+где для каждого шага заранее готовы текст и клавиатура. Набор сценариев
+(Registry) помечается версией - хешем содержимого файла, поэтому у всех
+воркеров одна и та же версия для одного и того же файла.
+
+Новый набор подменяет текущий одним присваиванием: хендлер, который уже
+взял сценарий, дорабатывает со старым объектом. Пользователь, начавший
+воронку, хранит версию в данных FSM и проходит ее до конца на тех текстах,
+с которых начал. Прошлые версии держатся в памяти (последние
+SCENARIO_HISTORY); если версии уже нет (например, после перезапуска),
+берется сценарий из текущей.
+
+Перечитать файл можно командой админа (reload()) или фоновой проверкой
+времени изменения файла (start_watcher()). Если новый файл некорректен,
+остается прежняя версия.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping
+
+from aiogram.types import InlineKeyboardMarkup
+
+from config import SCENARIOS_FILE, SCENARIOS_CHECK_INTERVAL
+import keyboards as kb
+
+DEFAULT_SCENARIO = "DEFAULT"
+STEP_KEYS = ("step1", "step2", "step3", "step4")
+# Ограничения Telegram на длину текста сообщения и кнопки
+MAX_TEXT_LENGTH = 4096
+MAX_BUTTON_LENGTH = 64
+# Сколько прошлых версий помнить для пользователей, которые еще идут по воронке
+SCENARIO_HISTORY = 20
+
+
+class ScenarioError(ValueError):
+    """Файл сценариев не прошел проверку."""
+
+
+@dataclass(frozen=True, slots=True)
+class Step:
+    text: str
+    reply_markup: InlineKeyboardMarkup
+
+
+@dataclass(frozen=True, slots=True)
+class Scenario:
+    key: str
+    lang: str
+    currency: str
+    final_button: str
+    steps: tuple[Step, ...]
+
+
+@dataclass(frozen=True, slots=True)
+class Registry:
+    version: str
+    scenarios: Mapping[str, Scenario]
+
+
+def _require_text(raw: dict, field: str, where: str, max_length: int) -> str:
+    value = raw.get(field)
+    if not isinstance(value, str) or not value.strip():
+        raise ScenarioError(f"{where}: '{field}' must be a non-empty string")
+    if len(value) > max_length:
+        raise ScenarioError(f"{where}: '{field}' is longer than {max_length} characters")
+    return value
+
+
+def compile_scenario(key: str, raw: dict) -> Scenario:
+    """Проверяет и собирает один сценарий из словаря в формате файла сценариев."""
+    if not isinstance(raw, dict) or not isinstance(raw.get("texts"), dict):
+        raise ScenarioError(f"Scenario {key}: expected an object with 'lang', 'currency' and 'texts'")
+    texts = raw["texts"]
+    where = f"Scenario {key}"
+    lang = _require_text(raw, "lang", where, MAX_BUTTON_LENGTH)
+    currency = _require_text(raw, "currency", where, MAX_BUTTON_LENGTH)
+    final_button = _require_text(texts, "final_button", where, MAX_BUTTON_LENGTH)
+    step_texts = [_require_text(texts, step_key, where, MAX_TEXT_LENGTH) for step_key in STEP_KEYS]
+    # Кнопка "Next" знает, на каком шаге стоит: нажатие на уже пройденном шаге отбрасывается
+    steps = [Step(text, kb.get_next_keyboard(number)) for number, text in enumerate(step_texts[:-1], start=1)]
+    # Последний шаг ведет на финальную кнопку вместо "Next"
+    steps.append(Step(step_texts[-1], kb.get_final_keyboard(final_button)))
+    return Scenario(key, lang, currency, final_button, tuple(steps))
+
+
+def compile_scenarios(raw_scenarios: dict, version: str) -> Registry:
+    """Собирает все сценарии; сценарий DEFAULT обязателен."""
+    if not isinstance(raw_scenarios, dict):
+        raise ScenarioError("Scenarios file must contain an object keyed by country code")
+    if DEFAULT_SCENARIO not in raw_scenarios:
+        raise ScenarioError(f"Scenario {DEFAULT_SCENARIO} is required")
+    for key in raw_scenarios:
+        if key != DEFAULT_SCENARIO and not (len(key) == 2 and key.isupper()):
+            raise ScenarioError(f"Scenario key {key!r} is not a two-letter country code")
+    compiled = {key: compile_scenario(key, raw) for key, raw in raw_scenarios.items()}
+    return Registry(version, MappingProxyType(compiled))
+
+
+def read_file(path: str = SCENARIOS_FILE) -> tuple[dict, str]:
+    """Читает файл сценариев; возвращает (словарь сценариев, версия)."""
+    with open(path, "rb") as f:
+        content = f.read()
+    try:
+        raw = json.loads(content)
+    except ValueError as e:
+        raise ScenarioError(f"{path}: {e}") from e
+    return raw, hashlib.sha256(content).hexdigest()[:12]
+
+
+def load(path: str = SCENARIOS_FILE) -> Registry:
+    """Читает и собирает сценарии из файла, ничего не подменяя."""
+    return compile_scenarios(*read_file(path))
+
+
+_current: Registry = load()
+_history: OrderedDict[str, Registry] = OrderedDict({_current.version: _current})
+_mtime = os.stat(SCENARIOS_FILE).st_mtime_ns
+_watcher: asyncio.Task | None = None
+
+
+def current() -> Registry:
+    """Действующий набор сценариев."""
+    return _current
+
+
+def activate(registry: Registry) -> bool:
+    """Делает набор сценариев действующим; False, если эта версия уже действует."""
+    global _current
+    if registry.version == _current.version:
+        return False
+    _history[registry.version] = registry
+    _history.move_to_end(registry.version)
+    while len(_history) > SCENARIO_HISTORY:
+        _history.popitem(last=False)
+    _current = registry
+    logging.info(f"Scenarios version {registry.version} is active ({len(registry.scenarios)} scenarios)")
+    return True
+
+
+def reload(path: str = SCENARIOS_FILE) -> tuple[Registry, bool]:
+    """Перечитывает файл; возвращает (действующий набор, изменилась ли версия). При ошибке бросает ScenarioError."""
+    global _mtime
+    # Запоминаем время изменения и для некорректного файла, чтобы не разбирать его на каждой проверке
+    _mtime = os.stat(path).st_mtime_ns
+    changed = activate(load(path))
+    return _current, changed
+
+
+def key_for_country(country_code: str) -> str:
+    """Ключ сценария для страны в действующей версии (DEFAULT, если отдельного сценария нет)."""
+    return country_code if country_code in _current.scenarios else DEFAULT_SCENARIO
+
+
+def get(key: str, version: str | None = None) -> Scenario:
+    """Готовый сценарий по ключу из указанной версии (по умолчанию - из действующей)."""
+    scenario = _history.get(version, _current).scenarios.get(key)
+    if scenario is None:
+        # Версия забыта, а в действующей такого сценария уже нет
+        scenario = _current.scenarios[key_for_country(key)]
+    return scenario
+
+
+async def _watch(path: str, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if os.stat(path).st_mtime_ns != _mtime:
+                reload(path)
+        except (OSError, ScenarioError) as e:
+            logging.error(f"Could not reload scenarios from {path}: {e}")
+
+
+def start_watcher(path: str = SCENARIOS_FILE, interval: float = SCENARIOS_CHECK_INTERVAL):
+    """Запускает фоновую проверку файла сценариев на изменения."""
+    global _watcher
+    if _watcher is None and interval > 0:
+        _watcher = asyncio.create_task(_watch(path, interval))
+
+
+async def stop_watcher():
+    """Останавливает проверку файла сценариев."""
+    global _watcher
+    if _watcher is not None:
+        _watcher.cancel()
+        await asyncio.gather(_watcher, return_exceptions=True)
+        _watcher = None
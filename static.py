@@ -0,0 +1,159 @@
+"""
+Раздача статики Web App из памяти с заранее сжатыми вариантами.
+
+При запуске каждый файл каталога читается один раз: считается хеш
+содержимого и готовятся gzip- и br-варианты,
+которые оставляются, только если они меньше исходника. Ответ выбирается по
+Accept-Encoding, ETag строится из хеша, и повторный запрос с If-None-Match
+получает 304 без тела.
+
+Ссылки вида /web_app/index.html?v=<хеш> (см. url()) не меняются, пока не
+изменится файл, поэтому отдаются с immutable и кешируются клиентом на год.
+Запросы без версии или со старой версией получают no-cache и
+перепроверяются по ETag.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+from dataclasses import dataclass
+
+import brotli
+from aiohttp import web
+
+WEBAPP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web_app')
+WEBAPP_PATH = "/web_app"
+# Расширения, которые имеет смысл сжимать
+COMPRESSIBLE = {".html", ".js", ".css", ".json", ".svg", ".txt", ".map"}
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+
+@dataclass(frozen=True, slots=True)
+class Asset:
+    content_type: str
+    version: str
+    # кодировка ("identity", "gzip", "br") -> тело
+    bodies: dict
+    mtime_ns: int
+
+
+def _content_type(name: str) -> str:
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    if content_type.startswith("text/") or content_type in ("application/javascript", "application/json"):
+        content_type += "; charset=utf-8"
+    return content_type
+
+
+def _build_asset(path: str) -> Asset:
+    with open(path, "rb") as f:
+        body = f.read()
+    bodies = {"identity": body}
+    if os.path.splitext(path)[1].lower() in COMPRESSIBLE:
+        # mtime=0, чтобы сжатый вариант (и его размер) не зависел от момента запуска
+        variants = {
+            "gzip": gzip.compress(body, compresslevel=9, mtime=0),
+            "br": brotli.compress(body, quality=11),
+        }
+        bodies.update((encoding, data) for encoding, data in variants.items() if len(data) < len(body))
+    return Asset(_content_type(path), hashlib.sha256(body).hexdigest()[:16], bodies, os.stat(path).st_mtime_ns)
+
+
+def _accepted_encodings(header: str) -> set[str]:
+    accepted = set()
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+def _etag_matches(header: str, version: str) -> bool:
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        # Прокси могут ослабить ETag (W/) при пересжатии; сравниваем только хеш
+        if tag.removeprefix("W/").strip('"').split("-")[0] == version:
+            return True
+    return False
+
+
+class StaticAssets:
+    """Файлы каталога directory в памяти с маршрутом prefix/<имя>."""
+
+    def __init__(self, directory: str, prefix: str, headers: dict | None = None, reload: bool = False):
+        self.directory = directory
+        self.prefix = prefix.rstrip("/")
+        self.headers = headers or {}
+        # Для локальной отладки: пересобирать файл, если он изменился на диске
+        self.reload = reload
+        self._assets: dict[str, Asset] = {}
+        self.load()
+
+    def load(self):
+        """Читает и сжимает все файлы каталога (кроме .py и скрытых)."""
+        assets = {}
+        for root, dirs, files in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if not d.startswith((".", "__"))]
+            for filename in files:
+                if filename.startswith(".") or filename.endswith((".py", ".pyc")):
+                    continue
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                assets[name] = _build_asset(path)
+        self._assets = assets
+
+    def version(self, name: str) -> str:
+        return self._assets[name].version
+
+    def url(self, name: str) -> str:
+        """Путь к файлу с версией; по нему файл кешируется навсегда."""
+        return f"{self.prefix}/{name}?v={self.version(name)}"
+
+    def _get(self, name: str) -> Asset | None:
+        asset = self._assets.get(name)
+        if asset is not None and self.reload:
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime_ns != asset.mtime_ns:
+                    asset = self._assets[name] = _build_asset(path)
+            except FileNotFoundError:
+                del self._assets[name]
+                return None
+        return asset
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        asset = self._get(request.match_info["name"])
+        if asset is None:
+            raise web.HTTPNotFound()
+
+        accepted = _accepted_encodings(request.headers.get("Accept-Encoding", ""))
+        encoding = next((e for e in ("br", "gzip") if e in asset.bodies and e in accepted), "identity")
+        immutable = request.query.get("v") == asset.version
+        headers = {
+            **self.headers,
+            "Cache-Control": IMMUTABLE_CACHE if immutable else REVALIDATE_CACHE,
+            "ETag": f'"{asset.version}"' if encoding == "identity" else f'"{asset.version}-{encoding}"',
+            "Vary": "Accept-Encoding",
+        }
+        if _etag_matches(request.headers.get("If-None-Match", ""), asset.version):
+            return web.Response(status=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        headers["Content-Type"] = asset.content_type
+        return web.Response(body=asset.bodies[encoding], headers=headers)
+
+    def register(self, app: web.Application):
+        """Добавляет маршрут GET/HEAD prefix/<имя> в приложение."""
+        app.router.add_get(f"{self.prefix}/{{name:.+}}", self.handle)
+
+
+# Страница проверки геолокации; собирается при импорте, чтобы keyboards мог взять версию для ссылки
+web_app = StaticAssets(WEBAPP_DIR, WEBAPP_PATH)
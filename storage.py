@@ -0,0 +1,175 @@
+"""
+FSM-хранилище aiogram поверх SQLite.
+
+Состояния живут в памяти процесса и пишутся в таблицу fsm_sessions
+с задержкой (write-behind): все изменения за FLUSH_INTERVAL секунд уходят
+в базу одной транзакцией. После перезапуска сессии подгружаются из базы
+по мере обращения. Сессии, которые не менялись дольше session_ttl
+(брошенные воронки), удаляются и из памяти, и из базы.
+
+При запуске нескольких воркеров включайте write_behind=False: тогда каждое
+изменение пишется сразу, а чтение всегда идет из базы, потому что следующий
+апдейт пользователя может прийти в другой процесс.
+"""
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+import db
+import profiler
+
+# Как часто сбрасывать изменения в базу, секунды
+FLUSH_INTERVAL = 1.0
+# Через сколько секунд без изменений сессия считается брошенной
+SESSION_TTL = 24 * 60 * 60
+# Сколько секунд держать в памяти сессию, которую никто не менял (в базе она остается)
+CACHE_IDLE_TTL = 30 * 60
+# Как часто искать и удалять брошенные сессии
+EVICT_INTERVAL = 5 * 60
+
+
+class _Session:
+    __slots__ = ('state', 'data', 'touched_at')
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any], touched_at: float):
+        self.state = state
+        self.data = data
+        self.touched_at = touched_at
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в SQLite с кешем в памяти и удалением брошенных сессий."""
+
+    def __init__(self, session_ttl: float = SESSION_TTL, cache_idle_ttl: float = CACHE_IDLE_TTL, write_behind: bool = True):
+        self.session_ttl = session_ttl
+        self.cache_idle_ttl = cache_idle_ttl
+        self.write_behind = write_behind
+        self._key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self._sessions: dict[StorageKey, _Session] = {}
+        self._dirty: set[StorageKey] = set()
+        # Ключи сессий, которые есть в базе: промах кеша для нового пользователя не идет в SQLite
+        self._persisted: set[str] = set()
+        self._tasks: list[asyncio.Task] = []
+
+    # Не __len__: пустое хранилище стало бы ложным, и Dispatcher(storage=...)
+    # молча заменил бы его на MemoryStorage (storage or MemoryStorage())
+    def session_count(self) -> int:
+        """Число сессий в памяти."""
+        return len(self._sessions)
+
+    async def start(self):
+        """Загружает список сохраненных сессий и запускает фоновую запись и очистку."""
+        if self.write_behind:
+            self._persisted = set(await db.get_fsm_session_keys())
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._flush_loop()), asyncio.create_task(self._evict_loop())]
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+
+    async def _get_session(self, key: StorageKey) -> _Session:
+        session = self._sessions.get(key)
+        if session is not None and self.write_behind:
+            return session
+        storage_key = self._key_builder.build(key)
+        row = None
+        if not self.write_behind or storage_key in self._persisted:
+            row = await db.load_fsm_session(storage_key)
+        if row is None:
+            session = _Session(None, {}, time.time())
+        else:
+            state, data, updated_at = row
+            session = _Session(state, json.loads(data) if data else {}, updated_at)
+        self._sessions[key] = session
+        return session
+
+    async def _changed(self, key: StorageKey, session: _Session):
+        session.touched_at = time.time()
+        self._sessions[key] = session
+        if self.write_behind:
+            self._dirty.add(key)
+        else:
+            await db.save_fsm_sessions(*self._prepare_rows([key]))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        with profiler.phase("fsm"):
+            session = await self._get_session(key)
+            session.state = state.state if isinstance(state, State) else state
+            await self._changed(key, session)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        with profiler.phase("fsm"):
+            return (await self._get_session(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        with profiler.phase("fsm"):
+            session = await self._get_session(key)
+            session.data = data.copy()
+            await self._changed(key, session)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        with profiler.phase("fsm"):
+            return (await self._get_session(key)).data.copy()
+
+    def _prepare_rows(self, keys):
+        upserts, deletes = [], []
+        for key in keys:
+            storage_key = self._key_builder.build(key)
+            session = self._sessions.get(key)
+            if session is None or (session.state is None and not session.data):
+                # Пустая сессия (после state.clear()) в базе не нужна
+                if storage_key in self._persisted or not self.write_behind:
+                    deletes.append(storage_key)
+                self._persisted.discard(storage_key)
+            else:
+                data = json.dumps(session.data, ensure_ascii=False, separators=(',', ':')) if session.data else None
+                upserts.append((storage_key, session.state, data, session.touched_at))
+                self._persisted.add(storage_key)
+        return upserts, deletes
+
+    async def flush(self):
+        """Записывает в базу все измененные сессии одной транзакцией."""
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        try:
+            await db.save_fsm_sessions(*self._prepare_rows(keys))
+        except Exception:
+            # Вернем ключи, чтобы попробовать еще раз при следующем сбросе
+            self._dirty |= keys
+            logging.exception("Could not save FSM sessions")
+
+    async def evict(self):
+        """Выгружает из памяти давно не менявшиеся сессии и удаляет из базы брошенные."""
+        now = time.time()
+        idle_before = now - self.cache_idle_ttl
+        for key in [k for k, s in self._sessions.items() if s.touched_at < idle_before]:
+            if key not in self._dirty:
+                del self._sessions[key]
+        expired_before = now - self.session_ttl
+        removed = await db.delete_expired_fsm_sessions(expired_before)
+        self._persisted.difference_update(removed)
+        if removed:
+            logging.info(f"Evicted {len(removed)} abandoned FSM sessions")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self.flush()
+
+    async def _evict_loop(self):
+        while True:
+            await asyncio.sleep(EVICT_INTERVAL)
+            try:
+                await self.evict()
+            except Exception:
+                logging.exception("Could not evict FSM sessions")
@@ -0,0 +1,51 @@
+import asyncio
+
+from aiogram.types import CallbackQuery, User
+
+from antiflood import AntiFloodMiddleware
+
+USER = User(id=1, is_bot=False, first_name="Test")
+
+
+def _tap(data: str) -> CallbackQuery:
+    return CallbackQuery(id="1", from_user=USER, chat_instance="1", inline_message_id="m1", data=data)
+
+
+def _run(middleware: AntiFloodMiddleware, data: str, handled: list) -> list:
+    answered = []
+
+    async def handler(event, _):
+        handled.append(event.data)
+
+    async def answer(*args, **kwargs):
+        answered.append(True)
+
+    event = _tap(data)
+    object.__setattr__(event, "answer", answer)
+    asyncio.run(middleware(handler, event, {"event_from_user": USER}))
+    return answered
+
+
+def test_repeated_tap_is_dropped_and_answered():
+    middleware = AntiFloodMiddleware()
+    handled = []
+    _run(middleware, "next_step:1", handled)
+    assert _run(middleware, "next_step:1", handled) == [True]
+    assert handled == ["next_step:1"]
+
+
+def test_next_step_on_same_message_passes():
+    # Кнопка следующего шага на том же сообщении - другие данные, а не дубль
+    middleware = AntiFloodMiddleware()
+    handled = []
+    _run(middleware, "next_step:1", handled)
+    _run(middleware, "next_step:2", handled)
+    assert handled == ["next_step:1", "next_step:2"]
+
+
+def test_throttled_tap_is_answered():
+    middleware = AntiFloodMiddleware(rate=0.001, burst=1)
+    handled = []
+    _run(middleware, "next_step:1", handled)
+    assert _run(middleware, "next_step:2", handled) == [True]
+    assert handled == ["next_step:1"]
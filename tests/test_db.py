@@ -0,0 +1,27 @@
+import asyncio
+
+import db
+
+
+def test_grouped_writes_share_one_transaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_NAME", str(tmp_path / "test.db"))
+    statements = []
+
+    def _trace(cursor):
+        cursor.connection.set_trace_callback(statements.append)
+
+    async def run():
+        await db.init_db()
+        try:
+            await db._write(_trace)
+            statements.clear()
+            await asyncio.gather(*(db.add_or_update_user(user_id, f"user{user_id}", "DE", 1) for user_id in range(5)))
+        finally:
+            await db.close_db()
+
+    asyncio.run(run())
+    # Пять записей одной пачкой: один BEGIN и один COMMIT на всех
+    commands = [sql.split()[0].upper() for sql in statements]
+    assert commands.count("SAVEPOINT") == 5
+    assert commands.count("BEGIN") == 1
+    assert commands.count("COMMIT") == 1
@@ -0,0 +1,25 @@
+import pytest
+
+import geo
+
+
+@pytest.mark.parametrize("lat, lon, country", [
+    # Острова и мелкие государства, которых нет в границах 1:110m
+    (39.57, 2.65, "ES"),  # Пальма
+    (38.91, 1.43, "ES"),  # Ибица
+    (28.29, -16.63, "ES"),  # Тенерифе
+    (28.12, -15.43, "ES"),  # Лас-Пальмас
+    (48.43, -123.37, "CA"),  # Виктория
+    (1.29, 103.85, "SG"),
+    (43.74, 7.42, "MC"),
+    # Внутри крупных стран работают границы
+    (52.52, 13.40, "DE"),
+    (40.42, -3.70, "ES"),
+    (-16.5, 179.99, "FJ"),
+])
+def test_resolve_country(lat, lon, country):
+    assert geo.resolve_country(lat, lon) == country
+
+
+def test_open_ocean_is_unknown():
+    assert geo.resolve_country(30.0, -40.0) is None
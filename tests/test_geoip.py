@@ -0,0 +1,43 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import geoip
+from geoip import CircuitBreaker
+
+
+def _open_breaker(monkeypatch, clock: list) -> CircuitBreaker:
+    monkeypatch.setattr(geoip, "time", SimpleNamespace(monotonic=lambda: clock[0]))
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.allow()
+    clock[0] += 30
+    return breaker
+
+
+def test_half_open_admits_one_probe(monkeypatch):
+    clock = [100.0]
+    breaker = _open_breaker(monkeypatch, clock)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_probe_reopens(monkeypatch):
+    clock = [100.0]
+    breaker = _open_breaker(monkeypatch, clock)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    clock[0] += 30
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_lookup_requires_client_ip():
+    # Без IP ipinfo вернул бы страну сервера бота
+    with pytest.raises(ValueError):
+        asyncio.run(geoip.GeoIPClient(token=None).lookup(None))
@@ -0,0 +1,42 @@
+import asyncio
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import outbound
+from benchmarks.mock_bot_api import MockBotAPI
+
+
+class _Clock:
+    """time.monotonic, который можно перевести вперед, не дожидаясь на самом деле."""
+
+    def __init__(self):
+        self.offset = 0.0
+
+    def monotonic(self) -> float:
+        return time.monotonic() + self.offset
+
+
+def test_message_to_same_chat_after_pause(monkeypatch):
+    # Пауза дольше, чем наполняется bucket чата: он устаревает и не должен выбросить сам себя
+    clock = _Clock()
+    monkeypatch.setattr(outbound, "time", clock)
+
+    async def run():
+        api = MockBotAPI()
+        api_url = await api.start()
+        session = AiohttpSession(api=TelegramAPIServer.from_base(api_url))
+        session.middleware(outbound.OutboundScheduler())
+        bot = Bot("42:TEST", session=session)
+        try:
+            await bot.send_message(42, "first")
+            clock.offset += 4
+            await bot.send_message(42, "second")
+        finally:
+            await session.close()
+            await api.stop()
+        return api.calls["sendmessage"]
+
+    assert asyncio.run(run()) == 2
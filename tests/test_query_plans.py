@@ -0,0 +1,59 @@
+import sqlite3
+
+import pytest
+
+import db
+import migrations
+from benchmarks.query_plans import check_query, find_queries, partial_indexes
+
+# Осознанные полные проходы: (функция db.py, таблица) -> причина.
+# Новый полный проход добавляется сюда только после ревью плана запроса
+ALLOWED_FULL_SCANS = {
+    ("_assign_legacy_bot", "users"): "строки без бота есть только после миграции 4, запрос выполняется при запуске",
+    ("_assign_legacy_bot", "broadcast_jobs"): "строка на рассылку, запрос выполняется при запуске",
+    ("_load_affiliate_links", "affiliate_links"): "строка на страну и бота, таблица целиком загружается в кеш",
+    ("_get_stats", "stats_countries"): "строка на страну",
+    ("_get_stats", "stats_archived"): "строка на страну",
+    ("_get_funnel_report", "stats_countries"): "строка на страну",
+    ("_export_all_users", "users"): "выгрузка без страны читает всех пользователей, фильтр по дате регистрации проверяется для каждой строки",
+    ("_export_all_users", "users_archive"): "то же для архива, он выгружается следом за users",
+    ("_export_clicks", "funnel_events"): "выгрузка читает все клики, подходящие под фильтр",
+    ("_get_fsm_session_keys", "fsm_sessions"): "ключи всех сессий читаются один раз при запуске",
+    ("_get_unfinished_broadcast_jobs", "broadcast_jobs"): "строка на рассылку, запрос выполняется при запуске",
+}
+
+QUERIES, DYNAMIC = find_queries(db)
+
+
+@pytest.fixture(scope="module")
+def conn():
+    conn = sqlite3.connect(":memory:")
+    migrations.migrate(conn.cursor())
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def _allowed(function: str) -> set[str]:
+    return {table for allowed_function, table in ALLOWED_FULL_SCANS if allowed_function == function}
+
+
+def test_all_queries_are_checked():
+    assert QUERIES
+    assert not DYNAMIC, f"queries built at runtime cannot be checked, db.py lines {DYNAMIC}"
+
+
+@pytest.mark.parametrize("lineno, function, sql", QUERIES, ids=[f"{function}:{lineno}" for lineno, function, _ in QUERIES])
+def test_no_full_scans(conn, lineno, function, sql):
+    assert check_query(conn, sql, partial_indexes(conn), _allowed(function)) == []
+
+
+def test_allowed_full_scans_are_used(conn):
+    # Запись, которой больше нечего разрешать, удаляется вместе с полным проходом
+    partial = partial_indexes(conn)
+    used = set()
+    for _, function, sql in QUERIES:
+        for table in _allowed(function):
+            if check_query(conn, sql, partial, _allowed(function) - {table}):
+                used.add((function, table))
+    assert set(ALLOWED_FULL_SCANS) - used == set()
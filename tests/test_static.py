@@ -0,0 +1,23 @@
+import asyncio
+
+import brotli
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import static
+
+
+def test_web_app_is_served_with_brotli():
+    async def run():
+        app = web.Application()
+        static.web_app.register(app)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get(
+                static.web_app.url("index.html"), headers={"Accept-Encoding": "gzip, br"}, auto_decompress=False
+            )
+            return response.headers.get("Content-Encoding"), await response.read()
+
+    encoding, body = asyncio.run(run())
+    assert encoding == "br"
+    with open(f"{static.WEBAPP_DIR}/index.html", "rb") as f:
+        assert brotli.decompress(body) == f.read()
@@ -0,0 +1,10 @@
+from aiogram import Dispatcher
+
+from storage import SQLiteStorage
+
+
+def test_dispatcher_keeps_empty_sqlite_storage():
+    # Пустое хранилище не должно быть ложным: иначе Dispatcher молча подставит MemoryStorage
+    storage = SQLiteStorage()
+    dp = Dispatcher(storage=storage)
+    assert dp.storage is storage
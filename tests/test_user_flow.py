@@ -0,0 +1,62 @@
+import asyncio
+from datetime import datetime
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import CallbackQuery, Chat, Message, User
+
+import scenarios
+from handlers.user_flow import UserFlow, go_to_next_step
+
+USER = User(id=1, is_bot=False, first_name="Test")
+
+
+def _tap(data: str, calls: list) -> CallbackQuery:
+    message = Message(message_id=10, date=datetime.now(), chat=Chat(id=1, type="private"), text="step")
+
+    async def edit_text(*args, **kwargs):
+        calls.append("edit_text")
+
+    async def answer(*args, **kwargs):
+        calls.append("answer")
+
+    object.__setattr__(message, "edit_text", edit_text)
+    callback = CallbackQuery(id="1", from_user=USER, chat_instance="1", message=message, data=data)
+    object.__setattr__(callback, "answer", answer)
+    return callback
+
+
+def _state(step) -> FSMContext:
+    state = FSMContext(MemoryStorage(), StorageKey(bot_id=1, chat_id=1, user_id=1))
+
+    async def setup():
+        await state.set_state(step)
+        await state.update_data(scenario=scenarios.DEFAULT_SCENARIO, scenario_version=None, country="DE")
+
+    asyncio.run(setup())
+    return state
+
+
+def test_next_step_button_carries_its_step():
+    steps = scenarios.current().scenarios[scenarios.DEFAULT_SCENARIO].steps
+    assert [step.reply_markup.inline_keyboard[0][0].callback_data for step in steps[:-1]] == [
+        "next_step:1", "next_step:2", "next_step:3",
+    ]
+
+
+def test_stale_tap_on_advanced_message_is_dropped():
+    # Второе нажатие двойного тапа: воронка уже на шаге 2, а кнопка - с шага 1
+    state = _state(UserFlow.step_2)
+    calls = []
+    asyncio.run(go_to_next_step(_tap("next_step:1", calls), state, UserFlow.step_2.state))
+    assert calls == ["answer"]
+    assert asyncio.run(state.get_state()) == UserFlow.step_2.state
+
+
+def test_tap_on_current_step_advances():
+    state = _state(UserFlow.step_2)
+    calls = []
+    asyncio.run(go_to_next_step(_tap("next_step:2", calls), state, UserFlow.step_2.state))
+    assert calls == ["edit_text", "answer"]
+    assert asyncio.run(state.get_state()) == UserFlow.step_3.state
@@ -1,20 +1,21 @@
 # web_app/server.py
-# Простой сервер для локальной отладки web app
-from http.server import HTTPServer, SimpleHTTPRequestHandler
-import os
+# Простой сервер для локальной отладки web app: та же раздача, что и в боте
+# (static.StaticAssets), но файлы перечитываются при изменении на диске.
+# Запуск из корня репозитория: python -m web_app.server
+from aiohttp import web
+
+import static
 
 PORT = 8000
 
-class CORSRequestHandler(SimpleHTTPRequestHandler):
-    def end_headers(self):
-        self.send_header('Access-Control-Allow-Origin', '*')
-        super().end_headers()
 
 def run_server():
-    os.chdir('web_app') # Переходим в папку с index.html
-    httpd = HTTPServer(('localhost', PORT), CORSRequestHandler)
-    print(f"Serving at http://localhost:{PORT}")
-    httpd.serve_forever()
+    app = web.Application()
+    assets = static.StaticAssets(static.WEBAPP_DIR, static.WEBAPP_PATH, headers={'Access-Control-Allow-Origin': '*'}, reload=True)
+    assets.register(app)
+    print(f"Serving at http://localhost:{PORT}{assets.url('index.html')}")
+    web.run_app(app, host='localhost', port=PORT, print=None)
+
 
 if __name__ == "__main__":
-    run_server()
\ No newline at end of file
+    run_server()